@@ -1,5 +1,101 @@
 import pyomo.environ as pyo
 
+# PFC とその他の栄養素のキー（RecipeNutrition 側の名前）
+PFC_KEYS = [
+    'カロリー(kcal)',
+    'たんぱく質(g)',
+    '脂質(g)',
+    '炭水化物(g)',
+]
+
+OTHER_KEYS = [
+    "食物繊維(g)",
+    "カルシウム(mg)",
+    "ビタミンA(μg)",
+    "ビタミンD(μg)",
+    "ビタミンC(mg)",
+    "ビタミンB₁(mg)",
+    "ビタミンB₂(mg)",
+    "鉄(mg)"
+]
+
+# 主菜を兼ねる主食の kind2（この主食を選んだ日は主菜を選ばない）
+STAPLE_SPECIAL_KIND2 = {'ご飯もの', 'パスタ', 'カレー', '鍋'}
+# ご飯の kind2（別案の重なり・部分編集の除外では献立の違いとみなさない）
+GOHAN_KIND2 = 'ご飯'
+# 1 日 1 回まで（週に日数分まで）使ってよいレシピの kind2．空ならご飯も含めて全レシピ週 1 回まで
+REPEATABLE_KIND2 = set()
+# 1 日の品目数の範囲
+ITEMS_PER_DAY = (3, 4)
+
+# レシピごとの 1 週間の使用回数の上限（モデルの RecipeUsage と献立の検証・貪欲法で共通）
+def weekly_recipe_cap(kind1, kind2, n_days):
+    if kind2 in REPEATABLE_KIND2:
+        return n_days
+    return 1
+
+# 実際にモデルに入れる栄養素のリスト
+def nutrition_keys(use_pfc=True):
+    if use_pfc:
+        return PFC_KEYS + OTHER_KEYS
+    return list(OTHER_KEYS)
+
+# 各栄養素の 1 週間合計の目標範囲 {栄養素: (下限, 上限)}（None は制限なし，両方 None の栄養素は含めない）
+# モデルの栄養制約と献立の検証で同じ範囲を使うため，ここで一元的に計算する
+def nutrition_bounds(nutritionals, menstruation, nut_keys):
+    cal_val = nutritionals.get('カロリー', None)
+
+    # 許容するズレ：目標値の5%　※カロリー・PFC・塩分以外の上限値は超えてはいけないラインなので下限値のみ範囲変更
+    low_ratio = 0.95 
+    up_ratio = 1.05
+
+    bounds = {}
+    for nut in nut_keys:
+        if nut == 'カロリー(kcal)':
+            bounds[nut] = (cal_val * 0.9 * low_ratio, cal_val * 1.1 * up_ratio)
+            continue
+
+        if nut == 'たんぱく質(g)':
+            p_lb = cal_val * low_ratio * (nutritionals.get('たんぱく質_下限',0)/100) / 4
+            p_ub = cal_val * up_ratio * (nutritionals.get('たんぱく質_上限',0)/100) / 4
+            bounds[nut] = (p_lb, p_ub)
+            continue
+
+        if nut == '脂質(g)':
+            f_lb = cal_val * low_ratio * (nutritionals.get('脂質_下限',0)/100) / 9
+            f_ub = cal_val * up_ratio * (nutritionals.get('脂質_上限',0)/100) / 9
+            bounds[nut] = (f_lb, f_ub)
+            continue
+
+        if nut == '炭水化物(g)':
+            c_lb = cal_val * low_ratio * (nutritionals.get('炭水化物_下限',0)/100) / 4
+            c_ub = cal_val * up_ratio * (nutritionals.get('炭水化物_上限',0)/100) / 4
+            bounds[nut] = (c_lb, c_ub)
+            continue
+
+        # それ以外の栄養素
+        lower_key = f"{nut.split('(')[0]}_下限"
+        upper_key = f"{nut.split('(')[0]}_上限"
+        raw_lower = nutritionals.get(lower_key, None)
+        raw_upper = nutritionals.get(upper_key, None)
+
+        # 鉄の月経対応
+        if nut == '鉄(mg)':
+            if menstruation == 'あり':
+                raw_lower = nutritionals.get('鉄・月経時_下限', None)
+            else:
+                raw_lower = nutritionals.get('鉄_下限', None)
+            raw_upper = nutritionals.get('鉄_上限', None)
+
+        # 下限側
+        if raw_lower is not None:
+            raw_lower = raw_lower * low_ratio   # 下限を少し緩める
+
+        if raw_lower is None and raw_upper is None:
+            continue
+        bounds[nut] = (raw_lower, raw_upper)
+    return bounds
+
 def build_model(
     days,
     recipe_dict,
@@ -11,11 +107,23 @@ def build_model(
     itemequal_dict,
     menstruation,
     regist_item,
-    use_pfc=True
+    use_pfc=True,
+    regist_inventory=True,
+    locked_menus=None
 ):
      # Pyomo の具体モデルを生成
     model = pyo.ConcreteModel()
 
+    # 部分編集の縮小モデル：固定した日（locked_menus = {日: {kind1: recipeId}}）は変数を置かず，
+    # その日のレシピの栄養・使用回数・食材・登録食材の使用量を定数として制約に足す
+    locked_menus = locked_menus or {}
+    model.locked_menus = locked_menus
+    locked_recipes = [r for menu in locked_menus.values() for r in menu.values() if r in recipe_dict]
+    week_days = len(days) + len(locked_menus)
+
+    def locked_amount(item):
+        return sum(recipeitem_dict.get(r, {}).get(item, 0) for r in locked_recipes)
+
     # 日とレシピIDの集合
     model.Days = pyo.Set(initialize=days)
     model.Recipes = pyo.Set(initialize=recipe_ids)
@@ -32,8 +140,7 @@ def build_model(
     model.kind2_map = pyo.Param(model.Recipes, initialize=kind2_map_init, within=pyo.Any)
 
     # --- kind2 が {ご飯もの, パスタ, カレー, 鍋} の主食レシピ集合 ---
-    staple_special_kind2 = {'ご飯もの', 'パスタ', 'カレー', '鍋'}
-    model.StapleSpecialRecipes = pyo.Set(initialize=[r for r in recipe_ids if recipe_dict[r]['data']['kind1']=='staple' and recipe_dict[r]['data']['kind2'] in staple_special_kind2])
+    model.StapleSpecialRecipes = pyo.Set(initialize=[r for r in recipe_ids if recipe_dict[r]['data']['kind1']=='staple' and recipe_dict[r]['data']['kind2'] in STAPLE_SPECIAL_KIND2])
 
     # --- 変数定義 ---
     # 日×レシピの採用フラグ（そのレシピをその日に使うかどうか）
@@ -83,130 +190,45 @@ def build_model(
 
     # --- 栄養制約の準備 ---
     # nutritionaltarget_dict から対象ユーザの栄養目標を 1 行取り出す
+    # 各レシピの週の使用回数（上限は weekly_recipe_cap で決める）
     def recipe_usage_rule(m, r):
-        if r in m.StapleSpecialRecipes:
-            return sum(m.x[d, r] for d in m.Days) <= 7
-        else:
-            return sum(m.x[d, r] for d in m.Days) <= 1
+        used = sum(m.x[d, r] for d in m.Days) + locked_recipes.count(r)
+        return used <= weekly_recipe_cap(m.kind1_map[r], m.kind2_map[r], week_days)
     model.RecipeUsage = pyo.Constraint(model.Recipes, rule=recipe_usage_rule)
 
     # （カロリー用）制約調整用の値
     target = next(iter(nutritionaltarget_dict.values()))
     nutritionals = target['nutritionals']  
 
-    cal_val = nutritionals.get('カロリー', None)
-
-    # PFC とその他の栄養素のキー（RecipeNutrition 側の名前）
-    pfc_keys = [
-        'カロリー(kcal)',
-        'たんぱく質(g)',
-        '脂質(g)',
-        '炭水化物(g)',
-    ]
-
-    other_keys = [
-        "食物繊維(g)",
-        "カルシウム(mg)",
-        "ビタミンA(μg)",
-        "ビタミンD(μg)",
-        "ビタミンC(mg)",
-        "ビタミンB₁(mg)",
-        "ビタミンB₂(mg)",
-        "鉄(mg)"
-    ]
-
-    # 実際にモデルに入れる栄養素のリスト
-    if use_pfc:
-        nut_keys = pfc_keys + other_keys
-    else:
-        nut_keys = other_keys
+    # 実際にモデルに入れる栄養素のリストと，その目標範囲
+    nut_keys = nutrition_keys(use_pfc)
+    model.nutrition_bound_map = nutrition_bounds(nutritionals, menstruation, nut_keys)
+    # 栄養素ごとの 1 週間合計の式（固定した日の分も含む．緩和ソルブ・違反レポートで使う）
+    model.nutrition_total = {}
 
     # 栄養制約：各栄養素について 1 週間の合計が目標範囲に収まるようにする
     def nutrition_rule(m, nut):
+        if nut not in m.nutrition_bound_map:
+            return pyo.Constraint.Skip
+
         total_val = sum(
             m.x[d, r] * filtered_recipe_nutritions[r].get(nut, 0)
             for d in m.Days
             for r in m.Recipes
-        )
-
-        # 許容するズレ：目標値の5%　※カロリー・PFC・塩分以外の上限値は超えてはいけないラインなので下限値のみ範囲変更
-        low_ratio = 0.95 
-        up_ratio = 1.05
-
-        if nut == 'カロリー(kcal)':
-            lower = cal_val * 0.9 * low_ratio
-            upper = cal_val * 1.1 * up_ratio
-            return pyo.inequality(lower, total_val, upper)
-
-        if nut == 'たんぱく質(g)':
-            p_lb = cal_val * low_ratio * (nutritionals.get('たんぱく質_下限',0)/100) / 4
-            p_ub = cal_val * up_ratio * (nutritionals.get('たんぱく質_上限',0)/100) / 4
-            return pyo.inequality(p_lb, total_val, p_ub)
-
-        if nut == '脂質(g)':
-            f_lb = cal_val * low_ratio * (nutritionals.get('脂質_下限',0)/100) / 9
-            f_ub = cal_val * up_ratio * (nutritionals.get('脂質_上限',0)/100) / 9
-            return pyo.inequality(f_lb, total_val, f_ub)
-
-        if nut == '炭水化物(g)':
-            c_lb = cal_val * low_ratio * (nutritionals.get('炭水化物_下限',0)/100) / 4
-            c_ub = cal_val * up_ratio * (nutritionals.get('炭水化物_上限',0)/100) / 4
-            return pyo.inequality(c_lb, total_val, c_ub)
-
-        # それ以外の栄養素
-        lower_key = f"{nut.split('(')[0]}_下限"
-        upper_key = f"{nut.split('(')[0]}_上限"
-        raw_lower = nutritionals.get(lower_key, None)
-        raw_upper = nutritionals.get(upper_key, None)
-
-        # 鉄の月経対応
-        if nut == '鉄(mg)':
-            if menstruation == 'あり':
-                raw_lower = nutritionals.get('鉄・月経時_下限', None)
-            else:
-                raw_lower = nutritionals.get('鉄_下限', None)
-            raw_upper = nutritionals.get('鉄_上限', None)
+        ) + sum(filtered_recipe_nutritions.get(r, {}).get(nut, 0) for r in locked_recipes)
+        m.nutrition_total[nut] = total_val
 
-        # 下限側
-        if raw_lower is not None:
-            raw_lower = raw_lower * low_ratio   # 下限を少し緩める
-        else:
-            raw_lower = None
-
-        if raw_lower is None and raw_upper is None:
-            return pyo.Constraint.Skip
-        if raw_lower is None:
-            return pyo.inequality(None, total_val, raw_upper)
-        if raw_upper is None:
-            return pyo.inequality(raw_lower, total_val, None)
-        return pyo.inequality(raw_lower, total_val, raw_upper)
+        lower, upper = m.nutrition_bound_map[nut]
+        return pyo.inequality(lower, total_val, upper)
 
     model.NutritionConstraints = pyo.Constraint(nut_keys, rule=nutrition_rule)
 
     # 1日の品目数（選ばれたレシピ数）を 3〜4 個に制限
     def items_per_day_rule(m, d):
-        return pyo.inequality(3, sum(m.x[d, r] for r in m.Recipes), 4)
+        return pyo.inequality(ITEMS_PER_DAY[0], sum(m.x[d, r] for r in m.Recipes), ITEMS_PER_DAY[1])
 
     model.ItemsPerDay = pyo.Constraint(model.Days, rule=items_per_day_rule)
 
-    # 未使用量（使い残し）を表す変数
-    model.Unused = pyo.Var(regist_item.keys(), domain=pyo.NonNegativeReals)
-
-    # 登録食材を使ったかどうか（0/1）
-    model.y_regist = pyo.Var(model.Ingredients, domain=pyo.Binary)
-    def y_regist_rule(m, i):
-        # 1週間のどこかで i が使われていたら 1
-        total_used = sum(
-            m.x[d, r] * recipeitem_dict[r].get(i, 0)
-            for d in m.Days for r in m.Recipes
-        )
-        # total_used > 0 → y_regist[i] = 1 を言いたい
-        # Pyomo では Big-M の形にする
-        return total_used <= BIG_M * m.y_regist[i]
-
-    BIG_M = 1000
-    model.YRegistConstraint = pyo.Constraint(model.Ingredients, rule=y_regist_rule)
-
     # 指定食材の使用量を「基準重量の倍数」に近づけるための誤差変数 e[d,r,i]
     model.e = pyo.Var(model.Days, model.Recipes, model.Ingredients, within=pyo.NonNegativeReals)
 
@@ -254,7 +276,7 @@ def build_model(
         return sum(
             m.x[d, r] * recipeitem_dict[r].get(i, 0)
             for d in m.Days for r in m.Recipes
-        ) <= 1e6 * m.y_item[i]
+        ) + locked_amount(i) <= 1e6 * m.y_item[i]
 
     model.IngredientLink = pyo.Constraint(model.Ingredients, rule=ingredient_link_rule)
 
@@ -318,19 +340,69 @@ def build_model(
     term_item = term_eq + term_non_eq
 
 
-    # ご飯レシピの集合
-    model.GohanRecipes = [r for r in model.Recipes if model.kind2_map[r] == 'ご飯']
-    # ご飯以外のレシピ
-    model.NonGohanRecipes = [r for r in model.Recipes if model.kind2_map[r] != 'ご飯']
-    # ご飯レシピ → 7回まで
-    def limit_gohan_rule(m, r):
-        return sum(m.x[d, r] for d in m.Days) <= len(m.Days)
-    model.LimitGohan = pyo.Constraint(model.GohanRecipes, rule=limit_gohan_rule)
-
-    # ご飯以外レシピ → 1回まで
-    def limit_non_gohan_rule(m, r):
-        return sum(m.x[d, r] for d in m.Days) <= 1
-    model.LimitNonGohan = pyo.Constraint(model.NonGohanRecipes, rule=limit_non_gohan_rule)
+    # --- 登録食材 ---
+    if regist_inventory:
+        # 登録食材ごとに，等価クラスを通してレシピ側の食材名に対応づける（レシピに出てこないものは除く）
+        regist_members = {}
+        for name in regist_item:
+            rep = rep_map.get(name)
+            members = {i for i, c in rep_map.items() if c == rep} if rep is not None else {name}
+            members &= ingredients_set
+            if members:
+                regist_members[name] = sorted(members)
+        model.RegistItems = pyo.Set(initialize=sorted(regist_members))
+
+        # 登録食材を含むレシピと，その 1 回あたりの使用量（g）
+        regist_recipes = {}
+        for k, members in regist_members.items():
+            regist_recipes[k] = {}
+            for r in model.Recipes:
+                amount = sum(recipeitem_dict[r].get(i, 0) for i in members)
+                if amount > 0:
+                    regist_recipes[k][r] = amount
+
+        # 登録食材を使ったかどうか（0/1）．含むレシピを 1 つも選ばなければ 0
+        model.y_regist = pyo.Var(model.RegistItems, domain=pyo.Binary)
+        def y_regist_rule(m, k):
+            locked_uses = sum(1 for r in locked_recipes if r in regist_recipes[k])
+            return m.y_regist[k] <= sum(m.x[d, r] for d in m.Days for r in regist_recipes[k]) + locked_uses
+        model.YRegistConstraint = pyo.Constraint(model.RegistItems, rule=y_regist_rule)
+
+        # 使い残し（登録量 - 1 週間の使用量）．登録量が 0 の食材は使ったかどうかだけを見る
+        model.RegistAmounts = pyo.Set(initialize=[k for k in model.RegistItems if float(regist_item[k] or 0) > 0])
+        model.Unused = pyo.Var(model.RegistAmounts, domain=pyo.NonNegativeReals)
+        def unused_rule(m, k):
+            used = sum(m.x[d, r] * amount for d in m.Days for r, amount in regist_recipes[k].items()) \
+                + sum(regist_recipes[k].get(r, 0) for r in locked_recipes)
+            return m.Unused[k] >= float(regist_item[k]) - used
+        model.UnusedConstraint = pyo.Constraint(model.RegistAmounts, rule=unused_rule)
+        regist_keys = list(model.RegistItems)
+        # 使い残しは登録量に対する割合で評価する
+        term_leftover = sum(model.Unused[k] / float(regist_item[k]) for k in model.RegistAmounts)
+    else:
+        # 旧方式：全食材に y_regist を置く（比較用）
+        # 未使用量（使い残し）を表す変数
+        model.Unused = pyo.Var(regist_item.keys(), domain=pyo.NonNegativeReals)
+
+        # 登録食材を使ったかどうか（0/1）
+        model.y_regist = pyo.Var(model.Ingredients, domain=pyo.Binary)
+        def y_regist_rule(m, i):
+            # 1週間のどこかで i が使われていたら 1
+            total_used = sum(
+                m.x[d, r] * recipeitem_dict[r].get(i, 0)
+                for d in m.Days for r in m.Recipes
+            ) + locked_amount(i)
+            # total_used > 0 → y_regist[i] = 1 を言いたい
+            # Pyomo では Big-M の形にする
+            return total_used <= BIG_M * m.y_regist[i]
+
+        BIG_M = 1000
+        model.YRegistConstraint = pyo.Constraint(model.Ingredients, rule=y_regist_rule)
+        regist_keys = list(model.Ingredients)
+        term_leftover = 0
+
+    # ご飯レシピの集合（使用回数の上限は RecipeUsage にまとめた）
+    model.GohanRecipes = [r for r in model.Recipes if model.kind2_map[r] == GOHAN_KIND2]
 
     # 目的関数
     # 重み
@@ -338,10 +410,12 @@ def build_model(
     weight_regist   = 5    # 登録食材を使うメリット
     penalty_not_use = 15  # 登録食材を使わないペナルティ
     weight_multiple = 20   # 倍数ルールからのズレに体すえるペナルティ
+    weight_leftover = 10   # 登録食材の使い残し（登録量に対する割合）のペナルティ
     model.obj = pyo.Objective(
         expr = weight_item * term_item
-            - weight_regist * sum(model.y_regist[i] for i in model.Ingredients)
-            + penalty_not_use * sum(1 - model.y_regist[i] for i in model.Ingredients)
+            - weight_regist * sum(model.y_regist[i] for i in regist_keys)
+            + penalty_not_use * sum(1 - model.y_regist[i] for i in regist_keys)
+            + weight_leftover * term_leftover
             + weight_multiple * sum(model.e[d,r,i] for d in model.Days for r in model.Recipes for i in model.Ingredients),
         sense = pyo.minimize
     )
@@ -349,4 +423,115 @@ def build_model(
     # --- Solver ---
     model.solver = pyo.SolverFactory('cbc')
 
-    return model
\ No newline at end of file
+    return model
+
+# 既に得た献立と重なりすぎない献立を探すためのカット
+# （ご飯レシピは献立の違いとみなさないため重なりの判定から外す）
+def add_diversity_cut(model, day_menus, max_overlap=0.7):
+    used = {
+        r
+        for menu in day_menus.values()
+        for r in menu.values()
+        if r in model.Recipes and r not in model.GohanRecipes
+    }
+    if not used:
+        return None
+
+    if not hasattr(model, 'DiversityCuts'):
+        model.DiversityCuts = pyo.ConstraintList()
+
+    # 前の献立のレシピは，全体の max_overlap 割までしか再利用しない
+    limit = int(max_overlap * len(used))
+    return model.DiversityCuts.add(
+        sum(model.x[d, r] for d in model.Days for r in used) <= limit
+    )
+
+
+# 献立の部分編集：固定した日・レシピの x[d,r] を現在の献立の値で固定し，
+# 残りは現在の献立を初期解（warm start）として解き直す
+# （縮小モデルでは固定した日は変数がないので，残りの日のレシピ固定・今のレシピの除外だけが効く）
+def apply_menu_locks(model, day_menus, lock_days=(), lock_recipes=(), exclude_current=True):
+    current = {
+        (d, r)
+        for d in model.Days
+        for r in day_menus.get(f"menu{d}", {}).values()
+        if r in model.Recipes
+    }
+    lock_days = set(lock_days)
+    lock_recipes = set(lock_recipes)
+
+    excluded = []
+    for d in model.Days:
+        for r in model.Recipes:
+            var = model.x[d, r]
+            chosen = (d, r) in current
+            var.set_value(1 if chosen else 0)
+
+            if d in lock_days:
+                # 日ごと固定：その日の選択をそのまま使う
+                var.fix(1 if chosen else 0)
+            elif chosen and r in lock_recipes:
+                # レシピ固定：その日のそのレシピだけ残す
+                var.fix(1)
+            elif chosen and exclude_current and r not in model.GohanRecipes:
+                # 作り直す枠では今のレシピを外して別の料理にする（ご飯は同じものを残してよい）
+                var.fix(0)
+                excluded.append(var)
+
+    # 解なしになったときに外せるよう，除外した変数を返す
+    return excluded
+
+
+# 栄養制約を「違反量にペナルティを課す」形に置き換える（解なしの栄養目標でも最も近い献立を求める）
+def make_elastic(model, penalty=1e7):
+    model.NutritionConstraints.deactivate()
+    keys = list(model.nutrition_total.keys())
+    model.NutShortage = pyo.Var(keys, within=pyo.NonNegativeReals)
+    model.NutExcess = pyo.Var(keys, within=pyo.NonNegativeReals)
+
+    # 下限側：合計 + 不足量 >= 下限
+    def elastic_lower_rule(m, nut):
+        lower, _ = m.nutrition_bound_map[nut]
+        if lower is None:
+            return pyo.Constraint.Skip
+        return m.nutrition_total[nut] + m.NutShortage[nut] >= lower
+    model.ElasticLower = pyo.Constraint(keys, rule=elastic_lower_rule)
+
+    # 上限側：合計 - 超過量 <= 上限
+    def elastic_upper_rule(m, nut):
+        _, upper = m.nutrition_bound_map[nut]
+        if upper is None:
+            return pyo.Constraint.Skip
+        return m.nutrition_total[nut] - m.NutExcess[nut] <= upper
+    model.ElasticUpper = pyo.Constraint(keys, rule=elastic_upper_rule)
+
+    # 違反量は目標値に対する割合で評価する（単位の違う栄養素を同じ重みで扱う）
+    def scale(nut):
+        lower, upper = model.nutrition_bound_map[nut]
+        ref = max(abs(v) for v in (lower, upper) if v is not None)
+        return 1 / max(ref, 1e-6)
+
+    model.obj.deactivate()
+    model.elastic_obj = pyo.Objective(
+        expr = model.obj.expr
+            + penalty * sum(scale(nut) * (model.NutShortage[nut] + model.NutExcess[nut]) for nut in keys),
+        sense = pyo.minimize
+    )
+
+# 栄養素ごとの目標範囲と実際の合計，不足・超過量のレポート
+def nutrition_violations(model, tol=1e-6):
+    report = {}
+    for nut, total in model.nutrition_total.items():
+        lower, upper = model.nutrition_bound_map[nut]
+        value = pyo.value(total)
+        shortage = max(0, lower - value) if lower is not None else 0
+        excess = max(0, value - upper) if upper is not None else 0
+        if shortage > tol or excess > tol:
+            report[nut] = {
+                'total': round(value, 3),
+                'lower': None if lower is None else round(lower, 3),
+                'upper': None if upper is None else round(upper, 3),
+                'shortage': round(shortage, 3),
+                'excess': round(excess, 3),
+            }
+    return report
@@ -0,0 +1,99 @@
+import bisect
+import hashlib
+import unicodedata
+
+# 検索語・食材名の表記揺れをならす（全角半角・大文字小文字・カタカナ→ひらがな・旧字体）
+KANJI_VARIANTS = str.maketrans({
+    "鷄": "鶏",
+    "雞": "鶏",
+})
+
+def normalize(name):
+    s = unicodedata.normalize("NFKC", name or "").strip().lower().translate(KANJI_VARIANTS)
+    # カタカナ（ァ〜ヶ）をひらがなにそろえる
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in s).replace(" ", "")
+
+# 名前に含まれる長さ 1〜3 の部分文字列（日本語の食材名は短いので 3-gram までで十分）
+def _grams(s, n):
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class IngredientIndex:
+    """レシピに出てくる食材名（正規名）の前方一致・部分一致（3-gram）索引"""
+
+    def __init__(self, ingredients, item_equals=None):
+        self.ingredients = sorted(set(ingredients))
+        ingredient_set = set(self.ingredients)
+
+        # 等価クラス（itemEquals）：どの名前で探しても，レシピに出てくる名前を候補に出す
+        members = {name: {name} for name in self.ingredients}
+        for rep, equals in (item_equals or {}).items():
+            group = {rep} | {e.strip() for e in (equals or "").split(",") if e.strip()}
+            # 白米クラスにはレシピ側の「米」も入れる（モデルと同じ扱い）
+            if "白米" in group:
+                group.add("米")
+            canon = sorted(n for n in group if n in ingredient_set)
+            for name in group:
+                members.setdefault(name, set()).update(canon)
+
+        # 検索用の別名（正規化済み）→ 正規名の集合
+        self.aliases = {}
+        for alias, canon in members.items():
+            if canon:
+                self.aliases.setdefault(normalize(alias), set()).update(canon)
+
+        self.keys = sorted(self.aliases)
+        self.grams = {}
+        for key in self.keys:
+            for n in (1, 2, 3):
+                for g in _grams(key, n):
+                    self.grams.setdefault(g, set()).add(key)
+
+        # 版は食材名と別名の対応の両方から求める（itemEquals だけの変更でも変わる）
+        h = hashlib.sha1("\n".join(self.ingredients).encode("utf-8"))
+        for key in self.keys:
+            h.update(f"\n{key}\t{','.join(sorted(self.aliases[key]))}".encode("utf-8"))
+        self.version = h.hexdigest()
+
+    # 入力された食材名を正規名に直す（見つからなければ None）
+    def resolve(self, name):
+        canon = self.aliases.get(normalize(name))
+        if not canon:
+            return None
+        # 入力そのものが正規名ならそれを優先する
+        return name if name in canon else sorted(canon)[0]
+
+    # 候補を一致の良い順に返す（完全一致 → 前方一致 → 部分一致，同順位は短い名前から）
+    def suggest(self, query, limit=10):
+        q = normalize(query)
+        if not q:
+            return []
+
+        # 前方一致は整列済みのキーを二分探索
+        start = bisect.bisect_left(self.keys, q)
+        prefix = []
+        for key in self.keys[start:]:
+            if not key.startswith(q):
+                break
+            prefix.append(key)
+
+        # 部分一致は 3-gram（短い語はそれ以下）の転置リストの積から絞り込んで確かめる
+        n = min(3, len(q))
+        postings = [self.grams.get(g, set()) for g in _grams(q, n)]
+        candidates = set.intersection(*postings) if postings else set()
+        contains = [key for key in candidates if q in key and not key.startswith(q)]
+
+        def rank(key):
+            return (0 if key == q else 1, len(key), key)
+
+        results = []
+        seen = set()
+        for key in sorted(prefix, key=rank) + sorted(contains, key=rank):
+            for name in sorted(self.aliases[key]):
+                if name in seen:
+                    continue
+                seen.add(name)
+                results.append(name)
+                if len(results) >= limit:
+                    return results
+        return results
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import http.cookiejar
+import urllib.parse
+import urllib.request
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+
+# 負荷試験：仮想ユーザーごとに signup → login → /createmenu → /menu_status のポーリング → 各表示ページ を流す
+# 起動済みの Flask アプリ（--url）とローカル Postgres に対して実行する．--workers を付けると
+# SOLVER_BACKEND=stub のワーカーを起動し，CBC を除いた Web・キューの処理能力を測れる
+# 登録食材なしの依頼は献立ライブラリから即時に返るので，ソルバーのキューに負荷をかけるには --regist-ratio を使う
+
+AGES = ["18~29(歳)", "30~49(歳)", "50~64(歳)", "65~74(歳)", "75以上(歳)"]
+GENDERS = ["男性", "女性"]
+LEVELS = ["低い", "ふつう", "高い"]
+READ_PAGES = ["/showmenu", "/item", "/nutrition"]
+
+
+class Recorder:
+    """エンドポイントごとの応答時間と，献立作成の所要時間を集める"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.end_to_end = []
+        self.paths = {}
+        self.failed_jobs = 0
+
+    def add(self, name, seconds, ok=True):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    # 献立作成の所要時間を，返し方（library・pregenerated は即時，solved はキュー経由）ごとにも記録する
+    def add_menu(self, path, seconds):
+        with self.lock:
+            self.end_to_end.append(seconds)
+            self.paths.setdefault(path, []).append(seconds)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(values)
+    return {f"p{p}": round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 4) for p in points}
+
+
+class VirtualUser:
+    """Cookie を持つ 1 人分のクライアント"""
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.timeout = timeout
+        self.etags = {}
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, name, path, form=None, payload=None, revalidate=False):
+        data = None
+        headers = {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif payload is not None:
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        # ブラウザと同じく前回の ETag を送り，304 で済むかを測る
+        if revalidate and path in self.etags:
+            headers["If-None-Match"] = self.etags[path]
+
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        start = time.time()
+        status, body = None, b""
+        try:
+            with self.opener.open(req, timeout=self.timeout) as res:
+                status, body = res.status, res.read()
+                if res.headers.get("ETag"):
+                    self.etags[path] = res.headers["ETag"]
+        except HTTPError as e:
+            status, body = e.code, e.read()
+        except OSError:
+            status = None
+        self.recorder.add(name, time.time() - start, ok=status is not None and status < 400)
+        return status, body
+
+
+# 試験で登録食材に使う食材名（レシピに出てくる食材名）
+def reference_ingredients():
+    from source.main.menuapp import app, db, RecipeItem
+    with app.app_context():
+        names = set()
+        for ri in db.session.query(RecipeItem.items).all():
+            names.update((ri.items or {}).keys())
+    return sorted(names)
+
+
+def run_user(index, args, recorder, run_id, ingredients=()):
+    rnd = random.Random(f"{run_id}-{index}")
+    user = VirtualUser(args.url, recorder, args.timeout)
+    gender = rnd.choice(GENDERS)
+    form = {
+        "userName": f"loadtest_{run_id}_{index}",
+        "password": "loadtest",
+        "userAge": rnd.choice(AGES),
+        "userGender": gender,
+        "userExerciseLevel": rnd.choice(LEVELS),
+        "menstruation": rnd.choice(["あり", "なし"]) if gender == "女性" else "なし",
+    }
+    user.request("signup", "/signup", form=form)
+    user.request("login", "/login", form={"userName": form["userName"], "password": form["password"]})
+
+    for _ in range(args.iterations):
+        regist_item = {}
+        if ingredients and rnd.random() < args.regist_ratio:
+            names = rnd.sample(ingredients, min(args.regist_items, len(ingredients)))
+            regist_item = {name: rnd.choice([50, 100, 150, 200]) for name in names}
+        start = time.time()
+        status, body = user.request("createmenu", "/createmenu", payload=regist_item)
+        if status is None or status >= 400:
+            continue
+        try:
+            immediate = json.loads(body).get("status") == "done"
+        except ValueError:
+            immediate = False
+        # 即時に返ったものはライブラリ（登録食材なし）か事前生成（登録食材あり）
+        path = ("pregenerated" if regist_item else "library") if immediate else "solved"
+
+        # 作成完了までポーリング（画面と同じく暫定献立が出た時点で表示に進む）
+        state = None
+        deadline = start + args.job_timeout
+        while time.time() < deadline:
+            status, body = user.request("menu_status", "/menu_status")
+            try:
+                state = json.loads(body).get("status") if status == 200 else None
+            except ValueError:
+                state = None
+            if state in ("done", "provisional", "failed"):
+                break
+            time.sleep(args.poll_interval)
+        if state == "failed" or state not in ("done", "provisional"):
+            with recorder.lock:
+                recorder.failed_jobs += 1
+            continue
+        recorder.add_menu(path, time.time() - start)
+
+        for _ in range(args.views):
+            for page in READ_PAGES:
+                user.request(page, page, revalidate=True)
+
+
+# 試験中のジョブの待ち時間・求解時間を DB から集める
+def job_stats(run_id):
+    from sqlalchemy import text
+    from source.main.menuapp import app, db
+    with app.app_context():
+        rows = db.session.execute(text(
+            "SELECT queue_wait, solve_seconds, status, strategy FROM menu_jobs WHERE userName LIKE :prefix"),
+            {"prefix": f"loadtest_{run_id}_%"}
+        ).fetchall()
+    waits = [float(r.queue_wait) for r in rows if r.queue_wait is not None]
+    solves = [float(r.solve_seconds) for r in rows if r.solve_seconds is not None]
+    strategies = {}
+    for r in rows:
+        strategies[r.strategy or r.status] = strategies.get(r.strategy or r.status, 0) + 1
+    return {"queue_wait": percentiles(waits), "solve_seconds": percentiles(solves), "jobs": strategies}
+
+
+def start_workers(count, stub_latency):
+    env = dict(os.environ, SOLVER_BACKEND="stub", STUB_SOLVER_LATENCY=str(stub_latency))
+    base_dir = os.path.join(os.path.dirname(__file__), "../..")
+    return [
+        subprocess.Popen([sys.executable, "-m", "source.main.menu_worker"], cwd=base_dir, env=env)
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="献立アプリの負荷試験")
+    parser.add_argument("--url", default="http://localhost:5000", help="Flask アプリの URL")
+    parser.add_argument("--users", type=int, default=20, help="仮想ユーザー数（同時実行数）")
+    parser.add_argument("--iterations", type=int, default=1, help="1 ユーザーあたりの献立作成回数")
+    parser.add_argument("--views", type=int, default=3, help="作成後に表示ページを見る回数")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="/menu_status のポーリング間隔（秒）")
+    parser.add_argument("--job-timeout", type=float, default=300, help="献立作成を待つ上限（秒）")
+    parser.add_argument("--timeout", type=float, default=30, help="1 リクエストのタイムアウト（秒）")
+    parser.add_argument("--workers", type=int, default=0, help="起動するスタブソルバーのワーカー数（0 なら起動済みのワーカーを使う）")
+    parser.add_argument("--stub-latency", type=float, default=1.0, help="スタブソルバーの 1 ジョブあたりの所要時間（秒）")
+    parser.add_argument("--regist-ratio", type=float, default=0.0,
+                        help="登録食材を付けて献立を作成する割合（0〜1．食材はレシピに出てくるものから選ぶ）")
+    parser.add_argument("--regist-items", type=int, default=2, help="1 回の作成で登録する食材の数")
+    parser.add_argument("--no-db-stats", action="store_true", help="DB からジョブの待ち時間を集めない")
+    args = parser.parse_args()
+
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    recorder = Recorder()
+    ingredients = reference_ingredients() if args.regist_ratio > 0 else []
+    workers = start_workers(args.workers, args.stub_latency) if args.workers else []
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            for future in [pool.submit(run_user, i, args, recorder, run_id, ingredients) for i in range(args.users)]:
+                future.result()
+        elapsed = time.time() - start
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+    total_requests = sum(len(v) for v in recorder.latencies.values())
+    report = {
+        "run_id": run_id,
+        "users": args.users,
+        "elapsed": round(elapsed, 2),
+        "requests": total_requests,
+        "requests_per_sec": round(total_requests / elapsed, 2) if elapsed else None,
+        "menus_per_sec": round(len(recorder.end_to_end) / elapsed, 3) if elapsed else None,
+        "failed_jobs": recorder.failed_jobs,
+        "end_to_end": percentiles(recorder.end_to_end),
+        "end_to_end_by_path": {
+            path: dict(count=len(values), **percentiles(values)) for path, values in sorted(recorder.paths.items())
+        },
+        "endpoints": {
+            name: dict(count=len(values), errors=recorder.errors.get(name, 0), **percentiles(values))
+            for name, values in sorted(recorder.latencies.items())
+        },
+    }
+    if not args.no_db_stats:
+        report.update(job_stats(run_id))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from sqlalchemy import text
+from pyomo.environ import SolverFactory
+from source.main.menuapp import (
+    app, db, CBC_PATH, should_use_pfc, wrap_nutritional_target, library_key, load_nutritional_targets,
+    record_dependencies
+)
+from source.main.menu_worker import load_reference, solution_pool
+from source.main.model_loader import build_job_model, extract_day_menus, solve_model
+from source.main.schema import ensure_schema
+from source.main.sandbox import SANDBOX_WALL_MARGIN, SandboxLimit, SandboxError, SandboxCancelled, run_limited
+
+# ライブラリの設定（環境変数で上書き可）
+LIBRARY_SIZE = int(os.environ.get("LIBRARY_SIZE", 5))                     # プロファイルごとの献立数 K
+LIBRARY_TIME_LIMIT = float(os.environ.get("LIBRARY_TIME_LIMIT", 60))      # 1 献立あたりの制限時間（秒）
+LIBRARY_RATIO_GAP = float(os.environ.get("LIBRARY_RATIO_GAP", 0.01))      # オフラインなので通常より厳しく
+LIBRARY_MAX_OVERLAP = float(os.environ.get("LIBRARY_MAX_OVERLAP", 0.7))   # 既出献立とのレシピ重なりの上限
+
+# 子プロセスで共有する参照データ
+_REFERENCE = None
+# 空き時間の解き直しで解なしだったプロファイル（このプロセスでは繰り返さない）
+_INFEASIBLE_PROFILES = set()
+
+def _init_process(reference):
+    global _REFERENCE
+    _REFERENCE = reference
+
+# 栄養目標 × 月経の組み合わせを列挙する（PFC 有無は栄養目標のユーザー情報から決まる）
+def library_profiles():
+    profiles = []
+    for nt in load_nutritional_targets().values():
+        user_info = dict(nt['userInfo'])
+        menstruations = ['なし', 'あり'] if user_info.get('性別') == '女性' else ['なし']
+        for menstruation in menstruations:
+            profiles.append({
+                'key': library_key(user_info, menstruation),
+                'userInfo': user_info,
+                'menstruation': menstruation,
+                'use_pfc': should_use_pfc(user_info),
+                'nutritionals': dict(nt['nutritionals']),
+            })
+    return profiles
+
+# プロファイルの内容から，そのプロファイルの版を求める
+# 参照データの変更は版に含めない（使っているレシピ・食材が変わったプロファイルだけを依存関係から無効にする）
+def profile_version(profile):
+    canonical = json.dumps(profile, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+# 1 プロファイル分の献立を K 件求める（子プロセスで実行）
+def solve_profile(profile, k, reference=None):
+    nutritionaltarget_dict = wrap_nutritional_target({
+        'nutritionals': dict(profile['nutritionals']),
+        'userInfo': profile['userInfo'],
+    })
+    model, scope = build_job_model(
+        reference or _REFERENCE, nutritionaltarget_dict, profile['menstruation'], {}, profile['use_pfc']
+    )
+
+    solver = SolverFactory('cbc', executable=CBC_PATH)
+    solver.options['sec'] = LIBRARY_TIME_LIMIT
+    solver.options['ratioGap'] = LIBRARY_RATIO_GAP
+    try:
+        _, found = solve_model(solver, model)
+    except Exception as e:
+        logging.warning(f"Library solve failed for {profile['key']}: {e}")
+        return profile['key'], []
+    day_menus = extract_day_menus(model)
+    if not found or not all(day_menus.values()):
+        return profile['key'], []
+
+    # 2 件目以降は既出の献立と重なりすぎないように解き直す
+    pool = solution_pool(
+        model, scope, day_menus, k - 1, LIBRARY_TIME_LIMIT, LIBRARY_RATIO_GAP, LIBRARY_MAX_OVERLAP
+    )
+    return profile['key'], pool
+
+def _solve_profile_task(args):
+    profile, k = args
+    return solve_profile(profile, k)
+
+# 1 プロファイル分の献立を入れ替え，使ったレシピを依存関係として記録する
+def store_profile(key, version, entries):
+    db.session.execute(text("DELETE FROM menu_library WHERE profile_key=:key"), {'key': key})
+    for variant, menus in enumerate(entries):
+        db.session.execute(text(
+            "INSERT INTO menu_library (profile_key, variant, profile_version, menus) "
+            "VALUES (:key, :variant, :version, :menus)"),
+            {
+                'key': key,
+                'variant': variant,
+                'version': version,
+                'menus': json.dumps(menus, ensure_ascii=False),
+            }
+        )
+    db.session.commit()
+    record_dependencies('library', [key], entries)
+    logging.info(f"Menu library: stored {len(entries)} menus for profile {key}")
+
+# 子プロセス側：1 プロファイル分を解いて返す（DB には触れない）
+def _refresh_in_child(send, profile, k, reference):
+    return solve_profile(profile, k, reference)
+
+# 参照データの変更で無効にされたプロファイルを 1 件だけ解き直す（ワーカーの空き時間に呼ぶ）
+# 求解は上限付きの子プロセスで行い，cancel（待機ジョブが来たら立つイベント）が立てば途中でやめる（次の空き時間にやり直す）
+# ライブラリを作っていない環境では何もしない（全体の構築・無効にされたプロファイルの作り直しはこのモジュールの CLI でもできる）
+def refresh_missing_profile(reference, k=LIBRARY_SIZE, cancel=None):
+    stored = set(db.session.execute(text("SELECT DISTINCT profile_key FROM menu_library")).scalars().all())
+    db.session.commit()
+    if not stored:
+        return False
+    for profile in library_profiles():
+        key = profile['key']
+        if key in stored or key in _INFEASIBLE_PROFILES:
+            continue
+        # 複数のワーカーが同じプロファイルを解かないよう，取れなければ次へ
+        with db.engine.connect() as conn:
+            if not conn.execute(text("SELECT pg_try_advisory_lock(hashtext(:key))"), {'key': key}).scalar():
+                continue
+            try:
+                if db.session.execute(text(
+                    "SELECT 1 FROM menu_library WHERE profile_key=:key LIMIT 1"), {'key': key}
+                ).first():
+                    db.session.commit()
+                    continue
+                db.session.commit()
+                start = time.time()
+                try:
+                    key, entries = run_limited(
+                        _refresh_in_child, (profile, k, reference),
+                        wall_timeout=k * LIBRARY_TIME_LIMIT + SANDBOX_WALL_MARGIN, cancel=cancel
+                    )
+                except SandboxCancelled:
+                    logging.info(f"Menu library: refresh of profile {key} yielded to pending jobs")
+                    return False
+                except (SandboxLimit, SandboxError) as e:
+                    _INFEASIBLE_PROFILES.add(key)
+                    logging.error(f"Menu library: refresh of profile {key} failed: {e}")
+                    return True
+                if not entries:
+                    _INFEASIBLE_PROFILES.add(key)
+                    logging.error(f"Menu library: no feasible menu for profile {key}")
+                    return True
+                store_profile(key, profile_version(profile), entries)
+                logging.info(f"Menu library: refreshed profile {key} in {time.time() - start:.1f}s")
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), {'key': key})
+        return True
+    return False
+
+# ライブラリを再構築する（full=False なら版が変わったプロファイルだけ）
+def rebuild_library(k=LIBRARY_SIZE, processes=None, full=False):
+    ensure_schema()
+    with app.app_context():
+        reference = load_reference()
+
+        stored = dict(db.session.execute(text(
+            "SELECT profile_key, MIN(profile_version) FROM menu_library GROUP BY profile_key"
+        )).fetchall())
+
+        targets = []
+        versions = {}
+        for profile in library_profiles():
+            version = profile_version(profile)
+            versions[profile['key']] = version
+            if full or stored.get(profile['key']) != version:
+                targets.append(profile)
+
+        # 栄養目標から消えたプロファイルを削除
+        for key in set(stored) - set(versions):
+            db.session.execute(text("DELETE FROM menu_library WHERE profile_key=:key"), {'key': key})
+        db.session.commit()
+
+        logging.info(f"Menu library: {len(targets)}/{len(versions)} profiles to rebuild")
+        if not targets:
+            return
+
+        start = time.time()
+        processes = processes or os.cpu_count()
+        with multiprocessing.Pool(processes, initializer=_init_process, initargs=(reference,)) as pool:
+            for key, entries in pool.imap_unordered(_solve_profile_task, [(p, k) for p in targets]):
+                if not entries:
+                    logging.error(f"Menu library: no feasible menu for profile {key}")
+                    continue
+                store_profile(key, versions[key], entries)
+
+        logging.info(f"Menu library rebuilt in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="栄養目標プロファイルごとの献立ライブラリを事前計算する")
+    parser.add_argument("--k", type=int, default=LIBRARY_SIZE, help="プロファイルごとの献立数")
+    parser.add_argument("--processes", type=int, default=None, help="並列プロセス数（既定: CPU 数）")
+    parser.add_argument("--full", action="store_true", help="版に関係なく全プロファイルを作り直す")
+    args = parser.parse_args()
+    rebuild_library(args.k, args.processes, args.full)
@@ -1,161 +1,800 @@
 import os
 import time
 import json
+import random
+import socket
 import logging
+import threading
 from sqlalchemy import text
-from pyomo.util.infeasible import log_infeasible_constraints
-from datetime import datetime, timezone, timedelta
+from datetime import datetime
 from source.main.menuapp import (
-    db, CBC_PATH, User, Menu, Recipe, RecipeItem, RecipeNutrition,
-    ItemWeight, ItemEqual, NutritionalTarget
+    db, CBC_PATH, User, Recipe, RecipeItem, RecipeNutrition,
+    ItemWeight, ItemEqual
 )
 from pyomo.environ import SolverFactory
-from source.main.menuapp import app, db, sanitize_pyomo_code, should_use_pfc, wrap_nutritional_target
+from source.main.menuapp import (
+    app, db, should_use_pfc, wrap_nutritional_target, problem_key, library_key,
+    find_nutritional_target, load_nutritional_targets, find_library_menus, save_menu, record_dependencies,
+    read_session, wait_for_replica, table_fingerprint
+)
+from source.main.scheduler import plan_budget, QUEUE_WAIT_SLO, CHEAP_JOB_SECONDS, CostModel, order_jobs
+from source.main.reference_data import (
+    build_reference, save_snapshot, load_snapshot, changed_entries, recipes_using
+)
+from source.main.model_loader import build_job_model, edit_days, extract_day_menus, clear_solution, solve_model
+from source.main.schema import ensure_schema
+from source.main.profiling import job_profile, JobProfile, NULL_PROFILE
+from source.main.replay import capture_job
+from source.main.verifier import MenuVerifier
+from source.main.sandbox import (
+    SANDBOX_SOLVES, SANDBOX_MAX_COMPONENTS, SANDBOX_WALL_MARGIN, SandboxLimit, SandboxCancelled,
+    run_limited, estimate_model_size, prune_reference, heuristic_menus
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
+
+class InvalidMenu(Exception):
+    """求解結果の献立がモデルの規則（品目構成・使用回数）を満たさない（解なし・打ち切りで解が得られなかった）"""
+
+
+class LeaseLost(Exception):
+    """ジョブのリースを失った（回収されて他のワーカーが取り直した・ユーザーが作り直した）．結果は捨てる"""
+
+# 別案 1 件あたりの制限時間・既出献立とのレシピ重なりの上限
+ALTERNATIVE_TIME_LIMIT = float(os.environ.get("ALTERNATIVE_TIME_LIMIT", 5))
+ALTERNATIVE_MAX_OVERLAP = float(os.environ.get("ALTERNATIVE_MAX_OVERLAP", 0.7))
+
+# 部分編集ジョブの制限時間（作り直す日だけの縮小モデルなので短くてよい）
+EDIT_TIME_LIMIT = float(os.environ.get("EDIT_TIME_LIMIT", 2))
+# 部分編集の縮小モデルがこの規模（estimate_model_size）以下なら，子プロセスを使わずにその場で解く
+EDIT_INLINE_MAX_COMPONENTS = int(os.environ.get("EDIT_INLINE_MAX_COMPONENTS", 1_000_000))
+# 栄養目標を満たせないとき，栄養制約を緩和して最も近い献立を返す
+ELASTIC_FALLBACK = os.environ.get("ELASTIC_FALLBACK", "1") == "1"
+# 最初の実行可能解を暫定献立として先に公開する（その後，残りの予算で解き直して差し替える）
+PROGRESSIVE_RESULTS = os.environ.get("PROGRESSIVE_RESULTS", "1") == "1"
+PROVISIONAL_TIME_LIMIT = float(os.environ.get("PROVISIONAL_TIME_LIMIT", 2))
+# 待機ジョブを見に行く間隔（秒）
+POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 5))
+
+# このワーカーが受け持つレーン（fast: 見込みの短いジョブだけ，slow: 長いジョブを先に，any: 区別しない）
+# fast と slow のワーカーを別々に起動すると，短いジョブが長い求解の後ろに並ばない
+WORKER_LANE = os.environ.get("WORKER_LANE", "any")
+# 処理順を決め直す間隔（秒）．長い求解の間に来た短いジョブを次に回す
+REPLAN_SECONDS = float(os.environ.get("SCHEDULER_REPLAN_SECONDS", 5))
+# 所要時間の見積もりモデルを実績から学習し直す間隔（秒）と，使う実績の件数
+COST_MODEL_REFRESH = float(os.environ.get("COST_MODEL_REFRESH", 300))
+COST_MODEL_SAMPLES = int(os.environ.get("COST_MODEL_SAMPLES", 500))
+
+# リース方式のジョブ取得：このワーカーの ID，リースの長さ，更新間隔，再試行の上限とバックオフ
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
+LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 60))
+HEARTBEAT_INTERVAL = LEASE_SECONDS / 3
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+RETRY_BACKOFF = float(os.environ.get("JOB_RETRY_BACKOFF", 10))        # 1 回目の再試行までの秒数（以後倍々）
+RETRY_BACKOFF_MAX = float(os.environ.get("JOB_RETRY_BACKOFF_MAX", 300))
+
+# 同じ問題の待機ジョブをまとめて 1 回だけ解く
+COALESCE_JOBS = os.environ.get("COALESCE_JOBS", "1") == "1"
+# まとめた結果を配るとき，ユーザーごとに日の並びを入れ替える
+COALESCE_SHUFFLE_DAYS = os.environ.get("COALESCE_SHUFFLE_DAYS", "1") == "1"
+
+# 負荷試験用：stub にすると CBC の代わりに決まった遅延で決まった献立を返す
+SOLVER_BACKEND = os.environ.get("SOLVER_BACKEND", "cbc")
+STUB_SOLVER_LATENCY = float(os.environ.get("STUB_SOLVER_LATENCY", 1.0))
+
+# 参照データのスナップショットファイル（空にすると毎回 DB から読む）
+REFERENCE_SNAPSHOT = os.environ.get(
+    "REFERENCE_SNAPSHOT", os.path.join(os.path.dirname(__file__), "../../reference.snapshot")
+)
+# スナップショットの鮮度判定に使う参照テーブル
+REFERENCE_TABLES = ['recipes', 'itemWeights', 'itemEquals', 'recipeItems', 'recipeNutritions', 'nutritionalTargets']
+# スナップショットを作り直すワーカーを 1 台に絞るアドバイザリロックのキー
+SNAPSHOT_LOCK_KEY = 73160040
+# 参照テーブルの変更を確かめる間隔（秒）．変わっていれば読み直し，影響する結果だけを無効にする
+REFERENCE_CHECK_INTERVAL = float(os.environ.get("REFERENCE_CHECK_INTERVAL", 60))
+# 待機ジョブがないとき，無効にされた献立ライブラリのプロファイルを解き直す
+LIBRARY_REFRESH = os.environ.get("LIBRARY_REFRESH", "1") == "1"
+# 空き時間の作業中に待機ジョブが来ていないかを確かめる間隔（秒）．来ていれば作業をやめてジョブに戻る
+IDLE_WATCH_INTERVAL = float(os.environ.get("IDLE_WATCH_INTERVAL", 1))
+
 def as_dict(obj):
     """SQLAlchemyオブジェクトを辞書に変換"""
     return {c.name: getattr(obj, c.name) for c in obj.__table__.columns}
 
-def load_reference_data():
+# 参照データを読むセッション：レプリカ（設定がなければプライマリ）．変更の検知（reference_source）はプライマリの統計で行う
+# 変更を検知した直後はレプリカがまだ古いことがあるので，追いつかなければプライマリで読む
+def reference_reader():
+    if wait_for_replica():
+        return read_session()
+    logging.warning("Replica is behind the primary, loading reference data from the primary")
+    return db.session
+
+def load_reference_data(source=None, reader=None):
     with app.app_context():
-        recipe_dict = {r.recipeId: as_dict(r) for r in db.session.query(Recipe).all()}
+        reader = reader or reference_reader()
+        # レシピはモデルが使う data（kind1・kind2）だけ読む
+        recipe_rows = {r.recipeId: {'data': r.data} for r in reader.query(Recipe.recipeId, Recipe.data).all()}
 
         itemweight_dict = {}
-        for iw in db.session.query(ItemWeight).all():
+        for iw in reader.query(ItemWeight).all():
             d = as_dict(iw)
             d['weights'] = d.get('weights') if isinstance(d.get('weights'), list) else [d['weights']] if d.get('weights') else []
             d['kind1'] = d.get('kind1', '')
             itemweight_dict[d['itemName']] = d
 
-        itemequal_dict = {ie.itemName: as_dict(ie) for ie in db.session.query(ItemEqual).all()}
+        itemequal_dict = {ie.itemName: as_dict(ie) for ie in reader.query(ItemEqual).all()}
 
         recipeitem_dict = {}
-        for ri in db.session.query(RecipeItem).all():
-            rec = as_dict(ri)
-            rid = rec['recipeId']
-            items_fixed = {k: (v if v is not None else 0) for k, v in rec.get('items', {}).items()}
-            recipeitem_dict[rid] = items_fixed
+        for ri in reader.query(RecipeItem.recipeId, RecipeItem.items).all():
+            items_fixed = {k: (v if v is not None else 0) for k, v in (ri.items or {}).items()}
+            recipeitem_dict[ri.recipeId] = items_fixed
 
         recipe_nutrition_dict = {
-            r.recipeId: r.nutritions for r in db.session.query(RecipeNutrition).all()
+            r.recipeId: r.nutritions for r in reader.query(RecipeNutrition.recipeId, RecipeNutrition.nutritions).all()
         }
 
-    return recipe_dict, itemweight_dict, itemequal_dict, recipeitem_dict, recipe_nutrition_dict
+    # 整数 ID・CSR・密行列の省メモリ表現にして持つ（読み込み用の辞書はここで捨てる）
+    return build_reference(recipe_rows, itemweight_dict, itemequal_dict, recipeitem_dict, recipe_nutrition_dict, source)
+
+# 参照データの状態（参照テーブルの行の追加・更新・削除の累計から求める．全件走査はしない）
+def reference_source():
+    return table_fingerprint(REFERENCE_TABLES)
+
+# スナップショットが DB と同じ状態から作られていれば返す
+def fresh_snapshot(source):
+    try:
+        reference = load_snapshot(REFERENCE_SNAPSHOT)
+    except (OSError, ValueError) as e:
+        logging.info(f"Reference snapshot unavailable: {e}")
+        return None
+    return reference if reference.source == source else None
+
+# 参照データと一緒に読み込んだ栄養目標（変更の検知で前後を比べる）
+LOADED_TARGETS = {}
+
+# 参照データを読み込む．スナップショットが新しければそれを使い，古ければ DB から読んで書き直す
+def load_reference():
+    with app.app_context():
+        reader = reference_reader()
+        # 栄養目標の表も読み込んでおく（ジョブごとの JSONB 検索を避ける）
+        LOADED_TARGETS.clear()
+        LOADED_TARGETS.update(load_nutritional_targets(reader))
+        if not REFERENCE_SNAPSHOT:
+            return load_reference_data(reference_source(), reader)
+
+        start = time.time()
+        source = reference_source()
+        reference = fresh_snapshot(source)
+        if reference is not None:
+            logging.info(f"Reference data loaded from snapshot in {time.time() - start:.3f}s")
+            return reference
+
+        # 一斉に起動したワーカーが全件読み込みに殺到しないよう，作り直しは 1 台ずつ
+        with db.engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': SNAPSHOT_LOCK_KEY})
+            try:
+                # 待っている間に他のワーカーが書き直していればそれを使う
+                reference = fresh_snapshot(source)
+                if reference is None:
+                    reference = load_reference_data(source, reader)
+                    try:
+                        save_snapshot(reference, REFERENCE_SNAPSHOT)
+                    except OSError as e:
+                        logging.warning(f"Failed to write reference snapshot: {e}")
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': SNAPSHOT_LOCK_KEY})
+
+        logging.info(f"Reference data loaded from DB in {time.time() - start:.3f}s")
+        return reference
+
+# 参照データの変更で古くなった結果を無効にする（変わったレシピ・食材に依存するものだけ）
+# 完了済みジョブは同じ問題の再利用・別案の再生成に使わなくし，ライブラリは該当プロファイルを消して空き時間に解き直す
+def invalidate_dependents(old, new):
+    recipe_ids, ingredients = changed_entries(old, new)
+    # itemWeights・itemEquals の変更は，その食材を使うレシピの変更として扱う
+    recipe_ids |= recipes_using(old, ingredients) | recipes_using(new, ingredients)
+    if not recipe_ids and not ingredients:
+        return 0, 0
+
+    rows = db.session.execute(text(
+        "SELECT DISTINCT kind, ref FROM menu_dependencies WHERE recipe_id = ANY(:recipes) OR ingredient = ANY(:ingredients)"),
+        {'recipes': sorted(recipe_ids), 'ingredients': sorted(ingredients)}
+    ).fetchall()
+    job_refs = [r.ref for r in rows if r.kind == 'job']
+    profile_keys = [r.ref for r in rows if r.kind == 'library']
+    pregenerated = [r.ref for r in rows if r.kind == 'pregen']
+
+    db.session.execute(text(
+        "UPDATE menu_jobs SET stale=TRUE, alternatives=NULL WHERE id = ANY(:ids)"),
+        {'ids': [int(ref) for ref in job_refs]}
+    )
+    db.session.execute(text("DELETE FROM menu_library WHERE profile_key = ANY(:keys)"), {'keys': profile_keys})
+    # 作り置きの献立は消す（次の閑散時間に作り直す）
+    db.session.execute(text("DELETE FROM menu_pregenerated WHERE userName = ANY(:users)"), {'users': pregenerated})
+    db.session.execute(text(
+        "DELETE FROM menu_dependencies WHERE (kind='job' AND ref = ANY(:jobs)) OR (kind='library' AND ref = ANY(:keys)) "
+        "OR (kind='pregen' AND ref = ANY(:users))"),
+        {'jobs': job_refs, 'keys': profile_keys, 'users': pregenerated}
+    )
+    db.session.commit()
+    logging.info(
+        f"Reference data changed ({len(recipe_ids)} recipes, {len(ingredients)} ingredients): "
+        f"invalidated {len(job_refs)} job results, {len(profile_keys)} library profiles "
+        f"and {len(pregenerated)} pregenerated menus"
+    )
+    return len(job_refs), len(profile_keys)
+
+# 栄養目標の変更で古くなった結果を無効にする
+# ライブラリは変わったプロファイルだけを消す．完了済みジョブ・作り置きは問題キーから栄養目標を引けないのでまとめて無効にする（変更はまれ）
+def invalidate_target_dependents(old_targets, new_targets):
+    changed = [key for key in set(old_targets) | set(new_targets) if old_targets.get(key) != new_targets.get(key)]
+    if not changed:
+        return 0
+    profile_keys = [
+        library_key((old_targets.get(key) or new_targets[key])['userInfo'], menstruation)
+        for key in changed for menstruation in ('なし', 'あり')
+    ]
+    db.session.execute(text("UPDATE menu_jobs SET stale=TRUE WHERE status='done' AND NOT stale"))
+    db.session.execute(text("DELETE FROM menu_library WHERE profile_key = ANY(:keys)"), {'keys': profile_keys})
+    db.session.execute(text("DELETE FROM menu_pregenerated"))
+    db.session.execute(text(
+        "DELETE FROM menu_dependencies WHERE (kind='library' AND ref = ANY(:keys)) OR kind='pregen'"),
+        {'keys': profile_keys}
+    )
+    db.session.commit()
+    logging.info(f"Nutritional targets changed for {len(changed)} profiles: invalidated cached results")
+    return len(changed)
+
+# 参照テーブルが変わっていれば読み直して依存する結果を無効にし，新しい参照データを返す
+def refresh_reference(reference):
+    if reference_source() == reference.source:
+        return reference
+    old_targets = dict(LOADED_TARGETS)
+    new_reference = load_reference()
+    invalidate_dependents(reference, new_reference)
+    invalidate_target_dependents(old_targets, LOADED_TARGETS)
+    return new_reference
+
+# 負荷判定用：待機中ジョブ数と直近の求解時間
+def queue_stats(limit=50):
+    backlog = db.session.execute(text(
+        "SELECT COUNT(*) FROM menu_jobs WHERE status='pending'"
+    )).scalar()
+    durations = db.session.execute(text(
+        "SELECT solve_seconds FROM menu_jobs WHERE solve_seconds IS NOT NULL ORDER BY updated_at DESC LIMIT :limit"),
+        {'limit': limit}
+    ).scalars().all()
+    return backlog, durations
+
+# 待機中のジョブを自分に割り当てる（他のワーカーが先に取っていれば False）
+def claim_job(job_id, waited=None):
+    claimed = db.session.execute(text(
+        "UPDATE menu_jobs SET status='running', worker_id=:worker, attempts=attempts+1, "
+        "lease_expires_at=NOW() + :lease * INTERVAL '1 second', queue_wait=COALESCE(:waited, queue_wait), "
+        "updated_at=NOW() WHERE id=:id AND status='pending'"),
+        {'id': job_id, 'worker': WORKER_ID, 'lease': LEASE_SECONDS, 'waited': waited}
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+# このワーカーが今も持っているジョブの条件．リースが回収されて他のワーカーが取り直したジョブや，
+# ユーザーが作り直して消えたジョブには書き込まない（claim_job 以後の書き込みはすべてこれで絞る）
+OWNED_JOB = "id=:id AND worker_id=:worker AND status='running'"
+
+# 自分が持っているジョブだけを更新し，更新できたかを返す（コミットは呼び出し側．save_menu の guard にも使う）
+def update_owned_job(job_id, assignments, params=None):
+    return db.session.execute(text(
+        f"UPDATE menu_jobs SET {assignments}, updated_at=NOW() WHERE {OWNED_JOB}"),
+        {**(params or {}), 'id': job_id, 'worker': WORKER_ID}
+    ).rowcount == 1
+
+# 自分が持っているジョブを失敗にする（持っていなければ何もしない）
+def fail_job(job_id):
+    update_owned_job(job_id, "status='failed', lease_expires_at=NULL")
+    db.session.commit()
+
+# ジョブ処理中にリースを延長し続けるスレッドを起動し，(止めるためのイベント, リースを失ったら立つイベント) を返す
+def start_heartbeat(job_id):
+    engine = db.engine
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                with engine.begin() as conn:
+                    renewed = conn.execute(text(
+                        "UPDATE menu_jobs SET lease_expires_at=NOW() + :lease * INTERVAL '1 second' "
+                        f"WHERE {OWNED_JOB}"),
+                        {'id': job_id, 'worker': WORKER_ID, 'lease': LEASE_SECONDS}
+                    ).rowcount
+            except Exception as e:
+                logging.warning(f"Heartbeat for job {job_id} failed: {e}")
+                continue
+            if renewed == 0:
+                logging.warning(f"Job {job_id}: lease lost, stopping")
+                lost.set()
+                return
+
+    threading.Thread(target=beat, name=f"heartbeat-{job_id}", daemon=True).start()
+    return stop, lost
+
+# 空き時間の作業中に待機ジョブを見張るスレッドを起動し，(止めるためのイベント, ジョブが来たら立つイベント) を返す
+# 見る条件は main_worker_loop がジョブを取る条件と同じ．リースが切れた running ジョブ（回収が必要）も来たとみなす
+def watch_pending():
+    engine = db.engine
+    stop = threading.Event()
+    arrived = threading.Event()
+
+    def watch():
+        while not stop.wait(IDLE_WATCH_INTERVAL):
+            try:
+                with engine.connect() as conn:
+                    pending = conn.execute(text(
+                        "SELECT EXISTS (SELECT 1 FROM menu_jobs WHERE (status='pending' "
+                        "AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())) "
+                        "OR (status='running' AND lease_expires_at < NOW()))"
+                    )).scalar()
+            except Exception as e:
+                logging.warning(f"Pending job watch failed: {e}")
+                continue
+            if pending:
+                arrived.set()
+                return
+
+    threading.Thread(target=watch, name="pending-watch", daemon=True).start()
+    return stop, arrived
+
+# リースが切れた running ジョブ（ワーカー停止など）を待機に戻す．再試行回数を超えたものは失敗にする
+def reap_stale_jobs():
+    stale = (
+        "status='running' AND (lease_expires_at < NOW() "
+        "OR (lease_expires_at IS NULL AND updated_at < NOW() - :lease * INTERVAL '1 second'))"
+    )
+    requeued = db.session.execute(text(
+        "UPDATE menu_jobs SET status='pending', worker_id=NULL, lease_expires_at=NULL, provisional=FALSE, "
+        "next_attempt_at=NOW() + LEAST(:backoff * POWER(2, GREATEST(attempts - 1, 0)), :backoff_max) * INTERVAL '1 second', "
+        f"updated_at=NOW() WHERE {stale} AND attempts < :max_attempts"),
+        {'lease': LEASE_SECONDS, 'backoff': RETRY_BACKOFF, 'backoff_max': RETRY_BACKOFF_MAX, 'max_attempts': MAX_ATTEMPTS}
+    ).rowcount
+    failed = db.session.execute(text(
+        f"UPDATE menu_jobs SET status='failed', lease_expires_at=NULL, updated_at=NOW() WHERE {stale} AND attempts >= :max_attempts"),
+        {'lease': LEASE_SECONDS, 'max_attempts': MAX_ATTEMPTS}
+    ).rowcount
+    db.session.commit()
+    if requeued or failed:
+        logging.warning(f"Reaped stale jobs: {requeued} re-queued, {failed} failed")
+
+# 同じ問題を解いた完了済みジョブの結果を探す
+def find_cached_result(key):
+    row = db.session.execute(text(
+        "SELECT result_json FROM menu_jobs WHERE problem_key=:key AND status='done' AND result_json IS NOT NULL "
+        "AND NOT stale ORDER BY updated_at DESC LIMIT 1"),
+        {'key': key}
+    ).first()
+    if row is None:
+        return None
+    result = row.result_json
+    return json.loads(result) if isinstance(result, str) else result
+
+# 待機ジョブのユーザーをまとめて引く：{userName: User}
+def fetch_job_users(jobs):
+    names = {job.userName for job in jobs}
+    if not names:
+        return {}
+    return {u.userName: u for u in db.session.query(User).filter(User.userName.in_(names)).all()}
+
+# 待機ジョブを問題キーごとにまとめる：[(代表ジョブ, [同じ問題の後続ジョブ, ...]), ...]
+def coalesce_jobs(jobs, users):
+    if not COALESCE_JOBS:
+        return [(job, []) for job in jobs]
+
+    groups = {}
+    order = []
+    for job in jobs:
+        user = users.get(job.userName)
+        if user is None or job.edit_json:
+            # ユーザー不在は代表ジョブ側の処理で失敗扱いにする／部分編集はユーザーごとに別問題
+            order.append((job, []))
+            continue
+        regist_item = json.loads(job.regist_item) if job.regist_item else {}
+        key = problem_key(user.userInfo, user.menstruation, regist_item)
+        if key in groups:
+            groups[key][1].append(job)
+        else:
+            groups[key] = (job, [])
+            order.append(groups[key])
+    return order
+
+# 見積もりモデルの特徴（登録食材を含むレシピ数は参照データから数える）
+def job_features(reference, regist_item, edit, memo=None):
+    names = frozenset(regist_item or {})
+    if memo is not None and names in memo:
+        regist_recipes = memo[names]
+    else:
+        regist_recipes = len(recipes_using(reference, names))
+        if memo is not None:
+            memo[names] = regist_recipes
+    return CostModel.features(len(names), regist_recipes, edit)
+
+# 直近の求解実績から所要時間の見積もりモデルを作る（memo は登録食材 → レシピ数で，計画と共有する）
+def train_cost_model(reference, limit=COST_MODEL_SAMPLES, memo=None):
+    rows = db.session.execute(text(
+        "SELECT regist_item, edit_json IS NOT NULL AS edit, solve_seconds FROM menu_jobs "
+        "WHERE solve_seconds IS NOT NULL AND status='done' ORDER BY updated_at DESC LIMIT :limit"),
+        {'limit': limit}
+    ).fetchall()
+    memo = {} if memo is None else memo
+    samples = [
+        (job_features(reference, json.loads(r.regist_item) if r.regist_item else {}, r.edit, memo), float(r.solve_seconds))
+        for r in rows
+    ]
+    model = CostModel.train(samples)
+    logging.info(f"Cost model trained on {model.samples} jobs: {model.coef}")
+    return model
+
+# 待機ジョブ（代表ジョブ単位）の所要時間を見積もり，このワーカーのレーンで処理する順に並べる
+# ライブラリにある問題・SLO 超過でキャッシュを使う問題は DB を引くだけなので短いと見る
+# memo を渡すと登録食材を含むレシピ数を計画をまたいで使い回す（参照データが変わったら捨てること）
+def plan_jobs(jobs, reference, cost_model, memo=None):
+    # ユーザーは計画 1 回につき 1 度だけ引き，まとめと見積もりで共有する
+    users = fetch_job_users(jobs)
+    groups = coalesce_jobs(jobs, users)
+
+    entries = []
+    for job, followers in groups:
+        user = users.get(job.userName)
+        regist_item = json.loads(job.regist_item) if job.regist_item else {}
+        entry = {'job': job, 'followers': followers, 'user': job.userName, 'waited': float(job.waited),
+                 'library_key': None, 'problem_key': None}
+        if user is not None and not job.edit_json:
+            if not regist_item:
+                entry['library_key'] = library_key(user.userInfo, user.menstruation)
+            if entry['waited'] > QUEUE_WAIT_SLO:
+                entry['problem_key'] = problem_key(user.userInfo, user.menstruation, regist_item)
+        entry['cost'] = CHEAP_JOB_SECONDS if user is None else cost_model.predict(
+            job_features(reference, regist_item, bool(job.edit_json), memo)
+        )
+        entries.append(entry)
+
+    library_keys = [e['library_key'] for e in entries if e['library_key']]
+    cache_keys = [e['problem_key'] for e in entries if e['problem_key']]
+    stored = set(db.session.execute(text(
+        "SELECT DISTINCT profile_key FROM menu_library WHERE profile_key = ANY(:keys)"),
+        {'keys': library_keys}
+    ).scalars().all()) if library_keys else set()
+    cached = set(db.session.execute(text(
+        "SELECT DISTINCT problem_key FROM menu_jobs WHERE problem_key = ANY(:keys) AND status='done' "
+        "AND result_json IS NOT NULL AND NOT stale"),
+        {'keys': cache_keys}
+    ).scalars().all()) if cache_keys else set()
+    db.session.commit()
+    for entry in entries:
+        if entry['library_key'] in stored or entry['problem_key'] in cached:
+            entry['cost'] = CHEAP_JOB_SECONDS
+    return order_jobs(entries, WORKER_LANE)
+
+# 日の並びを入れ替えた献立（1日単位・1週間合計の制約はどちらも並び順に依存しない）
+def diversify_menus(day_menus, seed):
+    names = [f"menu{d}" for d in range(1, 8)]
+    shuffled = names[:]
+    random.Random(seed).shuffle(shuffled)
+    return {name: day_menus.get(src_name, {}) for name, src_name in zip(names, shuffled)}
+
+# 代表ジョブの結果を同じ問題の後続ジョブに配る
+def fan_out(leader_id, key, followers, day_menus):
+    for job in followers:
+        try:
+            menus = diversify_menus(day_menus, job.id) if COALESCE_SHUFFLE_DAYS else day_menus
+            # 待機中にユーザーが作り直した（ジョブが消えた）場合は配らない
+            if not claim_job(job.id):
+                continue
+            # 完了の更新と献立の保存は同じトランザクションで（その間にジョブを失っていれば保存しない）
+            saved = save_menu(job.userName, menus, guard=lambda: update_owned_job(
+                job.id, "status='done', result_json=:result, problem_key=:key, strategy='coalesced'",
+                {'result': json.dumps(menus, ensure_ascii=False), 'key': key}
+            ))
+            if saved is None:
+                logging.warning(f"Fan-out to job {job.id} skipped: job no longer owned")
+                continue
+            logging.info(f"Job {job.id} ({job.userName}) served from job {leader_id}")
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Fan-out to job {job.id} failed: {e}")
+            fail_job(job.id)
+
+# 求めた献立に多様性カットを重ねて解き直し，別案を含む献立のリストを返す
+def solution_pool(model, scope, day_menus, count, time_limit, ratio_gap, max_overlap=ALTERNATIVE_MAX_OVERLAP):
+    add_diversity_cut = scope.get('add_diversity_cut')
+    solver = SolverFactory('cbc', executable=CBC_PATH)
+    solver.options['sec'] = time_limit
+    solver.options['ratioGap'] = ratio_gap
+
+    pool = [day_menus]
+    for _ in range(count):
+        add_diversity_cut(model, pool[-1], max_overlap)
+        clear_solution(model)
+        try:
+            _, found = solve_model(solver, model)
+        except Exception as e:
+            logging.warning(f"Solution pool stopped: {e}")
+            break
+        menus = extract_day_menus(model)
+        if not found or not all(menus.values()):
+            break
+        pool.append(menus)
+    return pool
+
+# 別案をジョブに保存する（まとめて配った後続ジョブには日の並びを入れ替えて保存）
+def store_alternatives(job_id, followers, pool):
+    db.session.execute(text(
+        "UPDATE menu_jobs SET alternatives=:alts, alt_index=0 WHERE id=:id AND worker_id=:worker AND status='done'"),
+        {'alts': json.dumps(pool, ensure_ascii=False), 'id': job_id, 'worker': WORKER_ID}
+    )
+    for follower in followers:
+        alts = [diversify_menus(menus, follower.id) for menus in pool] if COALESCE_SHUFFLE_DAYS else pool
+        db.session.execute(text(
+            "UPDATE menu_jobs SET alternatives=:alts, alt_index=0 WHERE id=:id AND worker_id=:worker AND status='done'"),
+            {'alts': json.dumps(alts, ensure_ascii=False), 'id': follower.id, 'worker': WORKER_ID}
+        )
+    db.session.commit()
+
+# 暫定献立をユーザーに見せる（ジョブは running のまま provisional を立てる．ジョブを失っていれば保存しない）
+def publish_provisional(job, day_menus):
+    saved = save_menu(job.userName, day_menus, guard=lambda: update_owned_job(
+        job.id, "result_json=:result, provisional=TRUE", {'result': json.dumps(day_menus, ensure_ascii=False)}
+    ))
+    if saved is None:
+        logging.warning(f"Job {job.id} ({job.userName}): provisional menu discarded, job no longer owned")
+        return
+    logging.info(f"Job {job.id} ({job.userName}) published provisional menu")
+
+# モデルを構築して解き，日ごとの献立を返す（edit があれば作り直す日だけの縮小モデルで解き直す）
+# on_incumbent を渡すと，短い制限時間で見つけた実行可能解を先に渡してから本番の求解を続ける
+# sandboxed（上限付きの子プロセス内）ではソルバーの失敗を握りつぶさずに投げ，上限によるものかを sandbox に判定させる
+def solve_menu(reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit=None, on_incumbent=None,
+               profile=NULL_PROFILE, sandboxed=False):
+    with profile.phase('build'), profile.construction():
+        model, scope = build_job_model(reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, edit)
+
+    excluded = []
+    if edit:
+        excluded = scope.get('apply_menu_locks')(
+            model, edit['menus'], edit.get('lock_days', []), edit.get('lock_recipes', []),
+            edit.get('exclude_current', True)
+        )
+
+    # Solver 実行（制限時間・ギャップはアドミッション制御で決めた予算）
+    solver = SolverFactory('cbc', executable=CBC_PATH)
+    solver.options['sec'] = budget['time_limit']
+    solver.options['ratioGap'] = budget['ratio_gap']
+    solver_start = time.time()
+    found = False
+    with profile.phase('solve'):
+        try:
+            warmstart = bool(edit)
+            if on_incumbent is not None and budget['time_limit'] > 2 * PROVISIONAL_TIME_LIMIT:
+                # 1段目：短時間で最初の実行可能解を取り，暫定献立として公開
+                solver.options['sec'] = PROVISIONAL_TIME_LIMIT
+                _, found = solve_model(solver, model)
+                if found:
+                    on_incumbent(extract_day_menus(model))
+                    warmstart = True
+                # 2段目：残りの予算で，暫定解を初期解にして解き直す
+                solver.options['sec'] = max(1, budget['time_limit'] - (time.time() - solver_start))
+
+            # 解が得られなかったときは値を消すので，初期解（部分編集の今の献立）が解として残らない
+            result, found = solve_model(solver, model, warmstart=warmstart)
+            logging.info(f"Solver finished: {result.solver.termination_condition}")
+            if excluded and not found:
+                # 今のレシピを外すと解なし → 外さずに解き直す
+                logging.info("Edit infeasible without current recipes, retrying with them allowed")
+                for var in excluded:
+                    var.unfix()
+                result, found = solve_model(solver, model)
+        except Exception as e:
+            if sandboxed:
+                raise
+            logging.error(f"Solver failed: {e}")
+
+        # 解なし：栄養制約に違反量のペナルティを付けて 1 回だけ解き直し，違反内容を返す
+        violations = None
+        if ELASTIC_FALLBACK and not found:
+            logging.info("Model infeasible, re-solving with elastic nutrition constraints")
+            scope.get('make_elastic')(model)
+            clear_solution(model)
+            try:
+                _, found = solve_model(solver, model)
+                if found:
+                    violations = scope.get('nutrition_violations')(model)
+            except Exception as e:
+                if sandboxed:
+                    raise
+                logging.error(f"Elastic solve failed: {e}")
+    solver_end = time.time()
+    solver_duration = solver_end - solver_start
+
+    return extract_day_menus(model), solver_duration, model, scope, violations
+
+# スタブソルバー：問題ごとに決まった献立（各日 主食・主菜・副菜・汁物 1 品ずつ）を返す
+def stub_solve_menu(reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit=None, on_incumbent=None,
+                    profile=NULL_PROFILE):
+    solver_start = time.time()
+    user_info = next(iter(nutritionaltarget_dict.values()))['userInfo']
+    rnd = random.Random(problem_key(user_info, menstruation, regist_item))
+    by_kind = {}
+    for record in reference.records:
+        by_kind.setdefault(record.kind1, []).append(record.recipeId)
+    day_menus = {
+        f"menu{d}": {kind: rnd.choice(by_kind[kind]) for kind in ('staple', 'main', 'side', 'soup') if by_kind.get(kind)}
+        for d in range(1, 8)
+    }
+    time.sleep(STUB_SOLVER_LATENCY)
+    return day_menus, time.time() - solver_start, None, None, None
+
+# 子プロセス側：求解・記録・別案までを済ませ，献立だけを返す（DB には触れない．暫定献立は send で親に渡す）
+# 解が得られなかった（打ち切りで暫定解もない）ときは上限として親に返し，安い方法に落とさせる
+# profiled なら子でプロファイルを取り，その要約（.prof は子が書く）も返して親のプロファイルに取り込ませる
+def solve_in_child(send, job_id, reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit,
+                   progressive, profiled=False):
+    profile = JobProfile(f"{job_id}-sandbox") if profiled else NULL_PROFILE
+    day_menus, solver_duration, model, scope, violations = solve_menu(
+        reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit,
+        send if progressive else None, profile, sandboxed=True
+    )
+    capture_job(
+        job_id, reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc,
+        budget, edit, solver_duration, model, day_menus, violations
+    )
+    if not all(day_menus.values()):
+        raise SandboxLimit('no solution')
+    pool = None
+    with profile.phase('alternatives'):
+        if budget['alternatives'] > 0:
+            pool = solution_pool(
+                model, scope, day_menus, budget['alternatives'],
+                min(ALTERNATIVE_TIME_LIMIT, budget['time_limit']), budget['ratio_gap']
+            )
+    return day_menus, solver_duration, violations, pool, profile.report()
+
+# 求解を上限付きの子プロセスで行い，上限に達したら安い方法に落としていく
+# （レシピを絞ったモデル → 同じ問題の解 → ソルバーを使わない貪欲法）．budget['strategy'] に使った方法を残す
+# 部分編集は固定した日・レシピを守れない貪欲法には落とさず，ジョブを失敗にする（保存済みの献立はそのまま残る）
+# 上限以外の失敗（SandboxError）は落とさずにそのまま投げ，ジョブを失敗にする
+# cancel（リースを失ったら立つイベント）が立てば子を止めて SandboxCancelled を投げる
+# 子で測ったプロファイル（構築・求解・別案）は profile に取り込む
+def sandboxed_solve(job, reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit, key,
+                    on_incumbent=None, cancel=None, profile=NULL_PROFILE):
+    # 子プロセスの実時間の上限：暫定解と本番・緩和の求解，別案の分に猶予を足す
+    wall_timeout = (
+        2 * budget['time_limit'] + budget['alternatives'] * min(ALTERNATIVE_TIME_LIMIT, budget['time_limit'])
+        + SANDBOX_WALL_MARGIN
+    )
+
+    def pruned():
+        return prune_reference(reference, regist_item, key or job.id, edit)
+
+    # 構築前の規模チェック：大きすぎるモデルは最初から絞って解く
+    days = len(edit_days(edit)) if edit else 7
+    attempts = [('pruned', pruned())] if estimate_model_size(reference, days) > SANDBOX_MAX_COMPONENTS else [
+        (budget['strategy'], reference), ('pruned', None)
+    ]
+    for strategy, attempt_reference in attempts:
+        attempt_reference = attempt_reference or pruned()
+        try:
+            start = time.time()
+            day_menus, solver_duration, violations, pool, child_profile = run_limited(
+                solve_in_child,
+                (job.id, attempt_reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit,
+                 on_incumbent is not None, profile is not NULL_PROFILE),
+                on_message=on_incumbent, wall_timeout=wall_timeout, cancel=cancel
+            )
+            profile.absorb(child_profile)
+            budget['strategy'] = strategy
+            return day_menus, solver_duration, violations, pool
+        except SandboxLimit as e:
+            logging.warning(
+                f"Job {job.id}: solve hit {e.reason} after {time.time() - start:.1f}s "
+                f"({len(attempt_reference.recipe_ids)} recipes, strategy {strategy})"
+            )
+
+    if edit:
+        raise SandboxLimit(f"edit job {job.id} hit resource limits")
+    verifier = MenuVerifier(reference, nutritionaltarget_dict, menstruation, use_pfc)
+    cached = find_cached_result(key) if key else None
+    if cached is not None:
+        report = verifier.verify_one(cached)
+        if not report['errors']:
+            budget['strategy'] = 'cached'
+            return cached, None, report['violations'] or None, None
+    budget['strategy'] = 'heuristic'
+    day_menus = heuristic_menus(reference, nutritionaltarget_dict, menstruation, use_pfc, regist_item)
+    return day_menus, None, verifier.verify_one(day_menus)['violations'] or None, None
 
 def main_worker_loop():
+    ensure_schema()
     with app.app_context():
-        # 参照データロード
-        RECIPE_DICT, ITEMWEIGHT_DICT, ITEMEQUAL_DICT, RECIPEITEM_DICT, RECIPE_NUTRITION_DICT = load_reference_data()
+        # 参照データロード（スナップショットが新しければ DB は読まない）
+        reference = load_reference()
+        reference_checked = time.time()
+        cost_model = None
+        cost_model_trained = 0
+        # 登録食材 → それを含むレシピ数（参照データを読み直すか見積もりモデルを学習し直すたびに空にする）
+        feature_memo = {}
         
         while True:
+            planned = []
             try:
+                # 停止したワーカーのジョブを回収
+                reap_stale_jobs()
+
+                # 参照データの変更を確かめる（変わったレシピ・食材に依存する結果だけを無効にする）
+                if time.time() - reference_checked >= REFERENCE_CHECK_INTERVAL:
+                    refreshed = refresh_reference(reference)
+                    if refreshed is not reference:
+                        feature_memo = {}
+                        reference = refreshed
+                    reference_checked = time.time()
+
+                # 所要時間の見積もりモデルを直近の実績で学習し直す
+                if cost_model is None or time.time() - cost_model_trained >= COST_MODEL_REFRESH:
+                    feature_memo = {}
+                    cost_model = train_cost_model(reference, memo=feature_memo)
+                    cost_model_trained = time.time()
+
                 jobs = db.session.execute(text(
-                    "SELECT * FROM menu_jobs WHERE status='pending' ORDER BY created_at"
+                    "SELECT *, EXTRACT(EPOCH FROM (NOW() - created_at)) AS waited "
+                    "FROM menu_jobs WHERE status='pending' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW()) "
+                    "ORDER BY created_at"
                 )).fetchall()
 
-                for job in jobs:
+                # 見込み時間の短い順（待った分だけ前に出す・ユーザーごとに交互）に，このワーカーのレーンの分だけ処理する
+                planned = plan_jobs(jobs, reference, cost_model, feature_memo)
+                planned_at = time.time()
+                for entry in planned:
+                    # 計画が古くなったら，その間に来たジョブも含めて並べ直す
+                    if time.time() - planned_at > REPLAN_SECONDS:
+                        break
+                    job, followers = entry['job'], entry['followers']
                     solver_duration = None
                     db_duration = None
                     day_menus = {}
+                    budget = None
+                    user = None
+                    regist_item = None
+                    heartbeat = None
                     try:
-                        # ジョブを running に更新
-                        db.session.execute(text(
-                            "UPDATE menu_jobs SET status='running', updated_at=NOW() WHERE id=:id"),
-                            {'id': job.id}
-                        )
-                        db.session.commit()
+                        # 滞留状況から求解予算を決める
+                        waited = float(job.waited)
+                        backlog, recent_durations = queue_stats()
+                        budget = plan_budget(backlog, waited, recent_durations)
+
+                        # ジョブを自分に割り当てて running に（他のワーカーが取っていれば飛ばす）
+                        if not claim_job(job.id, waited):
+                            continue
+                        heartbeat, lease_lost = start_heartbeat(job.id)
+                        # PROFILE_JOBS=1 かジョブの profile_requested で有効（無効時は何もしない）
+                        profile = job_profile(job.id, getattr(job, 'profile_requested', False))
 
                         # ユーザー取得
                         user = db.session.query(User).filter_by(userName=job.userName).first()
                         if not user:
                             logging.error(f"User {job.userName} not found")
-                            db.session.execute(text(
-                                "UPDATE menu_jobs SET status='failed', updated_at=NOW() WHERE id=:id"),
-                                {'id': job.id}
-                            )
-                            db.session.commit()
+                            fail_job(job.id)
                             continue
 
                         user_info = user.userInfo
                         regist_item = json.loads(job.regist_item) if job.regist_item else {}
 
                         # NutritionalTarget 取得
-                        age = user_info.get('年齢')
-                        gender = user_info.get('性別')
-                        activity = user_info.get('運動レベル')
-                        activity_query = 'ふつう' if age and '75' in age and activity == '高い' else activity
-
-                        nt = db.session.query(NutritionalTarget).filter(
-                            NutritionalTarget.userInfo['年齢'].astext == str(age),
-                            NutritionalTarget.userInfo['性別'].astext == str(gender),
-                            NutritionalTarget.userInfo['運動レベル'].astext == str(activity_query)
-                        ).first()
+                        nt = find_nutritional_target(user_info)
 
                         if nt is None:
                             logging.error(f"NutritionalTarget not found for user {job.userName}")
-                            db.session.execute(text(
-                                "UPDATE menu_jobs SET status='failed', updated_at=NOW() WHERE id=:id"),
-                                {'id': job.id}
-                            )
-                            db.session.commit()
+                            fail_job(job.id)
                             continue
 
-                        # PFC判定
-                        no_pfc_users = [
-                            ("18~29(歳)", "男性", "高い"),
-                            ("30~49(歳)", "男性", "高い"),
-                            ("50~64(歳)", "男性", "高い"),
-                        ]
-                        # age, gender, activity はユーザー情報から取得済み
-                        if (age, gender, activity) in no_pfc_users:
-                            # PFC無視ユーザー向け
-                            nutrition_match = {
-                                "食塩_上限":"食塩(g)",
-                                "食物繊維_下限":"食物繊維(g)",
-                                "カルシウム_上限":"カルシウム(mg)",
-                                "カルシウム_下限":"カルシウム(mg)",
-                                "ビタミンA_上限":"ビタミンA(μg)",
-                                "ビタミンA_下限":"ビタミンA(μg)",
-                                "ビタミンD_上限": "ビタミンD(μg)",
-                                "ビタミンD_下限": "ビタミンD(μg)",
-                                "ビタミンC_下限": "ビタミンC(mg)",
-                                "ビタミンB1_下限":"ビタミンB₁(mg)",
-                                "ビタミンB2_下限":"ビタミンB₂(mg)",
-                                "鉄・月経時_下限":"鉄(mg)",
-                                "鉄_下限":"鉄(mg)"
-                            }
-                        else:
-                            # 通常ユーザー向け（PFC制約あり）
-                            nutrition_match = {
-                                "カロリー":"カロリー(kcal)",
-                                "たんぱく質_上限":"たんぱく質(g)",
-                                "たんぱく質_下限":"たんぱく質(g)",
-                                "脂質_上限":"脂質(g)",
-                                "脂質_下限":"脂質(g)",
-                                "炭水化物_上限":"炭水化物(g)",
-                                "炭水化物_下限":"炭水化物(g)",
-                                "食物繊維_下限":"食物繊維(g)",
-                                "カルシウム_上限":"カルシウム(mg)",
-                                "カルシウム_下限":"カルシウム(mg)",
-                                "ビタミンA_上限":"ビタミンA(μg)",
-                                "ビタミンA_下限":"ビタミンA(μg)",
-                                "ビタミンD_上限": "ビタミンD(μg)",
-                                "ビタミンD_下限": "ビタミンD(μg)",
-                                "ビタミンC_下限": "ビタミンC(mg)",
-                                "ビタミンB1_下限":"ビタミンB₁(mg)",
-                                "ビタミンB2_下限":"ビタミンB₂(mg)",
-                                "鉄・月経時_下限":"鉄(mg)",
-                                "鉄_下限":"鉄(mg)"
-                            }
-
-                        filtered_nutritional = {
-                            nutrition_match[k]: v
-                            for k, v in nt.nutritionals.items()
-                            if k in nutrition_match and nutrition_match[k] is not None
-                        }
-
                         # wrap
                         nutritionaltarget_dict = wrap_nutritional_target(nt)
                         for nt_id, nt_val in nutritionaltarget_dict.items():
@@ -165,88 +804,118 @@ def main_worker_loop():
                                         nt_val['nutritionals'][nut] = 0
 
                         menstruation = user.menstruation
-                        days = list(range(1, 8))
-                        recipe_ids = list(RECIPE_DICT.keys())
-
-                        # Pyomo モデル読み込み
-                        base_dir = os.path.dirname(__file__)
-                        api_file_path = os.path.join(base_dir, "api_pyomo_model.py")
-                        with open(api_file_path, encoding='utf-8') as f:
-                            pyomo_code_str = f.read()
-                        pyomo_code_str = sanitize_pyomo_code(pyomo_code_str)
                         use_pfc = should_use_pfc(user_info)
+                        key = problem_key(user_info, menstruation, regist_item)
 
-                        scope = {
-                            'days': days,
-                            'recipe_dict': RECIPE_DICT,
-                            'recipe_ids': recipe_ids,
-                            'recipeitem_dict': RECIPEITEM_DICT,
-                            'filtered_recipe_nutritions': RECIPE_NUTRITION_DICT,
-                            'nutritionaltarget_dict': nutritionaltarget_dict,
-                            'itemweight_dict': ITEMWEIGHT_DICT,
-                            'itemequal_dict': ITEMEQUAL_DICT,
-                            'menstruation': menstruation,
-                            'regist_item': regist_item,
-                            'use_pfc': use_pfc
-                        }
-
-                        exec(pyomo_code_str, scope, scope)
-                        build_model = scope.get('build_model')
-                        model = build_model(
-                            days, RECIPE_DICT, recipe_ids, RECIPEITEM_DICT, RECIPE_NUTRITION_DICT,
-                            nutritionaltarget_dict, ITEMWEIGHT_DICT, ITEMEQUAL_DICT,
-                            menstruation, regist_item, use_pfc
-                        )
+                        # 部分編集ジョブ：固定部分以外だけを短い制限時間で解き直す
+                        edit = None
+                        if job.edit_json:
+                            edit = json.loads(job.edit_json) if isinstance(job.edit_json, str) else job.edit_json
+                            key = None
+                            budget = {
+                                'strategy': 'edit', 'time_limit': EDIT_TIME_LIMIT,
+                                'ratio_gap': budget['ratio_gap'], 'alternatives': 0,
+                            }
 
-                        # Solver 実行
-                        solver = SolverFactory('cbc', executable=CBC_PATH)
-                        solver.options['sec'] = 20
-                        solver.options['ratioGap'] = 0.02
-                        solver_start = time.time()
-                        try:
-                            result = solver.solve(model, tee=False)
-                            logging.info("Solver finished successfully")
-                        except Exception as e:
-                            log_infeasible_constraints(model)
-                            logging.error(f"Solver failed: {e}")
-                        solver_end = time.time()
-                        solver_duration = solver_end - solver_start
-
-                        # メニュー保存
-                        day_menus = {}
-                        for d in model.Days:
-                            menu_name = f"menu{d}"
-                            day_menus[menu_name] = {}
-                            for r in model.Recipes:
-                                var = model.x[d, r]
-                                if var.value is not None and var.value > 0.5:
-                                    kind1 = model.kind1_map[r]
-                                    day_menus[menu_name][kind1] = r
-
-                        # DB保存
-                        # JST (UTC+9) に変換
-                        now_jst = datetime.now(timezone.utc) + timedelta(hours=9)
-                        db_start = time.time()
-                        menu_obj = Menu(
-                            userName=job.userName,
-                            menu1=day_menus.get('menu1', {}),
-                            menu2=day_menus.get('menu2', {}),
-                            menu3=day_menus.get('menu3', {}),
-                            menu4=day_menus.get('menu4', {}),
-                            menu5=day_menus.get('menu5', {}),
-                            menu6=day_menus.get('menu6', {}),
-                            menu7=day_menus.get('menu7', {}),
-                            createdAt=now_jst.replace(tzinfo=None)
+                        # 登録食材なし：事前計算した献立ライブラリがあればそれを使う
+                        cached_menus = None
+                        pool = None
+                        model = None
+                        violations = None
+                        # ソルバーを通さない献立はモデルと同じ規則で検証し，形の崩れたものは使わない
+                        verifier = MenuVerifier(reference, nutritionaltarget_dict, menstruation, use_pfc)
+                        if not regist_item and edit is None:
+                            pool = verifier.well_formed(find_library_menus(user_info, menstruation)) or None
+                            if pool is not None:
+                                cached_menus = pool[0]
+                                budget['strategy'] = 'library'
+
+                        # SLO 超過ジョブ：同じ問題の解があれば再利用，なければ短時間ソルブ
+                        if cached_menus is None and budget['strategy'] == 'fast':
+                            cached_menus = find_cached_result(key)
+                            if cached_menus is not None and verifier.verify_one(cached_menus)['errors']:
+                                cached_menus = None
+                            budget['strategy'] = 'cached' if cached_menus is not None else 'quick'
+
+                        # 使った予算をジョブに記録
+                        recorded = update_owned_job(
+                            job.id, "problem_key=:key, strategy=:strategy, time_limit=:time_limit, "
+                            "ratio_gap=:ratio_gap, predicted_seconds=:predicted, lane=:lane",
+                            {
+                                'key': key, 'strategy': budget['strategy'],
+                                'time_limit': budget['time_limit'], 'ratio_gap': budget['ratio_gap'],
+                                'predicted': entry['cost'], 'lane': entry['lane'],
+                            }
                         )
-                        db.session.add(menu_obj)
                         db.session.commit()
-                        db_end = time.time()
-                        db_duration = db_end - db_start
+                        if not recorded:
+                            raise LeaseLost(f"job {job.id} no longer owned")
+
+                        if cached_menus is not None:
+                            day_menus = cached_menus
+                            violations = verifier.verify_one(day_menus)['violations'] or None
+                        else:
+                            on_incumbent = None
+                            if PROGRESSIVE_RESULTS and edit is None:
+                                on_incumbent = lambda menus: publish_provisional(job, menus)
+                            # 部分編集の縮小モデルは小さいので，子プロセスを起こさずにその場で解く
+                            inline_edit = edit is not None and (
+                                estimate_model_size(reference, len(edit_days(edit))) <= EDIT_INLINE_MAX_COMPONENTS
+                            )
+                            if SANDBOX_SOLVES and SOLVER_BACKEND != 'stub' and not inline_edit:
+                                # 上限付きの子プロセスで解く（記録・別案も子で済ませる）．上限に達したら安い方法に落とす
+                                # 構築・求解・別案のフェーズは子で測って取り込み，親では子を待った時間を sandbox として測る
+                                with profile.phase('sandbox'):
+                                    day_menus, solver_duration, violations, pool = sandboxed_solve(
+                                        job, reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc,
+                                        budget, edit, key, on_incumbent, lease_lost, profile
+                                    )
+                            else:
+                                solve = stub_solve_menu if SOLVER_BACKEND == 'stub' else solve_menu
+                                day_menus, solver_duration, model, scope, violations = solve(
+                                    reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget,
+                                    edit, on_incumbent, profile
+                                )
+                                # 再実行用にジョブの入力と結果を記録（CAPTURE_JOBS=1 のときだけ）
+                                if model is not None:
+                                    capture_job(
+                                        job.id, reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc,
+                                        budget, edit, solver_duration, model, day_menus, violations
+                                    )
+
+                        # 求解中にリースを失っていれば，他のワーカーが取り直しているので結果は捨てる
+                        if lease_lost.is_set():
+                            raise LeaseLost(f"job {job.id} lease lost during solve")
+
+                        # 保存する前にモデルと同じ規則で確かめる（解が得られず崩れた献立は done にしない）
+                        if SOLVER_BACKEND != 'stub':
+                            errors = verifier.verify_one(day_menus)['errors']
+                            if errors:
+                                raise InvalidMenu(f"infeasible: no valid menu ({', '.join(errors)})")
+
+                        # DB保存：ジョブの完了と献立の保存は同じトランザクションで（ジョブを失っていれば保存しない）
+                        with profile.phase('save'):
+                            db_duration = save_menu(job.userName, day_menus, guard=lambda: update_owned_job(
+                                job.id, "status='done', result_json=:result, solve_seconds=:solve_seconds, "
+                                "provisional=FALSE, violations=:violations, strategy=:strategy",
+                                {
+                                    'result': json.dumps(day_menus, ensure_ascii=False),
+                                    'strategy': budget['strategy'],
+                                    'solve_seconds': solver_duration,
+                                    'violations': json.dumps(violations, ensure_ascii=False) if violations is not None else None,
+                                }
+                            ))
+                        if db_duration is None:
+                            raise LeaseLost(f"job {job.id} no longer owned at save")
 
                         # 成功ログ
                         logging.info(json.dumps({
                             "user": job.userName,
                             "status": "成功",
+                            "strategy": budget['strategy'],
+                            "time_limit": budget['time_limit'],
+                            "coalesced_jobs": len(followers),
+                            "violations": violations,
                             "solver_duration": solver_duration,
                             "db_duration": db_duration,
                             "day_menus": day_menus,
@@ -256,17 +925,42 @@ def main_worker_loop():
                             "timestamp": datetime.now().isoformat()
                         }, ensure_ascii=False))
 
-                        # ジョブ完了
-                        db.session.execute(text(
-                            "UPDATE menu_jobs SET status='done', result_json=:result, updated_at=NOW() WHERE id=:id"),
-                            {'result': json.dumps(day_menus, ensure_ascii=False), 'id': job.id}
+                        # 同じ問題の後続ジョブへ配る
+                        fan_out(job.id, key, followers, day_menus)
+
+                        # 余裕があれば別案も求めておく（再生成ボタン用）
+                        with profile.phase('alternatives'):
+                            if pool is None and model is not None and budget['alternatives'] > 0 and all(day_menus.values()):
+                                pool = solution_pool(
+                                    model, scope, day_menus, budget['alternatives'],
+                                    min(ALTERNATIVE_TIME_LIMIT, budget['time_limit']), budget['ratio_gap']
+                                )
+                            if pool is not None and len(pool) > 1:
+                                store_alternatives(job.id, followers, pool)
+
+                        # 使ったレシピ・登録食材を記録（参照データが変わったときの無効化用）
+                        record_dependencies(
+                            'job', [job.id] + [f.id for f in followers], pool or [day_menus], regist_item
                         )
-                        db.session.commit()
+
+                        # プロファイルの要約をジョブに残す（.prof ファイルは PROFILE_DIR）
+                        report = profile.report()
+                        if report is not None:
+                            db.session.execute(text(
+                                "UPDATE menu_jobs SET profile=:profile WHERE id=:id AND worker_id=:worker"),
+                                {'profile': json.dumps(report, ensure_ascii=False), 'id': job.id, 'worker': WORKER_ID}
+                            )
+                            db.session.commit()
+                    except (LeaseLost, SandboxCancelled) as e:
+                        # 回収されたジョブは他のワーカーが処理する．何も書かずに結果を捨てる
+                        db.session.rollback()
+                        logging.warning(f"Job {job.id} ({job.userName}): lease lost, result discarded ({e})")
                     except Exception as e:
                         # 失敗ログ
                         logging.error(json.dumps({
                             "user": getattr(user, 'userName', 'Unknown'),
                             "status": "失敗",
+                            "strategy": budget['strategy'] if budget else None,
                             "solver_duration": solver_duration,
                             "db_duration": db_duration,
                             "day_menus": day_menus,
@@ -275,17 +969,34 @@ def main_worker_loop():
                             "error_trace": str(e),
                             "timestamp": datetime.now().isoformat()
                         }, ensure_ascii=False))
-                        db.session.execute(text(
-                            "UPDATE menu_jobs SET status='failed', updated_at=NOW() WHERE id=:id"),
-                            {'id': job.id}
-                        )
-                        db.session.commit()
-                    pass
+                        db.session.rollback()
+                        fail_job(job.id)
+                    finally:
+                        if heartbeat is not None:
+                            heartbeat.set()
+
+                # 処理したジョブがあれば待たずに次を見に行く
+                if planned:
+                    continue
+
+                # 空き時間に，無効にされた献立ライブラリのプロファイルを 1 件ずつ解き直す
+                # 上限付きの子プロセスで解き，待機ジョブが来たらすぐにやめてジョブに戻る
+                if not jobs and LIBRARY_REFRESH and SOLVER_BACKEND != 'stub':
+                    # menu_library がこのモジュールを読み込むので，ここで読み込む
+                    from source.main.menu_library import refresh_missing_profile
+                    stop_watch, arrived = watch_pending()
+                    try:
+                        refreshed = refresh_missing_profile(reference, cancel=arrived)
+                    finally:
+                        stop_watch.set()
+                    if refreshed or arrived.is_set():
+                        continue
 
             except Exception as e:
+                db.session.rollback()
                 logging.error(f"Worker loop error: {e}")
 
-            time.sleep(5)
+            time.sleep(POLL_INTERVAL)
 
 
 if __name__ == "__main__":
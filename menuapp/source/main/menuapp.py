@@ -1,17 +1,24 @@
-from flask import Flask,render_template,request,redirect,flash,url_for, send_file,session
+from flask import Flask,render_template,request,redirect,flash,url_for, send_file,session,make_response,g,has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy import  cast, BigInteger,literal,select,union_all,text
+from sqlalchemy import  cast, BigInteger,literal,select,union_all,text,create_engine
+from sqlalchemy.orm import sessionmaker
 from flask_login import UserMixin,LoginManager,login_user,login_required,logout_user,current_user
 from werkzeug.security import generate_password_hash,check_password_hash
-import os,json,logging
-from collections import defaultdict
+import os,json,logging,hashlib,time,threading
+from datetime import datetime, timezone, timedelta
+from collections import defaultdict, OrderedDict
+from functools import wraps
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from decimal import Decimal, ROUND_HALF_UP
 from pyomo.opt import TerminationCondition
 from pyomo.util.infeasible import log_infeasible_constraints
 from pyomo.opt import TerminationCondition
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from source.main.ingredient_index import IngredientIndex
+from source.main.profiling import install_route_profiler
+from source.main.sandbox import SandboxLimit, SandboxError
 
 
 app = Flask(__name__)
@@ -24,6 +31,9 @@ load_dotenv()
 login_manager = LoginManager()
 login_manager.init_app(app)
 
+# 遅いリクエストのプロファイル（PROFILE_ROUTES=1 のときだけ有効）
+install_route_profiler(app)
+
 log_file_path = os.path.join(os.path.dirname(__file__), "../../menu_app.log")
 # ログ設定
 logger = logging.getLogger()
@@ -71,6 +81,73 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     "pool_recycle": 1800  # 既存接続の再利用までの秒数（30分）
 }
 
+# 読み取り専用のレプリカ（DATABASE_REPLICA_URL が空ならすべてプライマリで読む）．接続プールはプライマリとは別に持つ
+# ジョブの取得・献立の書き込みと，書き込んだ直後の読み取りはプライマリに残す
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL", "").replace('postgres://','postgresql+psycopg2://')
+REPLICA_POOL_SIZE = int(os.environ.get("REPLICA_POOL_SIZE", 5))
+REPLICA_MAX_OVERFLOW = int(os.environ.get("REPLICA_MAX_OVERFLOW", 10))
+# 書き込んだユーザーの読み取りをプライマリに固定する秒数（レプリカの遅延で直後の表示が古くならないように）
+READ_AFTER_WRITE_SECONDS = float(os.environ.get("READ_AFTER_WRITE_SECONDS", 30))
+# 参照データの読み込み前にレプリカの追いつきを待つ上限（秒）．追いつかなければプライマリで読む
+REPLICA_CATCHUP_SECONDS = float(os.environ.get("REPLICA_CATCHUP_SECONDS", 10))
+
+replica_engine = None
+ReplicaSession = None
+if DATABASE_REPLICA_URL:
+    replica_engine = create_engine(
+        DATABASE_REPLICA_URL,
+        pool_size=REPLICA_POOL_SIZE,
+        max_overflow=REPLICA_MAX_OVERFLOW,
+        pool_timeout=30,
+        pool_recycle=1800,
+        pool_pre_ping=True,   # レプリカの再起動・フェイルオーバー後の切れた接続を使わない
+        # 読み取りだけなので文ごとに確定する（長く開いたワーカーのコンテキストでも古いスナップショットに留まらない）
+        isolation_level="AUTOCOMMIT",
+    )
+    ReplicaSession = sessionmaker(bind=replica_engine)
+
+#このユーザーの読み取りをしばらくプライマリに固定する（書き込みのあるルートから呼ぶ）
+def pin_primary():
+    if ReplicaSession is not None:
+        session['primary_until'] = time.time() + READ_AFTER_WRITE_SECONDS
+
+#読み取り専用の処理に使うセッション（レプリカがないとき・書き込み直後のユーザーはプライマリの db.session）
+#レプリカのセッションはアプリケーションコンテキストごとに 1 つで，コンテキストの終わりに閉じる
+def read_session():
+    if ReplicaSession is None:
+        return db.session
+    if has_request_context() and session.get('primary_until', 0) > time.time():
+        return db.session
+    if 'read_session' not in g:
+        g.read_session = ReplicaSession()
+    return g.read_session
+
+@app.teardown_appcontext
+def close_read_session(exc):
+    replica = g.pop('read_session', None)
+    if replica is not None:
+        replica.close()
+
+#レプリカがプライマリの現在の WAL 位置まで追いつくのを待つ（時間内に追いつかなければ False）
+#ストリーミングレプリケーションでない DB（ローカルの別インスタンスなど）は常に追いついているとみなす
+def wait_for_replica(timeout=REPLICA_CATCHUP_SECONDS):
+    if replica_engine is None:
+        return True
+    lsn = db.session.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+    db.session.commit()
+    deadline = time.time() + timeout
+    with replica_engine.connect() as conn:
+        while True:
+            caught_up = conn.execute(text(
+                "SELECT COALESCE(pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn), TRUE)"), {'lsn': lsn}
+            ).scalar()
+            conn.rollback()
+            if caught_up:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.2)
+
 Base = automap_base()
 with app.app_context():
     Base.prepare(db.engine, reflect=True)
@@ -84,12 +161,35 @@ ItemWeight = Base .classes .itemWeights
 NutritionalTarget = Base .classes.nutritionalTargets
 User = Base.classes.user
 
-#現在のユーザを識別する
+#ユーザー情報のキャッシュ（userId → (期限, 列の値)）．ORM オブジェクトはリクエストをまたいで持たない
+#invalidate_user は更新したプロセスのキャッシュしか捨てないので，他のプロセスでは TTL の間古い値が残る
+#そのため献立の版（menu_version）と献立作成のプロフィールはキャッシュを使わず DB の値で求める
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 10))
+USER_CACHE = {}
+USER_CACHE_LOCK = threading.Lock()
+
+#ユーザーのキャッシュを捨てる（ユーザー情報の更新時．このプロセスの分のみ）
+def invalidate_user(user_id):
+    with USER_CACHE_LOCK:
+        USER_CACHE.pop(int(user_id), None)
+
+#現在のユーザを識別する（1 リクエスト内は flask_login が保持し，リクエスト間は TTL 付きでキャッシュ）
 @login_manager.user_loader
 def load_user(user_id):
-    user = db.session.query(User).get(int(user_id))
+    user_id = int(user_id)
+    now = time.time()
+    with USER_CACHE_LOCK:
+        cached = USER_CACHE.get(user_id)
+    if cached is not None and cached[0] > now:
+        return UserWrapper(cached[1])
+
+    user = read_session().get(User, user_id)
     if user:
-        return UserWrapper(user)
+        # パスワードハッシュは持たない
+        snapshot = SimpleNamespace(**{k: v for k, v in as_dict(user).items() if k != 'password'})
+        with USER_CACHE_LOCK:
+            USER_CACHE[user_id] = (now + USER_CACHE_TTL, snapshot)
+        return UserWrapper(snapshot)
     return None
 
 #辞書化関数・kind1の補完
@@ -111,13 +211,6 @@ def wrap_nutritional_target(nt):
             nutr[nut] = 0
     return {0: {"nutritionals": nutr, "userInfo": userinfo}}
 
-#誤ったreturn文を自動削除処理
-def sanitize_pyomo_code(code):
-    # よくある誤りパターンを一括補正（False→Infeasible, True→Skip）
-    code = code.replace('return False', 'return pyo.Constraint.Infeasible')
-    code = code.replace('return True', 'return pyo.Constraint.Skip')
-    return code
-
 #ユーザーごとに制約とする栄養素を判断するためのフラグ
 def should_use_pfc(userInfo):
     age = userInfo.get("年齢")
@@ -135,6 +228,293 @@ def should_use_pfc(userInfo):
         return False  # PFC制約を外す
     return True
 
+#同じ入力（＝同じ献立問題）を識別するキー
+def problem_key(userInfo, menstruation, regist_item):
+    payload = {
+        "年齢": userInfo.get("年齢"),
+        "性別": userInfo.get("性別"),
+        "運動レベル": userInfo.get("運動レベル"),
+        "月経": menstruation,
+        "use_pfc": should_use_pfc(userInfo),
+        "regist_item": regist_item or {},
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+#栄養目標を引くための (年齢, 性別, 運動レベル)（75歳以上の「高い」は「ふつう」の目標を使う）
+def target_profile(userInfo):
+    age = userInfo.get('年齢')
+    gender = userInfo.get('性別')
+    activity = userInfo.get('運動レベル')
+    activity_query = 'ふつう' if age and '75' in age and activity == '高い' else activity
+    return age, gender, activity_query
+
+#栄養目標の表（(年齢, 性別, 運動レベル) → userInfo・nutritionals）．ワーカーは参照データと一緒に読み込む
+#TTL を過ぎたら表を空にして引き直す（他のプロセスでの栄養目標の更新も TTL 以内に反映される）
+NUTRITIONAL_TARGETS_TTL = float(os.environ.get("NUTRITIONAL_TARGETS_TTL", 300))
+NUTRITIONAL_TARGETS = {}
+NUTRITIONAL_TARGETS_EXPIRES = 0.0
+
+def nutritional_target_key(age, gender, activity):
+    return (str(age), str(gender), str(activity))
+
+#栄養目標を全件読み込んで表を作り直す（reader を省略すると read_session で読む）
+def load_nutritional_targets(reader=None):
+    targets = {}
+    for nt in (reader or read_session()).query(NutritionalTarget).all():
+        info = dict(nt.userInfo or {})
+        key = nutritional_target_key(info.get('年齢'), info.get('性別'), info.get('運動レベル'))
+        targets.setdefault(key, {"userInfo": info, "nutritionals": dict(nt.nutritionals or {})})
+    global NUTRITIONAL_TARGETS_EXPIRES
+    NUTRITIONAL_TARGETS.clear()
+    NUTRITIONAL_TARGETS.update(targets)
+    NUTRITIONAL_TARGETS_EXPIRES = time.time() + NUTRITIONAL_TARGETS_TTL
+    return targets
+
+#ユーザー情報に対応する栄養目標を返す（表になければ式インデックスの効く SQL で引いて表に足す）
+def find_nutritional_target(userInfo):
+    global NUTRITIONAL_TARGETS_EXPIRES
+    if time.time() >= NUTRITIONAL_TARGETS_EXPIRES:
+        NUTRITIONAL_TARGETS.clear()
+        NUTRITIONAL_TARGETS_EXPIRES = time.time() + NUTRITIONAL_TARGETS_TTL
+    key = nutritional_target_key(*target_profile(userInfo))
+    target = NUTRITIONAL_TARGETS.get(key)
+    if target is None:
+        nt = read_session().query(NutritionalTarget).filter(
+            NutritionalTarget.userInfo['年齢'].astext == key[0],
+            NutritionalTarget.userInfo['性別'].astext == key[1],
+            NutritionalTarget.userInfo['運動レベル'].astext == key[2]
+        ).first()
+        if nt is None:
+            return None
+        target = {"userInfo": dict(nt.userInfo or {}), "nutritionals": dict(nt.nutritionals or {})}
+        NUTRITIONAL_TARGETS[key] = target
+    # 呼び出し側で書き換えても表が変わらないようにコピーを返す
+    return {"userInfo": dict(target["userInfo"]), "nutritionals": dict(target["nutritionals"])}
+
+#参照テーブルの行の追加・更新・削除の累計から DB 側の状態を表す値を求める（全件走査はしない）
+#統計はプライマリのものを使う（レプリカの統計は再生した変更を数えない）
+def table_fingerprint(tables):
+    rows = db.session.execute(text(
+        "SELECT relname, n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables "
+        "WHERE relname = ANY(:tables) ORDER BY relname"),
+        {'tables': tables}
+    ).fetchall()
+    canonical = json.dumps([list(r) for r in rows], default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+#食材名の検索索引（レシピに出てくる食材名と itemEquals から作る）
+#INGREDIENT_INDEX_CHECK 秒ごとに元のテーブルの状態を確かめ，変わっていれば作り直す
+INGREDIENT_TABLES = ['recipeItems', 'itemEquals']
+INGREDIENT_INDEX_CHECK = float(os.environ.get("INGREDIENT_INDEX_CHECK", 60))
+INGREDIENT_INDEX = None
+INGREDIENT_INDEX_SOURCE = None
+INGREDIENT_INDEX_CHECKED = 0.0
+INGREDIENT_INDEX_LOCK = threading.Lock()
+
+def ingredient_index():
+    global INGREDIENT_INDEX, INGREDIENT_INDEX_SOURCE, INGREDIENT_INDEX_CHECKED
+    with INGREDIENT_INDEX_LOCK:
+        if INGREDIENT_INDEX is not None and time.time() - INGREDIENT_INDEX_CHECKED < INGREDIENT_INDEX_CHECK:
+            return INGREDIENT_INDEX
+        source = table_fingerprint(INGREDIENT_TABLES)
+        INGREDIENT_INDEX_CHECKED = time.time()
+        if INGREDIENT_INDEX is None or source != INGREDIENT_INDEX_SOURCE:
+            # 変更の直後はレプリカが古いことがあるので，作り直しはプライマリで読む
+            ingredients = set()
+            for ri in db.session.query(RecipeItem.items).all():
+                ingredients.update((ri.items or {}).keys())
+            item_equals = {ie.itemName: ie.equals for ie in db.session.query(ItemEqual).all()}
+            db.session.commit()
+            INGREDIENT_INDEX = IngredientIndex(ingredients, item_equals)
+            INGREDIENT_INDEX_SOURCE = source
+            logging.info(f"Ingredient index built: {len(INGREDIENT_INDEX.ingredients)} ingredients")
+        return INGREDIENT_INDEX
+
+#登録食材の名前をレシピ側の食材名にそろえる（重量は同じ食材ごとに合算）．見つからない名前も返す
+def canonical_regist_item(regist_item):
+    index = ingredient_index()
+    canonical = {}
+    unknown = []
+    for name, weight in regist_item.items():
+        canon = index.resolve(name)
+        if canon is None:
+            unknown.append(name)
+            continue
+        canonical[canon] = canonical.get(canon, 0) + float(weight or 0)
+    return canonical, unknown
+
+#献立ライブラリ（登録食材なしの事前計算献立）のキー
+def library_key(userInfo, menstruation):
+    age, gender, activity = target_profile(userInfo)
+    payload = {
+        "年齢": age,
+        "性別": gender,
+        "運動レベル": activity,
+        "月経": menstruation,
+        "use_pfc": should_use_pfc(userInfo),
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+#献立ライブラリの献立を順不同で返す（先頭を採用し，残りは再生成用の別案にする）
+def find_library_menus(userInfo, menstruation):
+    try:
+        rows = db.session.execute(text(
+            "SELECT menus FROM menu_library WHERE profile_key=:key ORDER BY random()"),
+            {'key': library_key(userInfo, menstruation)}
+        ).fetchall()
+    except SQLAlchemyError as e:
+        # ライブラリ未作成の環境では通常の作成に回す
+        db.session.rollback()
+        logging.warning(f"Menu library unavailable: {e}")
+        return []
+    return [json.loads(r.menus) if isinstance(r.menus, str) else r.menus for r in rows]
+
+#結果が使うレシピと登録食材を記録する（参照データが変わったとき，影響する結果だけを無効にするため）
+#kind は 'job'（refs は menu_jobs.id），'library'（refs は profile_key），'pregen'（refs は userName）
+def record_dependencies(kind, refs, menus_list, ingredients=()):
+    refs = [str(ref) for ref in refs]
+    recipe_ids = sorted({int(r) for menus in menus_list for menu in menus.values() for r in menu.values()})
+    rows = [{'kind': kind, 'ref': ref, 'recipe_id': rid, 'ingredient': None} for ref in refs for rid in recipe_ids]
+    rows += [{'kind': kind, 'ref': ref, 'recipe_id': None, 'ingredient': name} for ref in refs for name in sorted(set(ingredients))]
+    try:
+        db.session.execute(text(
+            "DELETE FROM menu_dependencies WHERE kind=:kind AND ref = ANY(:refs)"),
+            {'kind': kind, 'refs': refs}
+        )
+        if rows:
+            db.session.execute(text(
+                "INSERT INTO menu_dependencies (kind, ref, recipe_id, ingredient) "
+                "VALUES (:kind, :ref, :recipe_id, :ingredient)"),
+                rows
+            )
+        db.session.commit()
+    except SQLAlchemyError as e:
+        # 記録できなくても結果は返す（無効化の対象から漏れるだけ）
+        db.session.rollback()
+        logging.warning(f"Failed to record dependencies of {kind} {refs}: {e}")
+
+#閑散時間に作っておいた献立を取り出す（条件が同じときだけ．取り出したら消す）
+def take_pregenerated_menus(userName, key):
+    try:
+        row = db.session.execute(text(
+            "DELETE FROM menu_pregenerated WHERE userName=:userName AND problem_key=:key RETURNING menus"),
+            {'userName': userName, 'key': key}
+        ).first()
+        if row is not None:
+            db.session.execute(text(
+                "DELETE FROM menu_dependencies WHERE kind='pregen' AND ref=:userName"), {'userName': userName}
+            )
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        logging.warning(f"Pregenerated menus unavailable: {e}")
+        return []
+    if row is None:
+        return []
+    return json.loads(row.menus) if isinstance(row.menus, str) else row.menus
+
+#事前に求めた献立（先頭を採用，全体を再生成用の別案にする）で完了済みのジョブを作る
+def serve_precomputed(user, regist_item, menus_list, strategy):
+    save_menu(user.userName, menus_list[0])
+    job_id = db.session.execute(text(
+        "INSERT INTO menu_jobs (userName, regist_item, status, strategy, result_json, problem_key, alternatives) "
+        "VALUES (:userName, :regist_item, 'done', :strategy, :result, :key, :alternatives) RETURNING id"),
+        {
+            'userName': user.userName,
+            'regist_item': json.dumps(regist_item),
+            'strategy': strategy,
+            'result': json.dumps(menus_list[0], ensure_ascii=False),
+            'key': problem_key(user.userInfo, user.menstruation, regist_item),
+            'alternatives': json.dumps(menus_list, ensure_ascii=False),
+        }
+    ).scalar()
+    db.session.commit()
+    record_dependencies('job', [job_id], menus_list, regist_item)
+
+#献立ページ（/showmenu・/item・/nutrition）の描画結果のキャッシュ．(ユーザー, ページ, 献立の版) ごとに持つ
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 1000))
+PAGE_CACHE = OrderedDict()
+PAGE_CACHE_LOCK = threading.Lock()
+
+#献立の版：献立の保存時刻・直近のジョブの状態・ユーザー情報から求める（ワーカーが献立を保存すると変わる）
+#ユーザー情報は他のプロセスで更新されてもすぐ変わるように，キャッシュ（current_user）ではなく DB の行から読む
+def menu_version(user):
+    row = read_session().execute(text(
+        'SELECT (SELECT MAX("createdAt") FROM menu WHERE "userName"=:userName) AS menu_at, '
+        "(SELECT CONCAT(id, ':', status, ':', provisional, ':', alt_index, ':', updated_at) FROM menu_jobs "
+        "WHERE userName=:userName ORDER BY created_at DESC LIMIT 1) AS job, "
+        '(SELECT CONCAT("userInfo"::text, \':\', menstruation) FROM "user" WHERE "userName"=:userName) AS profile'),
+        {'userName': user.userName}
+    ).first()
+    canonical = json.dumps(
+        [str(row.menu_at), row.job, row.profile], ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+#ユーザーのキャッシュを捨てる（献立の保存・ユーザー情報の更新時）
+def invalidate_page_cache(userName):
+    with PAGE_CACHE_LOCK:
+        for key in [k for k in PAGE_CACHE if k[0] == userName]:
+            del PAGE_CACHE[key]
+
+#献立の版を ETag にして，変わっていなければ 304，描画済みならキャッシュを返すデコレータ
+def cached_page(page):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = menu_version(current_user)
+            key = (current_user.userName, page, version)
+            with PAGE_CACHE_LOCK:
+                body = PAGE_CACHE.get(key)
+                if body is not None:
+                    PAGE_CACHE.move_to_end(key)
+
+            if body is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    with PAGE_CACHE_LOCK:
+                        PAGE_CACHE[key] = response.get_data()
+                        while len(PAGE_CACHE) > PAGE_CACHE_SIZE:
+                            PAGE_CACHE.popitem(last=False)
+            else:
+                response = make_response(body)
+
+            # ブラウザには毎回確認させ，版が同じなら 304 で済ませる
+            response.set_etag(version)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+#献立を Menu テーブルに保存し（既存の献立は置き換え），保存にかかった秒数を返す
+#guard を渡すと同じトランザクションで先に実行し，False なら保存せずに None を返す（ワーカーのジョブの所有確認用）
+def save_menu(userName, day_menus, guard=None):
+    # JST (UTC+9) に変換
+    now_jst = datetime.now(timezone.utc) + timedelta(hours=9)
+    db_start = time.time()
+    if guard is not None and not guard():
+        db.session.rollback()
+        return None
+    db.session.query(Menu).filter_by(userName=userName).delete()
+    menu_obj = Menu(
+        userName=userName,
+        menu1=day_menus.get('menu1', {}),
+        menu2=day_menus.get('menu2', {}),
+        menu3=day_menus.get('menu3', {}),
+        menu4=day_menus.get('menu4', {}),
+        menu5=day_menus.get('menu5', {}),
+        menu6=day_menus.get('menu6', {}),
+        menu7=day_menus.get('menu7', {}),
+        createdAt=now_jst.replace(tzinfo=None)
+    )
+    db.session.add(menu_obj)
+    db.session.commit()
+    invalidate_page_cache(userName)
+    return time.time() - db_start
+
 #　PFCの目標をグラム単位に換算する
 def percent_to_g(percent, energy, factor):
     """%エネルギー→g換算"""
@@ -175,6 +555,10 @@ def classify_error_jp(e=None, solver_result=None):
         return "データベース内部エラー"
     if isinstance(e, MemoryError):
         return "サーバーメモリ不足"
+    if isinstance(e, SandboxLimit):
+        return "サーバーメモリ不足" if e.reason == 'memory' else "計算資源の上限超過"
+    if isinstance(e, SandboxError):
+        return "ソルバー内部エラー"
 
     # --- ③ メッセージ文字列で判定 ---
     if e:
@@ -253,6 +637,7 @@ def signup():
         user = User(userName=userName,password=hashed_pass,userInfo=userInfo,menstruation=menstruation)
         db.session.add(user)
         db.session.commit()
+        pin_primary()
         return redirect('/login')
     elif request.method == 'GET':
         return render_template('signup.html', show_navbar=False)
@@ -273,6 +658,7 @@ def login():
         if check_password_hash(user.password,password=password):
             wrapped_user = UserWrapper(user)
             login_user(wrapped_user)
+            pin_primary()
             return redirect('/showmenu')
         else:
             flash('ユーザ名かパスワードが違います')
@@ -283,15 +669,24 @@ def login():
 #　献立一覧表示機能
 @app.route("/showmenu")
 @login_required
+@cached_page('showmenu')
 def show_menus():
     weekly_data = []
-    menu = db.session.query(Menu).filter_by(userName=current_user.userName).first()
+    reader = read_session()
+    menu = reader.query(Menu).filter_by(userName=current_user.userName).first()
 
     if menu is None:
         return render_template("showmenu.html", weekly_data=[], show_navbar=True)
     
     menu_created_date = getattr(menu, 'createdAt', None)
 
+    # 暫定献立（ソルバーが最終結果を探している途中）かどうか
+    latest_job = reader.execute(text(
+        "SELECT status, provisional FROM menu_jobs WHERE userName=:userName ORDER BY created_at DESC LIMIT 1"),
+        {'userName': current_user.userName}
+    ).first()
+    provisional = latest_job is not None and latest_job.status == 'running' and latest_job.provisional
+
     queries = []
     idx = 0
 
@@ -313,7 +708,7 @@ def show_menus():
             idx += 1
 
             query = (
-                db.session.query(
+                reader.query(
                     RecipeUrl.recipeTitle.label('recipeTitle'),
                     RecipeUrl.recipeUrl.label('recipeUrl'),
                     RecipeUrl.foodImageUrl.label('foodImageUrl'),
@@ -342,7 +737,7 @@ def show_menus():
         full_union.c.meal_type,
     )
 
-    results = db.session.execute(stmt).fetchall()
+    results = reader.execute(stmt).fetchall()
 
     grouped = defaultdict(list)
     for r in results:
@@ -353,15 +748,17 @@ def show_menus():
     weekly_data = [grouped[m] for m in menu_order]
 
 
-    return render_template("showmenu.html", weekly_data=weekly_data, menu_created_date=menu_created_date, current_page='showmenu', show_navbar=True)
+    return render_template("showmenu.html", weekly_data=weekly_data, menu_created_date=menu_created_date, provisional=provisional, current_page='showmenu', show_navbar=True)
 
 #　ユーザ情報の更新機能
 @app.route("/userupdate", methods=['GET', 'POST'])
 @login_required
 def user_update():
-    user = db.session.query(User).filter_by(userId=int(current_user.get_id())).first()
+    user = current_user
 
     if request.method == 'POST':
+        # 書き換えるので ORM オブジェクトを取り直す
+        user = db.session.query(User).get(int(current_user.get_id()))
         userAge = request.form.get('userAge')
         userExerciseLevel = request.form.get('userExerciseLevel')
         menstruation = request.form.get('menstruation', 'なし')
@@ -377,6 +774,9 @@ def user_update():
             user.menstruation = menstruation
 
             db.session.commit()
+            pin_primary()
+            invalidate_user(user.userId)
+            invalidate_page_cache(user.userName)
         return redirect('/showmenu')
 
     else:  # GET
@@ -398,9 +798,11 @@ def user_update():
 #　食材一覧表示機能
 @app.route("/item")
 @login_required
+@cached_page('item')
 def show_item():
     aggregated_ingredients = {}
-    menu = db.session.query(Menu).filter_by(userName=current_user.userName).first()
+    reader = read_session()
+    menu = reader.query(Menu).filter_by(userName=current_user.userName).first()
     if menu is None:
         return render_template("item.html", ingredients=aggregated_ingredients, total_types=0, current_page='item', show_navbar=True)
 
@@ -421,7 +823,7 @@ def show_item():
     recipe_ids = list(set(recipe_ids))
 
     # ItemEqualの辞書作成: 等価食材名 -> 代表名
-    item_equals = db.session.query(ItemEqual).all()
+    item_equals = reader.query(ItemEqual).all()
     item_equal_map = {}
     for eq in item_equals:
         equals_list = eq.equals.split(',') if eq.equals else []
@@ -431,7 +833,7 @@ def show_item():
 
     # recipeIdごとにitemsを集計
     for rid in recipe_ids:
-        recipe_item = db.session.query(RecipeItem).filter(RecipeItem.recipeId == rid).first()
+        recipe_item = reader.query(RecipeItem).filter(RecipeItem.recipeId == rid).first()
         if not recipe_item:
             continue
         for ing_name, qty in recipe_item.items.items():
@@ -452,12 +854,45 @@ def show_item():
 def regist_item():
     return render_template('createmenu.html',current_page='createmenu',show_navbar=True)
 
+#　食材名の入力候補（献立作成画面の食材欄から呼ぶ）
+@app.route('/ingredients', methods=['GET'])
+@login_required
+def suggest_ingredients():
+    index = ingredient_index()
+    q = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    response = app.response_class(
+        json.dumps({"items": index.suggest(q, limit)}, ensure_ascii=False),
+        mimetype='application/json'
+    )
+    # 索引の版を ETag にする．索引は参照テーブルの変更で作り直すので，ブラウザには確かめる間隔だけキャッシュさせる
+    response.set_etag(hashlib.sha1(f"{index.version}\n{limit}\n{q}".encode('utf-8')).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.max_age = int(INGREDIENT_INDEX_CHECK)
+    return response.make_conditional(request)
+
 #　献立作成機能・献立作成画面で参照
 @app.route("/menu_status")
 @login_required
 def menu_status():
-    menu = db.session.query(Menu).filter_by(userName=current_user.userName).order_by(Menu.createdAt.desc()).first()
+    # 直近のジョブが処理中なら（部分編集で献立が残っていても）待ち
+    reader = read_session()
+    job = reader.execute(text(
+        "SELECT status, provisional FROM menu_jobs WHERE userName=:userName ORDER BY created_at DESC LIMIT 1"),
+        {'userName': current_user.userName}
+    ).first()
+    if job is not None and job.status == 'running' and job.provisional:
+        # 暫定献立は表示できる（最終結果で差し替わる）．続けて開く献立ページはプライマリで読む
+        pin_primary()
+        return {"status": "provisional"}
+    if job is not None and job.status in ('pending', 'running'):
+        return {"status": "pending"}
+    if job is not None and job.status == 'failed':
+        return {"status": "failed"}
+
+    menu = reader.query(Menu).filter_by(userName=current_user.userName).order_by(Menu.createdAt.desc()).first()
     if menu:
+        pin_primary()
         return {"status": "done"}
     else:
         return {"status": "pending"}
@@ -468,6 +903,16 @@ def menu_status():
 def create_menu_async():
     try:
         regist_item = request.json if request.json else {}
+        try:
+            regist_item, unknown = canonical_regist_item(regist_item)
+        except (AttributeError, TypeError, ValueError):
+            return {"status": "error", "message": "食材の指定が正しくありません"}, 400
+        if unknown:
+            # モデルの食材名に当たらない登録は無視されてしまうので，作成前に知らせる
+            return {"status": "error", "message": f"食材が見つかりません: {'、'.join(unknown)}", "unknown": unknown}, 400
+
+        # この後の状態確認・献立ページは書き込み先のプライマリで読む
+        pin_primary()
 
         # ログインユーザが以前取得した献立を削除
         existing_menu = db.session.query(Menu).filter_by(userName=current_user.userName).first()
@@ -482,6 +927,24 @@ def create_menu_async():
         )
         db.session.commit()
 
+        # プロフィールは他のプロセスで更新された直後でも正しいように，キャッシュではなくプライマリから読む
+        user = db.session.get(User, current_user.userId) or current_user
+
+        # 登録食材なし：事前計算した献立ライブラリがあれば即時に返す
+        if not regist_item:
+            library_menus = find_library_menus(user.userInfo, user.menstruation)
+            if library_menus:
+                serve_precomputed(user, regist_item, library_menus, 'library')
+                return {"status": "done", "message": "献立を作成しました。"}, 200
+        else:
+            # 閑散時間に前回と同じ登録食材で作っておいた献立があれば即時に返す
+            pregenerated = take_pregenerated_menus(
+                user.userName, problem_key(user.userInfo, user.menstruation, regist_item)
+            )
+            if pregenerated:
+                serve_precomputed(user, regist_item, pregenerated, 'pregenerated')
+                return {"status": "done", "message": "献立を作成しました。"}, 200
+
         # ジョブ登録
         db.session.execute(text(
             "INSERT INTO menu_jobs (userName, regist_item) VALUES (:userName, :regist_item)"),
@@ -495,9 +958,93 @@ def create_menu_async():
         logging.error(f"Failed to queue job: {e}")
         return {"status": "error", "message": "ジョブ登録に失敗しました"}, 500
 
+#　献立の部分編集機能・固定した日/レシピは残し，それ以外だけを作り直す
+@app.route('/editmenu', methods=['POST'])
+@login_required
+def edit_menu():
+    try:
+        payload = request.json or {}
+        menu_cols = [f"menu{d}" for d in range(1, 8)]
+
+        # 編集前の献立（指定がなければ保存済みの献立）
+        menus = payload.get('menus')
+        if not menus:
+            menu = db.session.query(Menu).filter_by(userName=current_user.userName).first()
+            if menu is None:
+                return {"status": "error", "message": "編集する献立がありません"}, 404
+            menus = {col: getattr(menu, col) or {} for col in menu_cols}
+        menus = {col: {k: int(v) for k, v in (menus.get(col) or {}).items()} for col in menu_cols}
+
+        edit = {
+            'menus': menus,
+            'lock_days': [int(d) for d in payload.get('lock_days', [])],
+            'lock_recipes': [int(r) for r in payload.get('lock_recipes', [])],
+            'exclude_current': bool(payload.get('exclude_current', True)),
+        }
+    except (ValueError, TypeError, AttributeError):
+        return {"status": "error", "message": "編集内容の指定が正しくありません"}, 400
+    if set(range(1, 8)) <= set(edit['lock_days']):
+        return {"status": "error", "message": "作り直す日がありません"}, 400
+
+    try:
+        # 前回と同じ登録食材で解き直す
+        last_job = db.session.execute(text(
+            "SELECT regist_item FROM menu_jobs WHERE userName=:userName ORDER BY created_at DESC LIMIT 1"),
+            {'userName': current_user.userName}
+        ).first()
+        regist_item = last_job.regist_item if last_job is not None and last_job.regist_item else json.dumps({})
+
+        db.session.execute(text(
+            "DELETE FROM menu_jobs WHERE userName=:userName AND status IN ('pending','running')"),
+            {'userName': current_user.userName}
+        )
+        db.session.execute(text(
+            "INSERT INTO menu_jobs (userName, regist_item, edit_json) VALUES (:userName, :regist_item, :edit)"),
+            {'userName': current_user.userName, 'regist_item': regist_item, 'edit': json.dumps(edit, ensure_ascii=False)}
+        )
+        db.session.commit()
+        pin_primary()
+        return {"status": "queued", "message": "献立の編集をキューに登録しました。"}, 202
+
+    except Exception as e:
+        logging.error(f"Failed to queue edit job: {e}")
+        return {"status": "error", "message": "ジョブ登録に失敗しました"}, 500
+
+#　献立の再生成機能・直近のジョブで求めておいた別案に切り替える（再計算なし）
+@app.route('/regenerate', methods=['POST'])
+@login_required
+def regenerate_menu():
+    try:
+        job = db.session.execute(text(
+            "SELECT id, alternatives, alt_index FROM menu_jobs WHERE userName=:userName AND status='done' "
+            "ORDER BY created_at DESC LIMIT 1"),
+            {'userName': current_user.userName}
+        ).first()
+        alternatives = []
+        if job is not None and job.alternatives:
+            alternatives = json.loads(job.alternatives) if isinstance(job.alternatives, str) else job.alternatives
+        if len(alternatives) < 2:
+            return {"status": "none", "message": "別の献立案がありません。献立作成からやり直してください。"}, 404
+
+        next_index = (job.alt_index + 1) % len(alternatives)
+        save_menu(current_user.userName, alternatives[next_index])
+        pin_primary()
+
+        db.session.execute(text(
+            "UPDATE menu_jobs SET alt_index=:index, result_json=:result, updated_at=NOW() WHERE id=:id"),
+            {'index': next_index, 'result': json.dumps(alternatives[next_index], ensure_ascii=False), 'id': job.id}
+        )
+        db.session.commit()
+        return {"status": "done", "index": next_index, "count": len(alternatives)}
+
+    except Exception as e:
+        logging.error(f"Failed to regenerate menu: {e}")
+        return {"status": "error", "message": "献立の切り替えに失敗しました"}, 500
+
 #　栄養一覧表示機能
 @app.route("/nutrition")
 @login_required
+@cached_page('nutrition')
 def show_nutrition():
     # NutritionalTarget→RecipeNutritionへのkey変換dict
     key_map = {
@@ -525,7 +1072,8 @@ def show_nutrition():
     aggregated_nutrition = {}
     recipe_ids = []
 
-    menu = db.session.query(Menu).filter_by(userName=current_user.userName).first()
+    reader = read_session()
+    menu = reader.query(Menu).filter_by(userName=current_user.userName).first()
     if menu is None:
         return render_template("nutrition.html", nutrition=aggregated_nutrition, nutritionals={}, current_page='nutrition', show_navbar=True)
 
@@ -542,7 +1090,7 @@ def show_nutrition():
                 continue
             recipe_ids.append(recipe_id)
 
-            rec_nut = db.session.query(RecipeNutrition).filter(RecipeNutrition.recipeId == recipe_id).first()
+            rec_nut = reader.query(RecipeNutrition).filter(RecipeNutrition.recipeId == recipe_id).first()
             if not rec_nut:
                 continue
 
@@ -555,17 +1103,17 @@ def show_nutrition():
     rounded_nutrition = {k: sig_round(v, 4) for k, v in aggregated_nutrition.items()}
 
     # ユーザー目標値取得・対応keyにリネーム
-    user = db.session.query(User).filter_by(userName=current_user.userName).first()
+    user = current_user
     nutritionals_raw = {}
     if user is not None:
-        nutritional_obj = db.session.query(NutritionalTarget).filter(NutritionalTarget.userInfo == user.userInfo).first()
-        if nutritional_obj is not None and nutritional_obj.nutritionals:
+        nutritional_obj = find_nutritional_target(user.userInfo)
+        if nutritional_obj is not None and nutritional_obj["nutritionals"]:
             # menstruationが'あり'なら鉄・月経時_下限、それ以外は鉄_下限
-            nutritionals_raw = nutritional_obj.nutritionals.copy()
+            nutritionals_raw = nutritional_obj["nutritionals"].copy()
             if user.menstruation == 'あり':
                 # 鉄_下限を鉄・月経時_下限に置き換える
-                if "鉄・月経時_下限" in nutritional_obj.nutritionals:
-                    nutritionals_raw["鉄_下限"] = nutritional_obj.nutritionals["鉄・月経時_下限"]
+                if "鉄・月経時_下限" in nutritional_obj["nutritionals"]:
+                    nutritionals_raw["鉄_下限"] = nutritional_obj["nutritionals"]["鉄・月経時_下限"]
             else:
                 # 月経なし → 「鉄・月経時_下限」を削除
                 if "鉄・月経時_下限" in nutritionals_raw:
@@ -601,7 +1149,16 @@ def show_nutrition():
             else:
                 nutritionals.setdefault(rep_key, {})['max'] = v
 
-    return render_template("nutrition.html", nutrition=rounded_nutrition, nutritionals=nutritionals, current_page='nutrition', show_navbar=True)
+    # 栄養目標を満たせず緩和して作った献立なら，満たせなかった栄養素を知らせる
+    latest_job = reader.execute(text(
+        "SELECT violations FROM menu_jobs WHERE userName=:userName AND status='done' ORDER BY created_at DESC LIMIT 1"),
+        {'userName': current_user.userName}
+    ).first()
+    violations = {}
+    if latest_job is not None and latest_job.violations:
+        violations = json.loads(latest_job.violations) if isinstance(latest_job.violations, str) else latest_job.violations
+
+    return render_template("nutrition.html", nutrition=rounded_nutrition, nutritionals=nutritionals, violations=violations, current_page='nutrition', show_navbar=True)
 
 #　ログアウト機能 
 @app.route('/logout',methods=['GET','POST'])
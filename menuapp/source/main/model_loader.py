@@ -0,0 +1,126 @@
+import os
+import pyomo.environ as pyo
+from pyomo.opt import SolutionStatus
+
+# モデルの読み込み・構築・解の取り出し（DB に触れないので，オフラインの再実行からも使える）
+
+# 登録食材の変数を登録された食材だけに置く（0 にすると全食材に置く旧方式）
+REGIST_INVENTORY_MODEL = os.environ.get("REGIST_INVENTORY_MODEL", "1") == "1"
+
+#誤ったreturn文を自動削除処理
+def sanitize_pyomo_code(code):
+    # よくある誤りパターンを一括補正（False→Infeasible, True→Skip）
+    code = code.replace('return False', 'return pyo.Constraint.Infeasible')
+    code = code.replace('return True', 'return pyo.Constraint.Skip')
+    return code
+
+# api_pyomo_model.py を読み込み，build_model などの定義を含む名前空間を返す
+def load_model_code(scope=None):
+    base_dir = os.path.dirname(__file__)
+    api_file_path = os.path.join(base_dir, "api_pyomo_model.py")
+    with open(api_file_path, encoding='utf-8') as f:
+        pyomo_code_str = f.read()
+    pyomo_code_str = sanitize_pyomo_code(pyomo_code_str)
+    scope = dict(scope or {})
+    exec(pyomo_code_str, scope, scope)
+    return scope
+
+# 定数・関数（nutrition_bounds など）だけを使うときの名前空間．1 回だけ読み込んで使い回す
+_MODEL_FUNCTIONS = None
+
+def model_functions():
+    global _MODEL_FUNCTIONS
+    if _MODEL_FUNCTIONS is None:
+        _MODEL_FUNCTIONS = load_model_code()
+    return _MODEL_FUNCTIONS
+
+# 部分編集で作り直す日（固定した日を除いた日）
+def edit_days(edit):
+    lock_days = set(edit.get('lock_days', []))
+    return [d for d in range(1, 8) if d not in lock_days]
+
+# 参照データとユーザー条件からモデルを構築する
+# edit（部分編集）を渡すと，作り直す日だけを変数にした縮小モデルにする（固定した日の献立は定数として制約に入る）
+def build_job_model(reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, edit=None):
+    RECIPE_DICT, ITEMWEIGHT_DICT, ITEMEQUAL_DICT, RECIPEITEM_DICT, RECIPE_NUTRITION_DICT = reference.views()
+    days = list(range(1, 8))
+    recipe_ids = list(RECIPE_DICT.keys())
+    locked_menus = {}
+    if edit:
+        days = edit_days(edit)
+        locked_menus = {
+            d: dict(edit['menus'].get(f"menu{d}") or {}) for d in range(1, 8) if d not in days
+        }
+
+    # Pyomo モデル読み込み
+    scope = load_model_code({
+        'days': days,
+        'recipe_dict': RECIPE_DICT,
+        'recipe_ids': recipe_ids,
+        'recipeitem_dict': RECIPEITEM_DICT,
+        'filtered_recipe_nutritions': RECIPE_NUTRITION_DICT,
+        'nutritionaltarget_dict': nutritionaltarget_dict,
+        'itemweight_dict': ITEMWEIGHT_DICT,
+        'itemequal_dict': ITEMEQUAL_DICT,
+        'menstruation': menstruation,
+        'regist_item': regist_item,
+        'use_pfc': use_pfc
+    })
+    build_model = scope.get('build_model')
+    model = build_model(
+        days, RECIPE_DICT, recipe_ids, RECIPEITEM_DICT, RECIPE_NUTRITION_DICT,
+        nutritionaltarget_dict, ITEMWEIGHT_DICT, ITEMEQUAL_DICT,
+        menstruation, regist_item, use_pfc, regist_inventory=REGIST_INVENTORY_MODEL,
+        locked_menus=locked_menus
+    )
+    return model, scope
+
+# 解いたモデルから日ごとの献立 {menu1: {kind1: recipeId}, ...} を取り出す
+# 縮小モデル（部分編集）では固定した日の献立をそのまま入れて 1 週間分にする
+def extract_day_menus(model):
+    locked_menus = getattr(model, 'locked_menus', {})
+    day_menus = {}
+    for d in sorted(set(model.Days) | set(locked_menus)):
+        menu_name = f"menu{d}"
+        if d in locked_menus:
+            day_menus[menu_name] = dict(locked_menus[d])
+            continue
+        day_menus[menu_name] = {}
+        for r in model.Recipes:
+            var = model.x[d, r]
+            if var.value is not None and var.value > 0.5:
+                kind1 = model.kind1_map[r]
+                day_menus[menu_name][kind1] = r
+    return day_menus
+
+# 解き直す前に前回の解を消す（解なしのとき前回の値が残って同じ献立に見えるのを防ぐ）
+# 固定した変数（部分編集で固定した日・レシピ）は値を残す
+def clear_solution(model):
+    for var in model.x.values():
+        if not var.fixed:
+            var.set_value(None)
+
+# 献立として使える解の状態（打ち切りでも整数の暫定解があればよい．'other' は LP 緩和の値なので使わない）
+USABLE_SOLUTIONS = {
+    SolutionStatus.optimal, SolutionStatus.globallyOptimal, SolutionStatus.locallyOptimal,
+    SolutionStatus.feasible, SolutionStatus.bestSoFar, SolutionStatus.stoppedByLimit,
+}
+
+# 解いて，使える解があるときだけモデルに読み込む（なければ初期解・前回の値を消す）．(結果, 解の有無) を返す
+def solve_model(solver, model, **kwargs):
+    result = solver.solve(model, tee=False, load_solutions=False, **kwargs)
+    found = len(result.solution) > 0 and result.solution(0).status in USABLE_SOLUTIONS
+    if found:
+        model.solutions.load_from(result)
+    else:
+        clear_solution(model)
+    return result, found
+
+# 有効な目的関数の値（解がなければ None）
+def objective_value(model):
+    for obj in model.component_data_objects(pyo.Objective, active=True):
+        try:
+            return pyo.value(obj)
+        except ValueError:
+            return None
+    return None
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from datetime import datetime
+from sqlalchemy import text
+from pyomo.environ import SolverFactory
+from source.main.menuapp import (
+    app, db, CBC_PATH, User, should_use_pfc, wrap_nutritional_target, problem_key, find_nutritional_target,
+    record_dependencies
+)
+from source.main.menu_worker import load_reference, queue_stats, solution_pool
+from source.main.model_loader import build_job_model, extract_day_menus, solve_model
+from source.main.schema import ensure_schema
+
+# 閑散時間の事前生成：直近に献立を作ったユーザーの次の献立を，前回の登録食材でまとめて解いておく
+# 次の /createmenu が同じ条件ならソルバーを通さずに返せるので，週初めの集中を CBC ワーカーから逃がせる
+# 登録食材なしのユーザーは献立ライブラリで即時に返せるので対象にしない
+
+# 事前生成の設定（環境変数で上書き可）
+PREGEN_ACTIVE_DAYS = int(os.environ.get("PREGEN_ACTIVE_DAYS", 14))              # この日数以内に献立を作ったユーザーが対象
+PREGEN_MAX_AGE_DAYS = float(os.environ.get("PREGEN_MAX_AGE_DAYS", 7))           # これより新しい作り置きは作り直さない
+PREGEN_ALTERNATIVES = int(os.environ.get("PREGEN_ALTERNATIVES", 2))             # 1 件目に加えて作る別案の数
+PREGEN_TIME_LIMIT = float(os.environ.get("PREGEN_TIME_LIMIT", 60))              # 1 献立あたりの制限時間（秒）
+PREGEN_RATIO_GAP = float(os.environ.get("PREGEN_RATIO_GAP", 0.01))              # オフラインなので通常より厳しく
+PREGEN_MAX_BACKLOG = int(os.environ.get("PREGEN_MAX_BACKLOG", 0))               # 待機ジョブがこれより多い間は始めない
+PREGEN_BACKLOG_WAIT = float(os.environ.get("PREGEN_BACKLOG_WAIT", 30))          # 待機ジョブが捌けるのを待つ間隔（秒）
+PREGEN_NICE = int(os.environ.get("PREGEN_NICE", 10))                            # 求解プロセスの優先度を下げる量
+PREGEN_WINDOW = os.environ.get("PREGEN_WINDOW", "1-6")                          # 実行してよい時間帯（時，日をまたいでもよい）
+
+# 子プロセスで共有する参照データ
+_REFERENCE = None
+
+def _init_process(reference):
+    global _REFERENCE
+    _REFERENCE = reference
+    # 同じマシンのワーカーの求解を邪魔しない
+    os.nice(PREGEN_NICE)
+
+# "1-6" を (1, 6) にする（終わりの時は含まない．"22-5" のように日をまたいでもよい）
+def parse_window(window):
+    start, end = (int(h) for h in window.split('-'))
+    return start, end
+
+def in_window(window, now=None):
+    start, end = window
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+# 事前生成の対象：直近に献立を作ったユーザーと，最後に使った登録食材（部分編集は除く）
+def active_users(days=PREGEN_ACTIVE_DAYS):
+    rows = db.session.execute(text(
+        "SELECT DISTINCT ON (userName) userName, regist_item FROM menu_jobs "
+        "WHERE created_at >= NOW() - :days * INTERVAL '1 day' AND edit_json IS NULL "
+        "ORDER BY userName, created_at DESC"),
+        {'days': days}
+    ).fetchall()
+    db.session.commit()
+    users = []
+    for row in rows:
+        regist_item = json.loads(row.regist_item) if row.regist_item else {}
+        if regist_item:
+            users.append((row.userName, regist_item))
+    return users
+
+# 1 ユーザー分の入力を作る（作り置きが同じ条件で新しければ None）
+def pregeneration_target(userName, regist_item, max_age_days=PREGEN_MAX_AGE_DAYS):
+    user = db.session.query(User).filter_by(userName=userName).first()
+    if not user:
+        return None
+    user_info = user.userInfo
+    nt = find_nutritional_target(user_info)
+    if nt is None:
+        logging.error(f"Pregeneration: NutritionalTarget not found for user {userName}")
+        return None
+    key = problem_key(user_info, user.menstruation, regist_item)
+    fresh = db.session.execute(text(
+        "SELECT 1 FROM menu_pregenerated WHERE userName=:userName AND problem_key=:key "
+        "AND created_at >= NOW() - :days * INTERVAL '1 day'"),
+        {'userName': userName, 'key': key, 'days': max_age_days}
+    ).first()
+    db.session.commit()
+    if fresh:
+        return None
+    return {
+        'userName': userName,
+        'key': key,
+        'nutritionaltarget_dict': wrap_nutritional_target(nt),
+        'menstruation': user.menstruation,
+        'regist_item': regist_item,
+        'use_pfc': should_use_pfc(user_info),
+    }
+
+# 1 ユーザー分の献立を別案と合わせて求める（子プロセスで実行）
+def solve_target(target, alternatives=PREGEN_ALTERNATIVES):
+    model, scope = build_job_model(
+        _REFERENCE, target['nutritionaltarget_dict'], target['menstruation'], target['regist_item'], target['use_pfc']
+    )
+    solver = SolverFactory('cbc', executable=CBC_PATH)
+    solver.options['sec'] = PREGEN_TIME_LIMIT
+    solver.options['ratioGap'] = PREGEN_RATIO_GAP
+    try:
+        _, found = solve_model(solver, model)
+    except Exception as e:
+        logging.warning(f"Pregeneration solve failed for {target['userName']}: {e}")
+        return target, []
+    day_menus = extract_day_menus(model)
+    if not found or not all(day_menus.values()):
+        return target, []
+    return target, solution_pool(model, scope, day_menus, alternatives, PREGEN_TIME_LIMIT, PREGEN_RATIO_GAP)
+
+# 作り置きを入れ替え，使ったレシピ・登録食材を依存関係として記録する
+def store_pregenerated(target, entries):
+    db.session.execute(text(
+        "INSERT INTO menu_pregenerated (userName, problem_key, menus) VALUES (:userName, :key, :menus) "
+        "ON CONFLICT (userName) DO UPDATE SET problem_key=EXCLUDED.problem_key, menus=EXCLUDED.menus, created_at=NOW()"),
+        {'userName': target['userName'], 'key': target['key'], 'menus': json.dumps(entries, ensure_ascii=False)}
+    )
+    db.session.execute(text(
+        "DELETE FROM menu_dependencies WHERE kind='pregen' AND ref=:userName"), {'userName': target['userName']}
+    )
+    db.session.commit()
+    record_dependencies('pregen', [target['userName']], entries, target['regist_item'])
+
+# 待機ジョブが捌けるまで待つ（本番の依頼を優先する）．時間帯を過ぎたら False
+def wait_for_quiet_queue(window, max_backlog=PREGEN_MAX_BACKLOG):
+    while True:
+        if window and not in_window(window):
+            return False
+        backlog, _ = queue_stats()
+        db.session.commit()
+        if backlog <= max_backlog:
+            return True
+        logging.info(f"Pregeneration: {backlog} pending jobs, waiting")
+        time.sleep(PREGEN_BACKLOG_WAIT)
+
+# 対象ユーザーの献立を事前生成する（processes 件ずつ，区切りごとに待機ジョブと時間帯を確かめる）
+def pregenerate(processes=None, window=None, days=PREGEN_ACTIVE_DAYS, limit=None):
+    ensure_schema()
+    with app.app_context():
+        if window and not in_window(window):
+            logging.info("Pregeneration: outside the off-peak window")
+            return
+        reference = load_reference()
+        targets = []
+        for userName, regist_item in active_users(days):
+            target = pregeneration_target(userName, regist_item)
+            if target is not None:
+                targets.append(target)
+        if limit is not None:
+            targets = targets[:limit]
+        logging.info(f"Pregeneration: {len(targets)} users to solve")
+        if not targets:
+            return
+
+        start = time.time()
+        stored = 0
+        processes = processes or max(1, (os.cpu_count() or 1) // 2)
+        with multiprocessing.Pool(processes, initializer=_init_process, initargs=(reference,)) as pool:
+            for i in range(0, len(targets), processes):
+                if not wait_for_quiet_queue(window):
+                    logging.info("Pregeneration: off-peak window ended, stopping")
+                    break
+                for target, entries in pool.imap_unordered(solve_target, targets[i:i + processes]):
+                    if not entries:
+                        logging.error(f"Pregeneration: no feasible menu for user {target['userName']}")
+                        continue
+                    store_pregenerated(target, entries)
+                    stored += 1
+
+        logging.info(f"Pregeneration: stored menus for {stored}/{len(targets)} users in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description="閑散時間に，直近のユーザーの次の献立を前回の登録食材で事前生成する")
+    parser.add_argument("--processes", type=int, default=None, help="並列プロセス数（既定: CPU 数の半分）")
+    parser.add_argument("--window", default=PREGEN_WINDOW,
+                        help="実行してよい時間帯（例: 1-6．空文字なら制限しない）")
+    parser.add_argument("--days", type=int, default=PREGEN_ACTIVE_DAYS, help="この日数以内に献立を作ったユーザーが対象")
+    parser.add_argument("--limit", type=int, default=None, help="解くユーザー数の上限")
+    args = parser.parse_args()
+    pregenerate(args.processes, parse_window(args.window) if args.window else None, args.days, args.limit)
@@ -0,0 +1,155 @@
+import io
+import os
+import time
+import pstats
+import logging
+import cProfile
+from contextlib import contextmanager, nullcontext
+from pyomo.common import timing
+
+# プロファイルの設定（既定は無効．無効時は何もしない文脈を返すだけ）
+PROFILE_JOBS = os.environ.get("PROFILE_JOBS", "0") == "1"                 # 全ジョブをプロファイル
+PROFILE_ROUTES = os.environ.get("PROFILE_ROUTES", "0") == "1"             # Flask のリクエストをプロファイル
+PROFILE_ROUTE_MIN_SECONDS = float(os.environ.get("PROFILE_ROUTE_MIN_SECONDS", 0.5))  # これより遅いリクエストだけ保存
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "../../profiles"))
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", 30))                      # 報告に残す関数・コンポーネントの数
+
+# cProfile の結果から累積時間の上位を文字列にする
+def top_functions(profiler, limit=PROFILE_TOP):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+def _dump_path(name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{name}.prof")
+
+
+class _ConstructionCollector(logging.Handler):
+    """Pyomo がコンポーネントを構築するたびに出す計測ログを集める"""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.components = []
+
+    def emit(self, record):
+        timer = record.msg
+        obj = getattr(timer, 'obj', None)
+        if obj is None:
+            return
+        self.components.append({
+            'component': obj.name,
+            'type': obj.ctype.__name__ if getattr(obj, 'ctype', None) else type(obj).__name__,
+            'seconds': round(float(getattr(timer, 'timer', 0) or 0), 6),
+            'size': len(obj) if hasattr(obj, '__len__') else None,
+        })
+
+
+class JobProfile:
+    """1 ジョブ分のプロファイル（フェーズごとの実時間・cProfile，Pyomo のコンポーネント構築時間）"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.phases = {}
+        self.components = []
+        self.children = []
+        self.profiler = cProfile.Profile()
+
+    # フェーズ（build・solve・save など）の実時間を測り，関数ごとの時間はジョブ全体でまとめる
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            self.phases[name] = round(self.phases.get(name, 0) + time.time() - start, 6)
+
+    # この中で構築した Pyomo コンポーネント（StapleCount・NutritionConstraints など）の時間を記録する
+    @contextmanager
+    def construction(self):
+        collector = _ConstructionCollector()
+        old_level = timing._logger.level
+        timing._logger.setLevel(logging.INFO)
+        timing._logger.addHandler(collector)
+        try:
+            yield
+        finally:
+            timing._logger.removeHandler(collector)
+            timing._logger.setLevel(old_level)
+            self.components.extend(collector.components)
+
+    # 子プロセス（sandbox）で測ったプロファイルの要約を取り込む（フェーズ・コンポーネントは足し，.prof は別に残す）
+    def absorb(self, report):
+        if not report:
+            return
+        for name, seconds in report['phases'].items():
+            self.phases[name] = round(self.phases.get(name, 0) + seconds, 6)
+        self.components.extend(report['components'])
+        self.children.append({'functions': report['functions'], 'file': report['file']})
+
+    # 結果を .prof ファイルに書き出し，ジョブに保存する要約を返す
+    def report(self):
+        path = _dump_path(f"job-{self.job_id}")
+        self.profiler.dump_stats(path)
+        components = sorted(self.components, key=lambda c: c['seconds'], reverse=True)
+        report = {
+            'phases': self.phases,
+            'components': components[:PROFILE_TOP],
+            'functions': top_functions(self.profiler),
+            'file': os.path.abspath(path),
+        }
+        if self.children:
+            report['children'] = self.children
+        return report
+
+
+class _NullProfile:
+    """無効時のプロファイル（何も測らない）"""
+
+    def phase(self, name):
+        return nullcontext()
+
+    def construction(self):
+        return nullcontext()
+
+    def absorb(self, report):
+        pass
+
+    def report(self):
+        return None
+
+NULL_PROFILE = _NullProfile()
+
+# ジョブのプロファイルを返す（環境変数かジョブごとのフラグで有効になる）
+def job_profile(job_id, requested=False):
+    if PROFILE_JOBS or requested:
+        return JobProfile(job_id)
+    return NULL_PROFILE
+
+# Flask アプリの各リクエストをプロファイルし，遅いものだけ .prof を残す（PROFILE_ROUTES=1 のときだけ登録）
+def install_route_profiler(app):
+    if not PROFILE_ROUTES:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_profile():
+        g._profile_start = time.time()
+        g._profiler = cProfile.Profile()
+        g._profiler.enable()
+
+    @app.teardown_request
+    def _stop_profile(exc):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        elapsed = time.time() - g.pop('_profile_start')
+        if elapsed < PROFILE_ROUTE_MIN_SECONDS:
+            return
+        endpoint = request.endpoint or 'unknown'
+        path = _dump_path(f"route-{endpoint}-{int(time.time() * 1000)}")
+        profiler.dump_stats(path)
+        logging.info(f"Slow request {request.method} {request.path} ({elapsed:.3f}s), profile: {path}\n{top_functions(profiler)}")
@@ -0,0 +1,382 @@
+import os
+import sys
+import mmap
+import json
+import bisect
+import struct
+import hashlib
+from array import array
+from collections.abc import Mapping
+import numpy as np
+from decimal import Decimal
+
+# 参照データ（レシピ・食材量・栄養素）の省メモリ表現
+# レシピ・食材・栄養素に整数 ID を振り，食材量は CSR（行ポインタ・列 ID・値の配列），栄養素は密行列で持つ
+# モデル側の recipe_dict[r]['data']['kind1'] / recipeitem_dict[r].get(i, 0) などの読み方はそのまま使える
+
+
+_MISSING = object()
+
+
+class RecipeRecord:
+    """レシピ 1 件分（モデルが使う kind1・kind2 だけを持つ）"""
+    __slots__ = ('recipeId', 'kind1', 'kind2')
+
+    def __init__(self, recipeId, kind1, kind2):
+        self.recipeId = recipeId
+        self.kind1 = sys.intern(kind1 or '')
+        self.kind2 = sys.intern(kind2 or '')
+
+    # 以前の as_dict 行と同じ読み方（record['data']['kind1']）に対応する
+    def __getitem__(self, key):
+        if key == 'data':
+            return self
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class RecipeTable(Mapping):
+    """recipeId → RecipeRecord"""
+
+    def __init__(self, ref):
+        self._ref = ref
+
+    def __getitem__(self, recipe_id):
+        return self._ref.records[self._ref.rows[recipe_id]]
+
+    def __iter__(self):
+        return iter(self._ref.rows)
+
+    def __len__(self):
+        return len(self._ref.rows)
+
+
+class IngredientRow(Mapping):
+    """1 レシピ分の {食材名: 量}（CSR の 1 行を指すだけで値は複製しない）"""
+    __slots__ = ('_ref', '_start', '_end')
+
+    def __init__(self, ref, row):
+        self._ref = ref
+        self._start = ref.indptr[row]
+        self._end = ref.indptr[row + 1]
+
+    # 行内の列 ID は昇順なので二分探索で引く
+    def get(self, name, default=None):
+        j = self._ref.ingredient_ids.get(name)
+        if j is None:
+            return default
+        indices = self._ref.indices
+        k = bisect.bisect_left(indices, j, self._start, self._end)
+        if k < self._end and indices[k] == j:
+            return self._ref.amounts[k]
+        return default
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __iter__(self):
+        names = self._ref.ingredients
+        indices = self._ref.indices
+        for k in range(self._start, self._end):
+            yield names[indices[k]]
+
+    def __len__(self):
+        return self._end - self._start
+
+
+class IngredientMatrix(Mapping):
+    """recipeId → IngredientRow"""
+
+    def __init__(self, ref):
+        self._ref = ref
+
+    def __getitem__(self, recipe_id):
+        return self._ref.ingredient_rows[self._ref.rows[recipe_id]]
+
+    def __iter__(self):
+        return iter(self._ref.rows)
+
+    def __len__(self):
+        return len(self._ref.rows)
+
+
+class NutrientRow(Mapping):
+    """1 レシピ分の {栄養素名: 値}（密行列の 1 行を指すだけで値は複製しない）"""
+    __slots__ = ('_ref', '_offset')
+
+    def __init__(self, ref, row):
+        self._ref = ref
+        self._offset = row * len(ref.nutrients)
+
+    def get(self, nut, default=None):
+        col = self._ref.nutrient_ids.get(nut)
+        if col is None:
+            return default
+        value = self._ref.nutrient_values[self._offset + col]
+        # NaN はその栄養素の値がないことを表す
+        return default if value != value else value
+
+    def __getitem__(self, nut):
+        value = self.get(nut, _MISSING)
+        if value is _MISSING:
+            raise KeyError(nut)
+        return value
+
+    def __iter__(self):
+        values = self._ref.nutrient_values
+        for col, nut in enumerate(self._ref.nutrients):
+            if values[self._offset + col] == values[self._offset + col]:
+                yield nut
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class NutrientMatrix(Mapping):
+    """recipeId → NutrientRow"""
+
+    def __init__(self, ref):
+        self._ref = ref
+
+    def __getitem__(self, recipe_id):
+        return self._ref.nutrient_rows[self._ref.rows[recipe_id]]
+
+    def __iter__(self):
+        return iter(self._ref.rows)
+
+    def __len__(self):
+        return len(self._ref.rows)
+
+
+class CompactReference:
+    """ワーカーが持つ参照データ一式"""
+
+    def __init__(self, recipe_ids, records, ingredients, nutrients, indptr, indices, amounts,
+                 nutrient_matrix, itemweight_dict, itemequal_dict, source=None):
+        self.source = source                              # 作成元 DB の状態（スナップショットの鮮度判定用）
+        self.recipe_ids = recipe_ids                      # 行番号 → recipeId
+        self.rows = {r: i for i, r in enumerate(recipe_ids)}
+        self.records = records                            # 行番号 → RecipeRecord
+        self.ingredients = ingredients                    # 食材 ID → 食材名
+        self.ingredient_ids = {n: i for i, n in enumerate(ingredients)}
+        self.nutrients = nutrients                        # 栄養素 ID → 栄養素名
+        self.nutrient_ids = {n: i for i, n in enumerate(nutrients)}
+        self.indptr = indptr                              # CSR：行 i の要素は indptr[i]〜indptr[i+1]
+        self.indices = indices                            # CSR：食材 ID
+        self.amounts = amounts                            # CSR：量（g）
+        self.nutrient_matrix = nutrient_matrix            # レシピ × 栄養素の密行列（欠損は NaN）
+        # 要素アクセスで Python の float を返すよう 1 次元の memoryview で引く
+        self.nutrient_values = memoryview(np.ascontiguousarray(nutrient_matrix).reshape(-1))
+        # 行ビューは作っておく（中身は配列を指すだけ）
+        self.ingredient_rows = [IngredientRow(self, i) for i in range(len(recipe_ids))]
+        self.nutrient_rows = [NutrientRow(self, i) for i in range(len(recipe_ids))]
+        self.itemweight_dict = itemweight_dict            # 件数が少ないので辞書のまま
+        self.itemequal_dict = itemequal_dict
+        self._version = None
+
+    # build_model に渡す 5 つの辞書相当（recipe, itemweight, itemequal, recipeitem, recipe_nutrition）
+    def views(self):
+        return (
+            RecipeTable(self), self.itemweight_dict, self.itemequal_dict,
+            IngredientMatrix(self), NutrientMatrix(self),
+        )
+
+    # 内容から求めた版（ハッシュ）
+    @property
+    def version(self):
+        if self._version is None:
+            h = hashlib.sha1()
+            header = [
+                list(self.recipe_ids), [(r.kind1, r.kind2) for r in self.records],
+                self.ingredients, self.nutrients, self.itemweight_dict, self.itemequal_dict,
+            ]
+            h.update(json.dumps(header, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'))
+            for buf in (self.indptr, self.indices, self.amounts, self.nutrient_matrix):
+                h.update(memoryview(buf).cast('B'))
+            self._version = h.hexdigest()
+        return self._version
+
+    # memoryview は pickle できないので，子プロセスへ渡すときは配列から作り直す
+    def __reduce__(self):
+        return (CompactReference, (
+            self.recipe_ids, self.records, self.ingredients, self.nutrients,
+            array('i', self.indptr), array('i', self.indices), array('d', self.amounts),
+            np.array(self.nutrient_matrix), self.itemweight_dict, self.itemequal_dict, self.source,
+        ))
+
+
+# スナップショットファイル：マジック・ヘッダ長・JSON ヘッダのあとに 8 バイト境界で配列をそのまま並べる
+SNAPSHOT_MAGIC = b"MENUREF\0"
+SNAPSHOT_FORMAT = 1
+
+def _json_default(obj):
+    # DB の numeric は数値のまま書く（文字列にすると読み込み後の計算が壊れる）
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+# DB の numeric（Decimal）を float にそろえる（スナップショットから読んだ値と比べても同じになるように）
+def plain_values(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, dict):
+        return {k: plain_values(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [plain_values(v) for v in obj]
+    return obj
+
+# 参照データをスナップショットファイルに書き出す（一時ファイルに書いてから置き換える）
+def save_snapshot(ref, path):
+    buffers = [
+        ('indptr', 'i', memoryview(ref.indptr).cast('B')),
+        ('indices', 'i', memoryview(ref.indices).cast('B')),
+        ('amounts', 'd', memoryview(ref.amounts).cast('B')),
+        ('nutrient_matrix', 'd', memoryview(np.ascontiguousarray(ref.nutrient_matrix)).cast('B')),
+    ]
+    layout = {}
+    offset = 0
+    for name, fmt, buf in buffers:
+        layout[name] = {'format': fmt, 'offset': offset, 'nbytes': buf.nbytes}
+        offset += (buf.nbytes + 7) // 8 * 8
+    header = json.dumps({
+        'format': SNAPSHOT_FORMAT,
+        'version': ref.version,
+        'source': ref.source,
+        'recipe_ids': list(ref.recipe_ids),
+        'kinds': [(r.kind1, r.kind2) for r in ref.records],
+        'ingredients': ref.ingredients,
+        'nutrients': ref.nutrients,
+        'itemweight_dict': ref.itemweight_dict,
+        'itemequal_dict': ref.itemequal_dict,
+        'layout': layout,
+    }, ensure_ascii=False, default=_json_default).encode('utf-8')
+    header += b" " * (-(len(SNAPSHOT_MAGIC) + 8 + len(header)) % 8)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, fmt, buf in buffers:
+            f.write(buf)
+            f.write(b"\0" * (-buf.nbytes % 8))
+    os.replace(tmp_path, path)
+
+# スナップショットファイルを読み込む（配列は mmap したまま使うので，同じノードのワーカーで物理メモリを共有できる）
+def load_snapshot(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"Not a reference snapshot: {path}")
+    start = len(SNAPSHOT_MAGIC) + 8
+    (header_len,) = struct.unpack('<Q', data[len(SNAPSHOT_MAGIC):start])
+    header = json.loads(data[start:start + header_len].decode('utf-8'))
+    if header.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format {header.get('format')}: {path}")
+
+    body = memoryview(data)[start + header_len:]
+    arrays = {}
+    for name, spec in header['layout'].items():
+        arrays[name] = body[spec['offset']:spec['offset'] + spec['nbytes']].cast(spec['format'])
+    recipe_ids = header['recipe_ids']
+    nutrients = header['nutrients']
+    matrix = np.frombuffer(arrays['nutrient_matrix'], dtype=np.float64).reshape(len(recipe_ids), len(nutrients))
+
+    ref = CompactReference(
+        recipe_ids,
+        [RecipeRecord(rid, kind1, kind2) for rid, (kind1, kind2) in zip(recipe_ids, header['kinds'])],
+        [sys.intern(n) for n in header['ingredients']], [sys.intern(n) for n in nutrients],
+        arrays['indptr'], arrays['indices'], arrays['amounts'], matrix,
+        header['itemweight_dict'], header['itemequal_dict'], header.get('source'),
+    )
+    ref._version = header['version']
+    return ref
+
+# DB から読んだ行（辞書）から省メモリ表現を組み立てる
+def build_reference(recipe_rows, itemweight_dict, itemequal_dict, recipeitem_dict, recipe_nutrition_dict, source=None):
+    recipe_ids = list(recipe_rows.keys())
+    records = []
+    for rid in recipe_ids:
+        data = recipe_rows[rid].get('data') or {}
+        records.append(RecipeRecord(rid, data.get('kind1'), data.get('kind2')))
+
+    ingredients = sorted({name for items in recipeitem_dict.values() for name in items})
+    ingredient_ids = {n: i for i, n in enumerate(ingredients)}
+    indptr, indices, amounts = array('i', [0]), array('i'), array('d')
+    for rid in recipe_ids:
+        # 行内は食材 ID 順（量 0 の食材もモデルの Items に入るので残す）
+        for j, amount in sorted(
+            (ingredient_ids[name], amount) for name, amount in recipeitem_dict.get(rid, {}).items()
+        ):
+            indices.append(j)
+            amounts.append(amount if amount is not None else 0)
+        indptr.append(len(indices))
+
+    nutrients = sorted({nut for nuts in recipe_nutrition_dict.values() if nuts for nut in nuts})
+    nutrient_ids = {n: i for i, n in enumerate(nutrients)}
+    matrix = np.full((len(recipe_ids), len(nutrients)), np.nan)
+    for i, rid in enumerate(recipe_ids):
+        for nut, value in (recipe_nutrition_dict.get(rid) or {}).items():
+            if value is not None:
+                matrix[i, nutrient_ids[nut]] = value
+
+    return CompactReference(
+        recipe_ids, records, [sys.intern(n) for n in ingredients], [sys.intern(n) for n in nutrients],
+        indptr, indices, amounts, matrix, plain_values(itemweight_dict), plain_values(itemequal_dict), source,
+    )
+
+
+# 2 つの参照データの差分：内容が変わった（追加・削除を含む）レシピ ID と，itemWeights・itemEquals が変わった食材名
+def changed_entries(old, new):
+    recipes = set(old.rows) ^ set(new.rows)
+    for rid in set(old.rows) & set(new.rows):
+        a, b = old.rows[rid], new.rows[rid]
+        if ((old.records[a].kind1, old.records[a].kind2) != (new.records[b].kind1, new.records[b].kind2)
+                or dict(old.ingredient_rows[a]) != dict(new.ingredient_rows[b])
+                or dict(old.nutrient_rows[a]) != dict(new.nutrient_rows[b])):
+            recipes.add(rid)
+
+    ingredients = set()
+    for old_dict, new_dict in ((old.itemweight_dict, new.itemweight_dict), (old.itemequal_dict, new.itemequal_dict)):
+        for name in set(old_dict) | set(new_dict):
+            # DB から作った側（Decimal）とスナップショット側（float）の違いを変更と見ない
+            before, after = plain_values(old_dict.get(name)), plain_values(new_dict.get(name))
+            if before != after:
+                ingredients.add(name)
+                # 等価クラスはもう一方の名前にも効く
+                for entry in (before, after):
+                    if entry and entry.get('equals'):
+                        ingredients.add(entry['equals'])
+    return recipes, ingredients
+
+# 指定した食材を使うレシピ ID
+def recipes_using(ref, names):
+    names = [n for n in names if n in ref.ingredient_ids]
+    if not names:
+        return set()
+    return {
+        rid for rid, row in zip(ref.recipe_ids, ref.ingredient_rows)
+        if any(row.get(n) is not None for n in names)
+    }
+
+# 指定したレシピだけを持つ参照データ（資源の上限に達したときの縮小モデル用）
+def subset_reference(ref, recipe_ids):
+    recipe_ids = set(recipe_ids)
+    keep = [rid for rid in ref.recipe_ids if rid in recipe_ids]
+    return build_reference(
+        {rid: {'data': {'kind1': ref.records[ref.rows[rid]].kind1, 'kind2': ref.records[ref.rows[rid]].kind2}} for rid in keep},
+        ref.itemweight_dict, ref.itemequal_dict,
+        {rid: dict(ref.ingredient_rows[ref.rows[rid]]) for rid in keep},
+        {rid: dict(ref.nutrient_rows[ref.rows[rid]]) for rid in keep},
+        ref.source,
+    )
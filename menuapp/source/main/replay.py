@@ -0,0 +1,234 @@
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import random
+import logging
+import argparse
+from multiprocessing import Pool
+from datetime import datetime
+from pyomo.environ import SolverFactory
+from source.main.reference_data import save_snapshot, load_snapshot
+from source.main.model_loader import build_job_model, extract_day_menus, objective_value, solve_model
+
+# 本番ジョブの記録と再実行：ワーカーが解いたジョブの入力・参照データの版・ソルバー設定・時間・結果を
+# 1 ファイル（job-<id>.json.gz）に残し，後から DB なしで同じ問題を解き直して時間と目的関数値を比べる
+
+# 記録の設定（既定は無効）
+CAPTURE_JOBS = os.environ.get("CAPTURE_JOBS", "0") == "1"
+CAPTURE_SAMPLE = float(os.environ.get("CAPTURE_SAMPLE", 1.0))      # 記録するジョブの割合
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", os.path.join(os.path.dirname(__file__), "../../captures"))
+BUNDLE_FORMAT = 1
+
+# 参照データは版ごとに 1 回だけスナップショットとして保存し，バンドルからは版で参照する
+def reference_path(version, capture_dir=CAPTURE_DIR):
+    return os.path.join(capture_dir, "refs", f"{version}.snapshot")
+
+def save_reference(reference, capture_dir=CAPTURE_DIR):
+    path = reference_path(reference.version, capture_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_snapshot(reference, path)
+    return path
+
+# 解いたジョブを記録する（CAPTURE_JOBS=1 のときだけ，CAPTURE_SAMPLE の割合で）
+def capture_job(job_id, reference, nutritionaltarget_dict, menstruation, regist_item, use_pfc, budget, edit,
+                solver_duration, model, day_menus, violations):
+    if not CAPTURE_JOBS or random.random() >= CAPTURE_SAMPLE:
+        return None
+    try:
+        save_reference(reference)
+        bundle = {
+            'format': BUNDLE_FORMAT,
+            'job_id': job_id,
+            'captured_at': datetime.now().isoformat(),
+            'reference_version': reference.version,
+            'inputs': {
+                'nutritionaltarget_dict': nutritionaltarget_dict,
+                'menstruation': menstruation,
+                'regist_item': regist_item,
+                'use_pfc': use_pfc,
+                'edit': edit,
+            },
+            'solver': {
+                'strategy': budget['strategy'],
+                'time_limit': budget['time_limit'],
+                'ratio_gap': budget['ratio_gap'],
+            },
+            'result': {
+                'solver_duration': solver_duration,
+                'objective': objective_value(model) if model is not None else None,
+                'day_menus': day_menus,
+                'violations': violations,
+            },
+        }
+        path = os.path.join(CAPTURE_DIR, f"job-{job_id}.json.gz")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(bundle, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+        logging.info(f"Captured job {job_id}: {path}")
+        return path
+    except Exception as e:
+        # 記録の失敗でジョブは落とさない
+        logging.error(f"Capture of job {job_id} failed: {e}")
+        return None
+
+def load_bundle(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+# 引数のファイル・ディレクトリからバンドルのパスを集める
+def bundle_paths(targets):
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            paths.extend(sorted(glob.glob(os.path.join(target, "job-*.json.gz"))))
+        else:
+            paths.append(target)
+    return paths
+
+# JSON を通すと日・食材の数値キーが文字列になるので，モデルが使う型に戻す
+def _restore_edit(edit):
+    if not edit:
+        return None
+    edit = dict(edit)
+    edit['menus'] = {
+        day: {kind: int(r) for kind, r in menu.items()} for day, menu in (edit.get('menus') or {}).items()
+    }
+    edit['lock_days'] = [int(d) for d in edit.get('lock_days', [])]
+    edit['lock_recipes'] = [int(r) for r in edit.get('lock_recipes', [])]
+    return edit
+
+# 再実行プロセスごとに参照データを版単位でキャッシュする
+_REFERENCES = {}
+_SETTINGS = {}
+
+def _init_replay(settings):
+    _SETTINGS.update(settings)
+
+def _reference(version):
+    if version not in _REFERENCES:
+        _REFERENCES[version] = load_snapshot(reference_path(version, _SETTINGS['capture_dir']))
+    return _REFERENCES[version]
+
+# バンドル 1 件を今のコードで構築・求解し，記録時と比べる
+def replay_bundle(path):
+    try:
+        bundle = load_bundle(path)
+    except (OSError, ValueError) as e:
+        return {'job_id': path, 'file': path, 'captured': {}, 'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+    inputs = bundle['inputs']
+    solver_settings = bundle['solver']
+    time_limit = _SETTINGS.get('time_limit') or solver_settings['time_limit']
+    outcome = {'job_id': bundle['job_id'], 'file': path, 'captured': bundle['result']}
+    try:
+        reference = _reference(bundle['reference_version'])
+        edit = _restore_edit(inputs.get('edit'))
+        build_start = time.time()
+        model, scope = build_job_model(
+            reference, inputs['nutritionaltarget_dict'], inputs['menstruation'],
+            inputs['regist_item'], inputs['use_pfc'], edit
+        )
+        if edit:
+            scope.get('apply_menu_locks')(
+                model, edit['menus'], edit.get('lock_days', []), edit.get('lock_recipes', []),
+                edit.get('exclude_current', True)
+            )
+        build_seconds = time.time() - build_start
+
+        solver = SolverFactory('cbc', executable=_SETTINGS['cbc'])
+        solver.options['sec'] = time_limit
+        solver.options['ratioGap'] = solver_settings['ratio_gap']
+        solve_start = time.time()
+        _, found = solve_model(solver, model, warmstart=bool(edit))
+        solve_seconds = time.time() - solve_start
+
+        day_menus = extract_day_menus(model)
+        captured_menus = bundle['result'].get('day_menus') or {}
+        outcome.update({
+            'status': 'ok' if found and all(day_menus.values()) else 'infeasible',
+            'build_seconds': round(build_seconds, 4),
+            'solve_seconds': round(solve_seconds, 4),
+            'objective': objective_value(model),
+            'same_menus': json.dumps(day_menus, sort_keys=True) == json.dumps(captured_menus, sort_keys=True),
+        })
+    except Exception as e:
+        outcome.update({'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+    return outcome
+
+def _delta(new, old):
+    if new is None or old is None:
+        return None
+    return round(new - old, 4)
+
+# 基準（記録時か，別のコードで取った再実行結果）との差を付ける
+def compare(results, baseline=None):
+    base = {str(r['job_id']): r for r in (baseline or [])}
+    for r in results:
+        ref = base.get(str(r['job_id']))
+        if ref is None:
+            ref = {'solve_seconds': r['captured'].get('solver_duration'), 'objective': r['captured'].get('objective')}
+        r['solve_delta'] = _delta(r.get('solve_seconds'), ref.get('solve_seconds'))
+        r['objective_delta'] = _delta(r.get('objective'), ref.get('objective'))
+    return results
+
+def summarize(results):
+    ok = [r for r in results if r['status'] == 'ok']
+    solve_deltas = [r['solve_delta'] for r in ok if r.get('solve_delta') is not None]
+    objective_deltas = [r['objective_delta'] for r in ok if r.get('objective_delta') is not None]
+    return {
+        'bundles': len(results),
+        'status': {s: sum(1 for r in results if r['status'] == s) for s in sorted({r['status'] for r in results})},
+        'same_menus': sum(1 for r in ok if r.get('same_menus')),
+        'solve_seconds': round(sum(r['solve_seconds'] for r in ok), 4),
+        'build_seconds': round(sum(r['build_seconds'] for r in ok), 4),
+        'solve_delta': round(sum(solve_deltas), 4) if solve_deltas else None,
+        'objective_worse': sum(1 for d in objective_deltas if d > 1e-6),
+        'objective_better': sum(1 for d in objective_deltas if d < -1e-6),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録したジョブを DB なしで再実行し，時間と目的関数値を比べる")
+    parser.add_argument("bundles", nargs="*", default=[CAPTURE_DIR], help="バンドル（job-*.json.gz）かそのディレクトリ")
+    parser.add_argument("--capture-dir", default=None, help="参照データのスナップショット（refs/）があるディレクトリ")
+    parser.add_argument("--cbc", default=os.environ.get("CBC_PATH", "cbc"), help="CBC の実行ファイル")
+    parser.add_argument("--time-limit", type=float, default=None, help="記録時の制限時間の代わりに使う秒数")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="並列に再実行するプロセス数")
+    parser.add_argument("--output", default=None, help="再実行結果を JSON で保存する（別のコードでの --baseline に使う）")
+    parser.add_argument("--baseline", default=None, help="比較対象の再実行結果（省略時は記録時の値と比べる）")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] %(message)s')
+
+    paths = bundle_paths(args.bundles)
+    if not paths:
+        print("No bundles found", file=sys.stderr)
+        sys.exit(1)
+    # 参照データは既定でバンドルと同じディレクトリの refs/ から読む
+    capture_dir = args.capture_dir or (args.bundles[0] if os.path.isdir(args.bundles[0]) else os.path.dirname(paths[0]))
+    settings = {'capture_dir': capture_dir, 'cbc': args.cbc, 'time_limit': args.time_limit}
+
+    with Pool(args.processes, initializer=_init_replay, initargs=(settings,)) as pool:
+        results = pool.map(replay_bundle, paths)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    results = compare(results, baseline)
+    report = {'summary': summarize(results), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report['summary'], ensure_ascii=False, indent=2))
+    for r in results:
+        if r['status'] != 'ok' or not r.get('same_menus'):
+            print(json.dumps({k: r.get(k) for k in ('job_id', 'status', 'error', 'solve_delta', 'objective_delta', 'same_menus')},
+                             ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import os
+import time
+import errno
+import random
+import signal
+import resource
+import multiprocessing
+import numpy as np
+from pyomo.common.errors import ApplicationError
+from source.main.reference_data import subset_reference, recipes_using
+from source.main.model_loader import model_functions
+
+# 求解を子プロセスに隔離する設定：メモリ（アドレス空間）・CPU 時間の上限と，実時間の打ち切り
+# CBC は子プロセスから起動されるので同じ上限を引き継ぐ．上限に達してもワーカー本体は落ちない
+SANDBOX_SOLVES = os.environ.get("SANDBOX_SOLVES", "1") == "1"
+SANDBOX_MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", 4096))          # 0 なら上限なし
+SANDBOX_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", 300))       # 0 なら上限なし
+SANDBOX_WALL_MARGIN = float(os.environ.get("SANDBOX_WALL_MARGIN", 60))      # 見込み時間に足す猶予（秒）
+# 構築前の規模チェック：x[d,r] と e[d,r,i]・倍数制約の数の見積もりがこれを超えるなら最初からレシピを絞る
+SANDBOX_MAX_COMPONENTS = int(os.environ.get("SANDBOX_MAX_COMPONENTS", 5_000_000))
+# 絞るときに種類（kind1）ごとに残すレシピ数（登録食材・部分編集で使うレシピ・ご飯は別に残す）
+PRUNED_RECIPES_PER_KIND = int(os.environ.get("PRUNED_RECIPES_PER_KIND", 60))
+
+KINDS = ('staple', 'main', 'side', 'soup')
+
+
+class SandboxLimit(Exception):
+    """子プロセスでの求解が資源の上限（メモリ・CPU 時間・実時間）に達した（安い方法に落としてよい）"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class SandboxError(Exception):
+    """子プロセスでの求解が上限以外の理由で失敗した（モデルのコードの誤りなど．落とさずにジョブを失敗にする）"""
+
+
+class SandboxCancelled(Exception):
+    """呼び出し側の取り消し（ジョブのリースを失ったなど）で子プロセスを止めた（結果は捨てる）"""
+
+
+# 子プロセスでの例外が資源の上限によるものなら理由を返す（上限以外なら None）
+# CBC は上限を引き継いだ孫プロセスなので，上限に達すると Pyomo の ApplicationError（異常終了）か起動時の ENOMEM になる
+# CBC の CPU 時間が上限に届いていれば cpu time，そうでなくメモリ上限付きで異常終了したなら確保の失敗（bad_alloc）とみなす
+def _limit_reason(exc):
+    if isinstance(exc, MemoryError):
+        return 'memory'
+    if isinstance(exc, OSError) and exc.errno in (errno.ENOMEM, errno.EAGAIN):
+        return 'memory'
+    if isinstance(exc, ApplicationError):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if SANDBOX_CPU_SECONDS and usage.ru_utime + usage.ru_stime >= SANDBOX_CPU_SECONDS - 1:
+            return 'cpu time'
+        if SANDBOX_MEMORY_MB:
+            return 'memory'
+    return None
+
+def _child_main(conn, target, args):
+    # CBC も含めてまとめて止められるよう，新しいプロセスグループにする
+    os.setsid()
+    if SANDBOX_MEMORY_MB:
+        limit = SANDBOX_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if SANDBOX_CPU_SECONDS:
+        resource.setrlimit(resource.RLIMIT_CPU, (SANDBOX_CPU_SECONDS, SANDBOX_CPU_SECONDS + 5))
+    try:
+        result = target(lambda payload: conn.send(('message', payload)), *args)
+        conn.send(('result', result))
+    except SandboxLimit as e:
+        conn.send(('limit', e.reason))
+    except BaseException as e:
+        reason = _limit_reason(e)
+        conn.send(('limit', reason) if reason else ('error', f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+        # 親から引き継いだ DB 接続などの後始末をさせずに終わる
+        os._exit(0)
+
+# target(send, *args) を上限付きの子プロセスで実行して戻り値を返す
+# 子が send(payload) で送った途中経過は on_message(payload) で親側で受け取る（DB への書き込みは親で行う）
+# cancel（threading.Event）が立ったら子を止めて SandboxCancelled を投げる
+def run_limited(target, args, on_message=None, wall_timeout=None, cancel=None):
+    ctx = multiprocessing.get_context('fork')
+    receiver, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child_main, args=(sender, target, args), daemon=True)
+    proc.start()
+    sender.close()
+    deadline = time.time() + wall_timeout if wall_timeout else None
+    try:
+        while True:
+            remaining = deadline - time.time() if deadline else 1.0
+            if remaining <= 0:
+                raise SandboxLimit('wall time')
+            if cancel is not None and cancel.is_set():
+                raise SandboxCancelled()
+            if not receiver.poll(min(remaining, 1.0)):
+                if not proc.is_alive() and not receiver.poll():
+                    break
+                continue
+            try:
+                kind, payload = receiver.recv()
+            except EOFError:
+                break
+            if kind == 'message':
+                if on_message is not None:
+                    on_message(payload)
+            elif kind == 'result':
+                return payload
+            elif kind == 'limit':
+                raise SandboxLimit(payload)
+            else:
+                raise SandboxError(payload)
+        # 結果を返さずに終わった：CPU 時間の上限（ソフトは SIGXCPU，ハードは SIGKILL）だけを上限として扱う
+        proc.join(1)
+        if proc.exitcode in (-signal.SIGXCPU, -signal.SIGKILL):
+            raise SandboxLimit('cpu time')
+        raise SandboxError(f"child exited with {proc.exitcode}")
+    finally:
+        if proc.is_alive():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                proc.kill()
+            proc.join()
+        receiver.close()
+
+# モデルの規模の見積もり（x[d,r]・e[d,r,i] と倍数制約 2 本が支配的）
+def estimate_model_size(reference, days=7):
+    recipes = len(reference.recipe_ids)
+    ingredients = len(reference.ingredients)
+    weighted = sum(1 for name in reference.ingredients if name in reference.itemweight_dict)
+    return days * recipes * (1 + ingredients + 2 * weighted)
+
+# レシピを絞った参照データ：登録食材を含むレシピ・部分編集で使うレシピ・ご飯は残し，それ以外は種類ごとに抽出する
+def prune_reference(reference, regist_item, seed, edit=None, per_kind=PRUNED_RECIPES_PER_KIND):
+    keep = set(recipes_using(reference, regist_item or {}))
+    if edit:
+        keep.update(int(r) for menu in edit.get('menus', {}).values() for r in menu.values())
+    gohan = model_functions()['GOHAN_KIND2']
+    by_kind = {}
+    for record in reference.records:
+        if record.kind2 == gohan:
+            keep.add(record.recipeId)
+        else:
+            by_kind.setdefault(record.kind1, []).append(record.recipeId)
+    rnd = random.Random(seed)
+    for kind, recipe_ids in by_kind.items():
+        keep.update(rnd.sample(recipe_ids, min(per_kind, len(recipe_ids))))
+    return subset_reference(reference, keep)
+
+# ソルバーを使わない貪欲法の献立：日ごとに主食・主菜・副菜・汁物を 1 品ずつ，
+# その時点までの栄養目標（範囲の中央）に最も近づくレシピを選ぶ（使用回数はモデルと同じ上限まで，登録食材を含むものを優先）
+# 栄養目標の外れは verifier で確かめる
+def heuristic_menus(reference, nutritionaltarget_dict, menstruation, use_pfc, regist_item, regist_bonus=0.5):
+    scope = model_functions()
+    nutritionals = next(iter(nutritionaltarget_dict.values()))['nutritionals']
+    bounds = scope['nutrition_bounds'](nutritionals, menstruation, scope['nutrition_keys'](use_pfc))
+
+    names = [n for n in bounds if n in reference.nutrient_ids]
+    values = np.nan_to_num(np.asarray(reference.nutrient_matrix)[:, [reference.nutrient_ids[n] for n in names]])
+    goal = np.array([
+        (lo + up) / 2 if lo is not None and up is not None else (lo if lo is not None else up)
+        for lo, up in (bounds[n] for n in names)
+    ], dtype=float)
+    scale = np.maximum(np.abs(goal), 1e-6)
+    preferred = {reference.rows[r] for r in recipes_using(reference, regist_item or {})}
+
+    candidates = {kind: [] for kind in KINDS}
+    for i, record in enumerate(reference.records):
+        if record.kind1 == 'staple' and record.kind2 in scope['STAPLE_SPECIAL_KIND2']:
+            continue
+        if record.kind1 in candidates:
+            candidates[record.kind1].append(i)
+
+    cap = scope['weekly_recipe_cap']
+    total = np.zeros(len(names))
+    used = {}
+    day_menus = {}
+    for d in range(1, 8):
+        menu = {}
+        for k, kind in enumerate(KINDS):
+            rows = [
+                i for i in candidates[kind]
+                if used.get(i, 0) < cap(reference.records[i].kind1, reference.records[i].kind2, 7)
+            ]
+            if not rows:
+                continue
+            # その日のこの品までで目指す合計との差（目標値で割って栄養素の単位をそろえる）
+            aim = goal * (d - 1 + (k + 1) / len(KINDS)) / 7
+            score = (((total + values[rows] - aim) / scale) ** 2).sum(axis=1)
+            score -= np.array([regist_bonus if i in preferred else 0 for i in rows])
+            best = rows[int(np.argmin(score))]
+            used[best] = used.get(best, 0) + 1
+            total += values[best]
+            menu[kind] = reference.recipe_ids[best]
+        day_menus[f"menu{d}"] = menu
+    return day_menus
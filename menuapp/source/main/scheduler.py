@@ -0,0 +1,107 @@
+import os
+import numpy as np
+
+# 求解予算の設定（環境変数で上書き可）
+BASE_TIME_LIMIT = float(os.environ.get("SOLVER_TIME_LIMIT", 20))      # 通常時の制限時間（秒）
+MIN_TIME_LIMIT = float(os.environ.get("SOLVER_TIME_LIMIT_MIN", 3))    # 高負荷時の下限
+MAX_TIME_LIMIT = float(os.environ.get("SOLVER_TIME_LIMIT_MAX", 30))   # 空いているときの上限
+BASE_RATIO_GAP = float(os.environ.get("SOLVER_RATIO_GAP", 0.02))      # 通常時の許容ギャップ
+MAX_RATIO_GAP = float(os.environ.get("SOLVER_RATIO_GAP_MAX", 0.10))   # 高負荷時に許す最大ギャップ
+QUEUE_WAIT_SLO = float(os.environ.get("QUEUE_WAIT_SLO", 60))          # 待ち時間の目標（秒）
+QUICK_TIME_LIMIT = float(os.environ.get("SOLVER_TIME_LIMIT_QUICK", 3)) # SLO超過時の最速ソルブ
+ALTERNATIVE_COUNT = int(os.environ.get("ALTERNATIVE_COUNT", 3))        # 余裕があるときに求める別案の数
+
+def plan_budget(backlog, queue_wait, recent_durations):
+    """キューの滞留数・待ち時間・直近の求解時間から，このジョブの求解予算を決める"""
+    # 既に SLO を超えて待たせているジョブは最速の戦略に回す
+    if queue_wait is not None and queue_wait > QUEUE_WAIT_SLO:
+        return {'strategy': 'fast', 'time_limit': QUICK_TIME_LIMIT, 'ratio_gap': MAX_RATIO_GAP, 'alternatives': 0}
+
+    # 実績がなければ通常の制限時間いっぱいかかると見積もる
+    durations = [d for d in recent_durations if d is not None]
+    avg_duration = sum(durations) / len(durations) if durations else BASE_TIME_LIMIT
+
+    # 負荷 = 後ろに並んでいるジョブを捌くのにかかる見込み時間 / SLO
+    load = backlog * avg_duration / QUEUE_WAIT_SLO
+
+    if load <= 1:
+        # SLO 内に捌ける → 空いているほど制限時間を延ばす
+        time_limit = BASE_TIME_LIMIT + (MAX_TIME_LIMIT - BASE_TIME_LIMIT) * (1 - load)
+        ratio_gap = BASE_RATIO_GAP
+        alternatives = ALTERNATIVE_COUNT
+    else:
+        # 捌ききれない → 負荷に応じて制限時間を縮め，ギャップを緩める
+        time_limit = max(MIN_TIME_LIMIT, BASE_TIME_LIMIT / load)
+        ratio_gap = min(MAX_RATIO_GAP, BASE_RATIO_GAP * load)
+        # 別案の生成は後回しにして待ち行列を優先する
+        alternatives = 0
+
+    return {
+        'strategy': 'solve',
+        'time_limit': round(time_limit, 1),
+        'ratio_gap': round(ratio_gap, 4),
+        'alternatives': alternatives,
+    }
+
+# --- ジョブの並べ替え（見込み時間による fast/slow レーン） ---
+FAST_LANE_SECONDS = float(os.environ.get("FAST_LANE_SECONDS", 5))          # これ以下の見込みなら fast レーン
+STARVATION_SECONDS = float(os.environ.get("STARVATION_SECONDS", 120))      # これ以上待ったジョブはレーンに関係なく最優先
+AGING_RATE = float(os.environ.get("SCHEDULER_AGING_RATE", 0.2))            # 待ち 1 秒あたりに差し引く見込み時間（長いジョブの飢餓防止）
+CHEAP_JOB_SECONDS = float(os.environ.get("CHEAP_JOB_SECONDS", 0.2))        # ライブラリ・キャッシュで返すジョブの見込み時間
+COST_MODEL_MIN_SAMPLES = int(os.environ.get("COST_MODEL_MIN_SAMPLES", 20)) # 実績がこれより少なければ既定値で見積もる
+
+
+class CostModel:
+    """ジョブの特徴（登録食材数・登録食材を含むレシピ数・部分編集か）から求解時間を見積もる線形モデル"""
+
+    def __init__(self, coef=None, samples=0):
+        self.coef = coef
+        self.samples = samples
+
+    @staticmethod
+    def features(regist_count, regist_recipes, edit):
+        return [1.0, float(regist_count), regist_recipes / 100.0, 1.0 if edit else 0.0]
+
+    # 実績 [(特徴, 求解時間), ...] から最小二乗（小さなリッジ付き）で係数を求める
+    @classmethod
+    def train(cls, samples):
+        if len(samples) < COST_MODEL_MIN_SAMPLES:
+            return cls(None, len(samples))
+        X = np.array([f for f, _ in samples])
+        y = np.array([t for _, t in samples])
+        ridge = 1e-3 * np.eye(X.shape[1])
+        coef = np.linalg.solve(X.T @ X + ridge, X.T @ y)
+        return cls([float(c) for c in coef], len(samples))
+
+    def predict(self, features, time_limit=BASE_TIME_LIMIT):
+        if self.coef is None:
+            # 実績がない間は，部分編集は短く，それ以外は制限時間いっぱいかかると見る
+            return MIN_TIME_LIMIT if features[3] else time_limit
+        value = sum(c * f for c, f in zip(self.coef, features))
+        return min(max(value, CHEAP_JOB_SECONDS), MAX_TIME_LIMIT)
+
+def job_lane(cost):
+    return 'fast' if cost <= FAST_LANE_SECONDS else 'slow'
+
+def order_jobs(entries, lane='any'):
+    """見込み時間・待ち時間・ユーザーから処理順を決め，このワーカーのレーンで扱うものだけを返す
+
+    entries は {'user', 'cost', 'waited', ...} の辞書のリスト（待ちの長い順でなくてよい）．
+    各レーン内は見込み時間の短い順（待った分だけ前に出す）で，同じユーザーのジョブは 1 件ずつ交互に並べる．
+    fast ワーカーは fast レーンと飢餓状態のジョブだけ，slow ワーカーは slow レーンを先に，空いていれば fast も処理する
+    """
+    seen = {}
+    for entry in sorted(entries, key=lambda e: -e['waited']):
+        entry['user_rank'] = seen.get(entry['user'], 0)
+        seen[entry['user']] = entry['user_rank'] + 1
+        entry['lane'] = job_lane(entry['cost'])
+        entry['starving'] = entry['waited'] >= STARVATION_SECONDS
+
+    def rank(entry):
+        return (not entry['starving'], entry['user_rank'], entry['cost'] - AGING_RATE * entry['waited'], -entry['waited'])
+
+    if lane == 'fast':
+        return sorted([e for e in entries if e['lane'] == 'fast' or e['starving']], key=rank)
+    if lane == 'slow':
+        return sorted(entries, key=lambda e: (e['lane'] != 'slow' and not e['starving'],) + rank(e))
+    return sorted(entries, key=rank)
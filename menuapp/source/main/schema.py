@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from sqlalchemy import text
+from source.main.menuapp import app, db, replica_engine, wait_for_replica
+
+# マイグレーション（版番号, 名前, DDL のリスト）．適用済みの版は schema_migrations に記録する
+# 既存の版は書き換えず，変更は必ず新しい版として末尾に追加すること
+MIGRATIONS = [
+    (1, "worker columns and menu library", [
+        # 求解予算（アドミッション制御）の記録用
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS problem_key TEXT",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS strategy TEXT",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS time_limit DOUBLE PRECISION",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS ratio_gap DOUBLE PRECISION",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS queue_wait DOUBLE PRECISION",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS solve_seconds DOUBLE PRECISION",
+        # 事前計算した献立ライブラリ（栄養目標プロファイルごとに K 件）
+        """CREATE TABLE IF NOT EXISTS menu_library (
+            id SERIAL PRIMARY KEY,
+            profile_key TEXT NOT NULL,
+            variant INTEGER NOT NULL,
+            profile_version TEXT NOT NULL,
+            menus JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            UNIQUE (profile_key, variant)
+        )""",
+        # 1 回の求解で得た別案（再生成用）
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS alternatives JSONB",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS alt_index INTEGER NOT NULL DEFAULT 0",
+        # 部分編集（固定する日・レシピと編集前の献立）
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS edit_json JSONB",
+        # 途中経過（暫定献立）を公開済みかどうか
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS provisional BOOLEAN NOT NULL DEFAULT FALSE",
+        # 栄養目標を満たせず緩和したときの栄養素ごとの違反量
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS violations JSONB",
+        # リース方式のジョブ取得（担当ワーカー・リース期限・再試行回数・次回試行時刻）
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS worker_id TEXT",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP",
+        # 栄養目標を (年齢, 性別, 運動レベル) で引く SQL 用の式インデックス
+        """CREATE INDEX IF NOT EXISTS nutritional_targets_profile_idx ON "nutritionalTargets" (
+            ("userInfo"->>'年齢'), ("userInfo"->>'性別'), ("userInfo"->>'運動レベル')
+        )""",
+    ]),
+    (2, "indexes for hot queries", [
+        # ワーカーの待機ジョブ取得（status='pending' ORDER BY created_at）
+        "CREATE INDEX IF NOT EXISTS menu_jobs_pending_idx ON menu_jobs (created_at) WHERE status='pending'",
+        # ユーザーごとの最新ジョブ取得・待機ジョブの削除（userName で絞って created_at 順）
+        "CREATE INDEX IF NOT EXISTS menu_jobs_user_idx ON menu_jobs (userName, created_at)",
+        # ユーザーの献立（userName で絞って createdAt 順）
+        'CREATE INDEX IF NOT EXISTS menu_user_idx ON "menu" ("userName", "createdAt")',
+        # レシピごとの食材・栄養
+        'CREATE INDEX IF NOT EXISTS recipe_items_recipe_idx ON "recipeItems" ("recipeId")',
+        'CREATE INDEX IF NOT EXISTS recipe_nutritions_recipe_idx ON "recipeNutritions" ("recipeId")',
+    ]),
+    (3, "job profiling", [
+        # ジョブごとのプロファイル指定と結果（フェーズ時間・コンポーネント構築時間・上位関数）
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS profile_requested BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS profile JSONB",
+    ]),
+    (4, "result dependencies", [
+        # 結果（kind='job' は menu_jobs.id，'library' は menu_library.profile_key）が使うレシピ・登録食材
+        """CREATE TABLE IF NOT EXISTS menu_dependencies (
+            kind TEXT NOT NULL,
+            ref TEXT NOT NULL,
+            recipe_id INTEGER,
+            ingredient TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS menu_dependencies_recipe_idx ON menu_dependencies (recipe_id)",
+        "CREATE INDEX IF NOT EXISTS menu_dependencies_ingredient_idx ON menu_dependencies (ingredient)",
+        "CREATE INDEX IF NOT EXISTS menu_dependencies_ref_idx ON menu_dependencies (kind, ref)",
+        # 参照データの変更で古くなった結果（同じ問題の再利用に使わない）
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS stale BOOLEAN NOT NULL DEFAULT FALSE",
+    ]),
+    (5, "job lanes", [
+        # スケジューラが見積もった所要時間と，振り分けたレーン（fast / slow）
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS predicted_seconds DOUBLE PRECISION",
+        "ALTER TABLE menu_jobs ADD COLUMN IF NOT EXISTS lane TEXT",
+    ]),
+    (6, "pregenerated menus", [
+        # 閑散時間に作っておいた次の献立（ユーザーごとに 1 件．使ったら消す）
+        """CREATE TABLE IF NOT EXISTS menu_pregenerated (
+            userName TEXT PRIMARY KEY,
+            problem_key TEXT NOT NULL,
+            menus JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )""",
+        # 直近に献立を作ったユーザーと最後の登録食材を引く
+        "CREATE INDEX IF NOT EXISTS menu_jobs_created_idx ON menu_jobs (created_at)",
+    ]),
+]
+
+# インデックスが効いているかを確かめる頻出クエリ（名前, SQL, インデックスで引くべきテーブル）
+HOT_QUERIES = [
+    ("pending jobs",
+     "SELECT id FROM menu_jobs WHERE status='pending' ORDER BY created_at",
+     ["menu_jobs"]),
+    ("latest job of user",
+     "SELECT status, provisional FROM menu_jobs WHERE userName='_' ORDER BY created_at DESC LIMIT 1",
+     ["menu_jobs"]),
+    ("delete waiting jobs of user",
+     "DELETE FROM menu_jobs WHERE userName='_' AND status IN ('pending','running')",
+     ["menu_jobs"]),
+    ("menu of user",
+     'SELECT id FROM "menu" WHERE "userName"=\'_\' ORDER BY "createdAt" DESC',
+     ["menu"]),
+    ("recipe items",
+     'SELECT items FROM "recipeItems" WHERE "recipeId"=1',
+     ["recipeItems"]),
+    ("recipe nutritions",
+     'SELECT nutritions FROM "recipeNutritions" WHERE "recipeId"=1',
+     ["recipeNutritions"]),
+    ("nutritional target",
+     """SELECT nutritionals FROM "nutritionalTargets" WHERE "userInfo"->>'年齢'='_' """
+     """AND "userInfo"->>'性別'='_' AND "userInfo"->>'運動レベル'='_'""",
+     ["nutritionalTargets"]),
+    ("dependents of changed recipes",
+     "SELECT DISTINCT kind, ref FROM menu_dependencies WHERE recipe_id = ANY(ARRAY[1]) OR ingredient = ANY(ARRAY['_'])",
+     ["menu_dependencies"]),
+]
+
+# 未適用のマイグレーションを版の順に適用する（版ごとに 1 トランザクション）
+def migrate():
+    with app.app_context():
+        db.session.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT NOW())"
+        ))
+        db.session.commit()
+        applied = set(db.session.execute(text("SELECT version FROM schema_migrations")).scalars().all())
+
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            try:
+                # 複数のワーカーが同時に起動しても 1 回だけ適用されるようにロックを取る
+                db.session.execute(text("LOCK TABLE schema_migrations IN EXCLUSIVE MODE"))
+                if db.session.execute(text(
+                    "SELECT 1 FROM schema_migrations WHERE version=:version"), {'version': version}
+                ).first():
+                    db.session.commit()
+                    continue
+                for stmt in statements:
+                    db.session.execute(text(stmt))
+                db.session.execute(text(
+                    "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                    {'version': version, 'name': name}
+                )
+                db.session.commit()
+                logging.info(f"Applied migration {version}: {name}")
+            except Exception:
+                db.session.rollback()
+                logging.error(f"Migration {version} ({name}) failed")
+                raise
+
+# 起動時にスキーマを最新にする（ワーカー・ライブラリ構築から呼ぶ）
+def ensure_schema():
+    migrate()
+    logging.info("Schema ensured")
+
+# 実行計画から Seq Scan しているテーブル名を集める
+def _seq_scans(plan):
+    tables = []
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        tables.extend(_seq_scans(child))
+    return tables
+
+# これより行数の少ないテーブルでは Seq Scan の方が安いことがあるので，既定のプランナーの判断は確かめず，
+# enable_seqscan を切ってインデックスが使える（定義があって条件に合う）ことだけを確かめる
+INDEX_CHECK_MIN_ROWS = int(os.environ.get("INDEX_CHECK_MIN_ROWS", 10000))
+
+# 頻出クエリの実行計画を調べ，インデックスを使わずに全件走査しているものを返す
+# 統計を取り直し，本番に近い行数のテーブルは既定のプランナー設定で（選ばれること），
+# 小さいテーブルは Seq Scan を切って（使えること）確かめる．1 件も確かめられなければそれも問題として返す
+def check_indexes(min_rows=INDEX_CHECK_MIN_ROWS):
+    problems = []
+    with app.app_context():
+        rows = {}
+        for table in sorted({t for _, _, tables in HOT_QUERIES for t in tables}):
+            db.session.execute(text(f'ANALYZE "{table}"'))
+            rows[table] = db.session.execute(text(
+                "SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"), {'name': f'"{table}"'}
+            ).scalar() or 0
+        db.session.commit()
+
+        checked = 0
+        for name, sql, tables in HOT_QUERIES:
+            small = [t for t in tables if rows[t] < min_rows]
+            if small:
+                db.session.execute(text("SET LOCAL enable_seqscan = off"))
+            result = db.session.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+            db.session.rollback()
+            plan = (json.loads(result) if isinstance(result, str) else result)[0]['Plan']
+            scanned = [t for t in _seq_scans(plan) if t in tables]
+            checked += 1
+            if scanned:
+                problems.append((name, scanned))
+                logging.error(f"Sequential scan on {', '.join(scanned)}: {name}")
+            elif small:
+                logging.info(f"Index usable (fewer than {min_rows} rows in {', '.join(small)}): {name}")
+            else:
+                logging.info(f"Index chosen: {name}")
+        if not checked:
+            problems.append(('all queries', []))
+            logging.error("No hot query was checked")
+    return problems
+
+# レプリカで読むテーブル（献立ページ・状態確認・ログイン中のユーザー・参照データ）
+REPLICA_TABLES = [
+    "user", "menu", "menu_jobs", "recipeUrls", "recipes", "recipeItems", "recipeNutritions",
+    "itemWeights", "itemEquals", "nutritionalTargets",
+]
+
+# 読み取りの振り分け先を確かめる（レプリカに必要なテーブルがあるか・リカバリ中か・プライマリからの遅れ）
+def check_replica():
+    with app.app_context():
+        if replica_engine is None:
+            logging.info("No replica configured (DATABASE_REPLICA_URL): all reads use the primary")
+            return []
+        with replica_engine.connect() as conn:
+            in_recovery, lag = conn.execute(text(
+                "SELECT pg_is_in_recovery(), EXTRACT(EPOCH FROM (NOW() - pg_last_xact_replay_timestamp()))"
+            )).first()
+            missing = [
+                t for t in REPLICA_TABLES
+                if conn.execute(text("SELECT to_regclass(:name)"), {'name': f'"{t}"'}).scalar() is None
+            ]
+        logging.info(f"Replica: in recovery={in_recovery}, replay lag={lag if lag is None else f'{float(lag):.1f}s'}")
+        if not wait_for_replica():
+            logging.warning("Replica did not catch up with the primary; reference data will be loaded from the primary")
+        for t in missing:
+            logging.error(f"Table missing on replica: {t}")
+    return missing
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description="スキーマのマイグレーションを適用する")
+    parser.add_argument("--check", action="store_true", help="適用後，頻出クエリがインデックスを使うか EXPLAIN で確かめる")
+    parser.add_argument("--min-rows", type=int, default=INDEX_CHECK_MIN_ROWS,
+                        help="--check でこれより行数の少ないテーブルは Seq Scan を切ってインデックスが使えるかだけを確かめる")
+    parser.add_argument("--check-replica", action="store_true", help="読み取り用レプリカに接続でき，必要なテーブルがあるか確かめる")
+    args = parser.parse_args()
+    ensure_schema()
+    failed = args.check and check_indexes(args.min_rows)
+    if args.check_replica and check_replica():
+        failed = True
+    if failed:
+        sys.exit(1)
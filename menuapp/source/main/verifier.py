@@ -0,0 +1,191 @@
+import numpy as np
+import pyomo.environ as pyo
+from source.main.model_loader import model_functions
+
+# ソルバーを通さない献立（キャッシュ・ライブラリ・ヒューリスティック・ユーザー編集）を build_model と同じ規則で検証する
+# 規則の定数と栄養目標の範囲はモデル定義（api_pyomo_model.py）から読むので，モデルと食い違わない
+
+KINDS = ('staple', 'main', 'side', 'soup')
+DAYS = 7
+
+
+class MenuVerifier:
+    """1 ユーザー分の条件（栄養目標・月経・PFC 有無）で，週の献立をまとめて検証する"""
+
+    def __init__(self, reference, nutritionaltarget_dict, menstruation, use_pfc, tol=1e-6):
+        scope = model_functions()
+        nutritionals = next(iter(nutritionaltarget_dict.values()))['nutritionals']
+        self.bounds = scope['nutrition_bounds'](nutritionals, menstruation, scope['nutrition_keys'](use_pfc))
+        self.items_per_day = scope['ITEMS_PER_DAY']
+        self.reference = reference
+        self.tol = tol
+
+        # レシピ行ごとの種類・主菜を兼ねる主食か・週の使用回数の上限（モデルの RecipeUsage と同じ関数で求める）
+        special = scope['STAPLE_SPECIAL_KIND2']
+        cap = scope['weekly_recipe_cap']
+        records = reference.records
+        self.kind_codes = np.array([KINDS.index(r.kind1) if r.kind1 in KINDS else -1 for r in records], dtype=np.int64)
+        self.special = np.array([r.kind1 == 'staple' and r.kind2 in special for r in records], dtype=bool)
+        self.caps = np.array([cap(r.kind1, r.kind2, DAYS) for r in records], dtype=np.int64)
+
+        # 栄養目標のある栄養素の列（参照データにない栄養素は合計 0 として扱う）
+        self.nutrients = list(self.bounds)
+        matrix = np.asarray(reference.nutrient_matrix)
+        columns = np.zeros((len(records), len(self.nutrients)))
+        for j, nut in enumerate(self.nutrients):
+            if nut in reference.nutrient_ids:
+                columns[:, j] = np.nan_to_num(matrix[:, reference.nutrient_ids[nut]])
+        self.values = columns
+        self.lower = np.array([np.nan if lo is None else lo for lo, _ in self.bounds.values()], dtype=float)
+        self.upper = np.array([np.nan if up is None else up for _, up in self.bounds.values()], dtype=float)
+
+    # 献立のリストを (献立数, 日, 種類) のレシピ行番号の配列にする（空きは -1，参照データにないレシピは -2）
+    def encode(self, menus_list):
+        rows = np.full((len(menus_list), DAYS, len(KINDS)), -1, dtype=np.int64)
+        index = self.reference.rows
+        for n, day_menus in enumerate(menus_list):
+            for d in range(DAYS):
+                for kind, r in (day_menus.get(f"menu{d + 1}") or {}).items():
+                    if kind in KINDS:
+                        rows[n, d, KINDS.index(kind)] = index.get(int(r), -2)
+        return rows
+
+    # 各献立の検証結果 [{'ok', 'errors', 'violations'}, ...]（violations は nutrition_violations と同じ形）
+    def verify(self, menus_list):
+        rows = self.encode(menus_list)
+        n = len(menus_list)
+        present = rows >= 0
+        safe = np.where(present, rows, 0)
+        unknown = (rows == -2).any(axis=(1, 2))
+
+        # 種類の取り違え（menuN の kind1 とレシピの kind1 が違う）
+        misplaced = (present & (self.kind_codes[safe] != np.arange(len(KINDS)))).any(axis=(1, 2))
+
+        # StapleCount・MainCount・SideCount・SoupCount（主菜は「主菜」か「主菜を兼ねる主食」のどちらか 1 品）
+        staple = present[:, :, 0]
+        main = present[:, :, 1].astype(int) + (staple & self.special[safe[:, :, 0]])
+        bad_staple = (~staple).any(axis=1)
+        bad_main = (main != 1).any(axis=1)
+        bad_side = (~present[:, :, 2]).any(axis=1)
+        bad_soup = (~present[:, :, 3]).any(axis=1)
+
+        # ItemsPerDay
+        items = present.sum(axis=2)
+        bad_items = ((items < self.items_per_day[0]) | (items > self.items_per_day[1])).any(axis=1)
+
+        # RecipeUsage：各レシピの週の使用回数が上限以下か（同じ献立の枠どうしを比べて数える）
+        flat = rows.reshape(n, -1)
+        used = flat >= 0
+        counts = ((flat[:, :, None] == flat[:, None, :]) & used[:, None, :]).sum(axis=2)
+        repeated = used & (counts > self.caps[np.where(used, flat, 0)])
+
+        # NutritionConstraints：1 週間の合計が範囲内か
+        totals = (self.values[safe] * present[..., None]).sum(axis=(1, 2))
+        shortage = np.where(np.isnan(self.lower), 0, np.maximum(0, self.lower - totals))
+        excess = np.where(np.isnan(self.upper), 0, np.maximum(0, totals - self.upper))
+        off = (shortage > self.tol) | (excess > self.tol)
+
+        checks = [
+            (unknown, "unknown recipe"), (misplaced, "kind1 mismatch"),
+            (bad_staple, "staple count"), (bad_main, "main count"), (bad_side, "side count"), (bad_soup, "soup count"),
+            (bad_items, "items per day"), (repeated.any(axis=1), "recipe usage"),
+        ]
+        reports = []
+        for i in range(n):
+            errors = [name for flags, name in checks if flags[i]]
+            violations = {}
+            for j in np.flatnonzero(off[i]):
+                violations[self.nutrients[j]] = {
+                    'total': round(float(totals[i, j]), 3),
+                    'lower': None if np.isnan(self.lower[j]) else round(float(self.lower[j]), 3),
+                    'upper': None if np.isnan(self.upper[j]) else round(float(self.upper[j]), 3),
+                    'shortage': round(float(shortage[i, j]), 3),
+                    'excess': round(float(excess[i, j]), 3),
+                }
+            if repeated[i].any():
+                reused = sorted({int(self.reference.recipe_ids[r]) for r in flat[i][repeated[i]]})
+                errors[errors.index("recipe usage")] = f"recipe usage: {reused}"
+            reports.append({'ok': not errors and not violations, 'errors': errors, 'violations': violations})
+        return reports
+
+    def verify_one(self, day_menus):
+        return self.verify([day_menus])[0]
+
+    # 献立の形（種類・品目数・使用回数）を満たすものだけを返す（栄養の外れは violations として残す）
+    def well_formed(self, menus_list):
+        return [menus for menus, report in zip(menus_list, self.verify(menus_list)) if not report['errors']]
+
+# 献立の形に関するモデルの制約（栄養以外）．verify の errors と同じ規則
+STRUCTURAL_CONSTRAINTS = ('StapleCount', 'MainCount', 'SideCount', 'SoupCount', 'ItemsPerDay', 'RecipeUsage')
+
+# 献立を実際のモデルに入れて，違反する形の制約名を返す（verifier と build_model の規則が食い違っていないかの確認用）
+# 献立に出てくるレシピだけでモデルを作るので軽い．栄養目標は使わない
+def model_errors(reference, day_menus):
+    from source.main.reference_data import subset_reference
+    from source.main.model_loader import build_job_model
+    used = {int(r) for menu in day_menus.values() for r in menu.values()}
+    subset = subset_reference(reference, used)
+    model, _ = build_job_model(subset, {0: {'nutritionals': {}, 'userInfo': {}}}, 'なし', {}, False)
+    chosen = {(d, int(r)) for d in model.Days for r in (day_menus.get(f"menu{d}") or {}).values()}
+    for (d, r), var in model.x.items():
+        var.set_value(1 if (d, r) in chosen else 0)
+    errors = []
+    for name in STRUCTURAL_CONSTRAINTS:
+        for index, con in getattr(model, name).items():
+            body = pyo.value(con.body)
+            lower = pyo.value(con.lower) if con.has_lb() else None
+            upper = pyo.value(con.upper) if con.has_ub() else None
+            if (lower is not None and body < lower - 1e-6) or (upper is not None and body > upper + 1e-6):
+                errors.append(f"{name}[{index}]")
+    return errors
+
+# 献立を少しずつ崩した検査用の献立（ご飯・主菜の使い回し，品目の欠け）
+def probe_menus(day_menus, reference):
+    gohan = model_functions()['GOHAN_KIND2']
+    probes = {'original': day_menus}
+    for kind, label in (('staple', 'reused staple'), ('main', 'reused main')):
+        days = [d for d in sorted(day_menus) if kind in day_menus[d]]
+        if len(days) >= 2:
+            probe = {d: dict(m) for d, m in day_menus.items()}
+            probe[days[1]][kind] = probe[days[0]][kind]
+            probes[label] = probe
+    # 同じご飯を 2 日に使う（主菜のある日の主食を差し替えるので，他の規則は崩さない）
+    rice = [r.recipeId for r in reference.records if r.kind1 == 'staple' and r.kind2 == gohan]
+    days = [d for d in sorted(day_menus) if day_menus[d].get('main') is not None]
+    if rice and len(days) >= 2:
+        probe = {d: dict(m) for d, m in day_menus.items()}
+        for d in days[:2]:
+            probe[d]['staple'] = rice[0]
+        probes['reused rice'] = probe
+    probe = {d: dict(m) for d, m in day_menus.items()}
+    probe['menu3'].pop('side', None)
+    probes['missing side'] = probe
+    return probes
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    from source.main.reference_data import load_snapshot
+    from source.main.sandbox import heuristic_menus
+    parser = argparse.ArgumentParser(description="献立の検証（verifier）とモデルの制約が同じ判定をするか確かめる")
+    parser.add_argument("snapshot", help="参照データのスナップショット")
+    parser.add_argument("--menus", default=None, help="検査の元にする献立（JSON．省略時は貪欲法の献立）")
+    args = parser.parse_args()
+
+    reference = load_snapshot(args.snapshot)
+    target = {0: {'nutritionals': {}, 'userInfo': {}}}
+    if args.menus:
+        with open(args.menus, encoding='utf-8') as f:
+            base = json.load(f)
+    else:
+        base = heuristic_menus(reference, target, 'なし', False, {})
+    verifier = MenuVerifier(reference, target, 'なし', False)
+    mismatches = 0
+    for label, menus in probe_menus(base, reference).items():
+        errors = verifier.verify_one(menus)['errors']
+        violated = model_errors(reference, menus)
+        same = bool(errors) == bool(violated)
+        mismatches += not same
+        print(json.dumps({'probe': label, 'same': same, 'verifier': errors, 'model': violated}, ensure_ascii=False))
+    raise SystemExit(1 if mismatches else 0)